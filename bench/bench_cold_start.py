@@ -0,0 +1,104 @@
+"""
+Benchmark time-to-first-redirect for a cold process, with and without the precompiled
+definitions snapshot (see src/functions/iri_snapshot.py).
+
+Each run starts a fresh Python process that imports the app, runs its lifespan startup,
+and serves one redirect through the ASGI interface.
+
+    python bench/bench_cold_start.py --config-dir ./configs --runs 10
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+repo_dir = Path(__file__).absolute().parent.parent
+
+
+def child(host: str, path: str):
+    t0 = time.perf_counter()
+    import asyncio
+    sys.path.insert(0, str(repo_dir))
+    from src.factory import create_app
+    t_import = time.perf_counter()
+
+    async def first_redirect():
+        app = create_app()
+        async with app.router.lifespan_context(app) as state:
+            t_ready = time.perf_counter()
+            scope = {
+                "type": "http", "http_version": "1.1", "method": "GET", "scheme": "https",
+                "path": "/" + path, "raw_path": ("/" + path).encode("utf-8"), "root_path": "",
+                "query_string": b"", "headers": [(b"host", host.encode("utf-8")), (b"accept", b"text/turtle")],
+                "client": ("127.0.0.1", 1), "server": (host, 443), "state": dict(state or {}),
+            }
+            sent = []
+
+            async def receive():
+                return {"type": "http.request", "body": b"", "more_body": False}
+
+            async def send(message):
+                sent.append(message)
+
+            await app(scope, receive, send)
+            return t_ready, sent[0]["status"]
+
+    t_ready, status = asyncio.run(first_redirect())
+    t_first = time.perf_counter()
+    print(json.dumps({
+        "import_s": t_import - t0, "startup_s": t_ready - t_import,
+        "first_redirect_s": t_first - t0, "status": status,
+    }))
+
+
+def run_children(env_overrides: dict, runs: int, host: str, path: str) -> list:
+    env = dict(os.environ)
+    env.update(env_overrides)
+    results = []
+    for _ in range(runs):
+        out = subprocess.run(
+            [sys.executable, __file__, "--child", "--host", host, "--path", path],
+            env=env, cwd=str(repo_dir), check=True, capture_output=True, text=True,
+        )
+        results.append(json.loads(out.stdout.strip().splitlines()[-1]))
+    return results
+
+
+def summarise(results: list) -> dict:
+    return {
+        k: statistics.median(r[k] for r in results)
+        for k in ("import_s", "startup_s", "first_redirect_s")
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--config-dir", default=str(repo_dir / "configs"))
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--host", default="linked.data.gov.au")
+    parser.add_argument("--path", default="dataset/bdr/orgs")
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        return child(args.host, args.path)
+
+    config_dir = str(Path(args.config_dir).absolute())
+    with tempfile.TemporaryDirectory() as tmp:
+        snapshot_file = str(Path(tmp) / "defs.pickle")
+        subprocess.run(
+            [sys.executable, "-m", "src.functions.iri_snapshot", snapshot_file],
+            env={**os.environ, "CONFIG_DEFS_DIRECTORY": config_dir}, cwd=str(repo_dir), check=True,
+        )
+        without = run_children({"CONFIG_DEFS_DIRECTORY": config_dir, "CONFIG_SNAPSHOT_FILE": ""}, args.runs, args.host, args.path)
+        with_snapshot = run_children({"CONFIG_DEFS_DIRECTORY": config_dir, "CONFIG_SNAPSHOT_FILE": snapshot_file}, args.runs, args.host, args.path)
+    report = {"runs": args.runs, "config_dir": config_dir, "without_snapshot": summarise(without), "with_snapshot": summarise(with_snapshot)}
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
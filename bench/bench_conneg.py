@@ -0,0 +1,65 @@
+"""
+Micro-benchmark of the content-negotiation header parsing in src/functions/connegp.py,
+memoised (as used by make_redir) against uncached parsing of the same headers.
+
+    python bench/bench_conneg.py --number 100000
+"""
+import argparse
+import json
+import sys
+import timeit
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).absolute().parent.parent))
+
+from src.functions.connegp import mediatype_extract, parse_mediatypes, parse_profiles, profile_extract
+from src.functions.iri_headers import RawHeaders
+
+HEADER_SETS = {
+    "browser": {
+        "accept": "text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,image/apng,*/*;q=0.8,application/signed-exchange;v=b3;q=0.7",
+    },
+    "rdflib": {
+        "accept": "application/rdf+xml, text/rdf+n3, application/xhtml+xml, text/turtle;q=0.9, application/n-triples;q=0.8, */*;q=0.1",
+    },
+    "curl_turtle": {
+        "accept": "text/turtle",
+    },
+    "profile_client": {
+        "accept": "text/turtle;q=1.0, application/ld+json;q=0.9",
+        "accept-profile": "<https://w3id.org/profile/vocpub>;q=1.0, <http://www.w3.org/ns/dx/prof/Profile>;q=0.5",
+    },
+}
+
+
+def bench(headers: RawHeaders, number: int) -> dict:
+    query = {}
+
+    def cached():
+        mediatype_extract(headers, query, None)
+        profile_extract(headers, query)
+
+    def uncached():
+        parse_mediatypes.__wrapped__(headers.accept, headers.prefer, None, None, None)
+        parse_profiles.__wrapped__(headers.accept_profile, headers.link, headers.prefer, None, None)
+
+    cached()  # warm the cache
+    t_uncached = min(timeit.repeat(uncached, number=number, repeat=3))
+    t_cached = min(timeit.repeat(cached, number=number, repeat=3))
+    return {
+        "uncached_us": t_uncached / number * 1e6,
+        "cached_us": t_cached / number * 1e6,
+        "speedup": t_uncached / t_cached,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--number", type=int, default=50000)
+    args = parser.parse_args()
+    report = {name: bench(RawHeaders.from_mapping(h), args.number) for name, h in HEADER_SETS.items()}
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+"""
+Benchmark redirects/sec for the Starlette app against the pure-ASGI fast path, create_app(fast=True).
+
+Requests are sent straight to the ASGI callable, in-process, so the numbers are for the app
+only, without a server or network. The redirect cache is turned off by default, so every
+request runs the rules, set --cache-size to measure with it on.
+
+    python bench/bench_fast_app.py --config-dir ./configs --requests 20000
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+from contextlib import asynccontextmanager
+from pathlib import Path
+
+repo_dir = Path(__file__).absolute().parent.parent
+sys.path.insert(0, str(repo_dir))
+
+# (path, headers) of the requests sent, in turn
+REQUESTS = [
+    ("/dataset/bdr", [(b"accept", b"text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8")]),
+    ("/dataset/bdr", [(b"accept", b"text/turtle")]),
+    ("/dataset/bdr/orgs", [(b"accept", b"text/turtle")]),
+    ("/dataset/bdr/orgs/wamuseum", [(b"accept", b"text/html")]),
+    ("/dataset/bdr/catalogs/abis", [(b"accept", b"*/*")]),
+    ("/not/a/path", []),
+]
+
+
+def make_scope(host: str, path: str, headers: list, state: dict) -> dict:
+    return {
+        "type": "http", "http_version": "1.1", "method": "GET", "scheme": "https",
+        "path": path, "raw_path": path.encode("utf-8"), "root_path": "", "query_string": b"",
+        "headers": [(b"host", host.encode("latin-1"))] + headers,
+        "client": ("127.0.0.1", 1), "server": (host, 443), "state": dict(state),
+    }
+
+
+@asynccontextmanager
+async def asgi_lifespan(app):
+    """Run the app's startup and shutdown through the ASGI lifespan protocol, like a server does."""
+    state = {}
+    to_app: asyncio.Queue = asyncio.Queue()
+    from_app: asyncio.Queue = asyncio.Queue()
+    task = asyncio.create_task(app({"type": "lifespan", "state": state}, to_app.get, from_app.put))
+    await to_app.put({"type": "lifespan.startup"})
+    message = await from_app.get()
+    assert message["type"] == "lifespan.startup.complete", message
+    try:
+        yield state
+    finally:
+        await to_app.put({"type": "lifespan.shutdown"})
+        await from_app.get()
+        await task
+
+
+async def run(fast: bool, host: str, n_requests: int) -> dict:
+    from src.factory import create_app
+    app = create_app(fast=fast)
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    statuses = {}
+
+    async def send(message):
+        if message["type"] == "http.response.start":
+            statuses[message["status"]] = statuses.get(message["status"], 0) + 1
+
+    async with asgi_lifespan(app) as state:
+        scopes = [make_scope(host, path, headers, state) for (path, headers) in REQUESTS]
+        # Warm up
+        for scope in scopes:
+            await app(dict(scope), receive, send)
+        statuses.clear()
+        t0 = time.perf_counter()
+        for i in range(n_requests):
+            await app(dict(scopes[i % len(scopes)]), receive, send)
+        elapsed = time.perf_counter() - t0
+    return {"requests": n_requests, "seconds": elapsed, "req_per_s": n_requests / elapsed, "statuses": statuses}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--config-dir", default=str(repo_dir / "configs"))
+    parser.add_argument("--requests", type=int, default=20000)
+    parser.add_argument("--host", default="linked.data.gov.au")
+    parser.add_argument("--cache-size", default="0")
+    args = parser.parse_args()
+    os.environ["CONFIG_DEFS_DIRECTORY"] = str(Path(args.config_dir).absolute())
+    os.environ["REDIR_CACHE_SIZE"] = args.cache_size
+    os.environ["CONFIG_SNAPSHOT_FILE"] = ""
+    report = {}
+    for (name, fast) in (("starlette", False), ("fast", True)):
+        report[name] = asyncio.run(run(fast, args.host, args.requests))
+    report["speedup"] = report["fast"]["req_per_s"] / report["starlette"]["req_per_s"]
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,217 @@
+"""
+Benchmark suite for the redirect engine, on synthetic configs (see synthetic_configs.py).
+
+For each config size it measures latency percentiles and throughput of:
+  - load_all_defs, loading and compiling all the definition files from cold
+  - make_redir, resolving a redirect for one request, without the web framework
+  - the end-to-end ASGI app, for both create_app() and create_app(fast=True)
+
+The results are written as JSON, so runs before and after a change can be compared:
+
+    python bench/bench_suite.py --sizes 100,10000 --output before.json
+    python bench/bench_suite.py --sizes 100,10000 --output after.json --compare before.json
+
+The redirect cache is off by default, so every request runs the rules.
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Dict, List
+
+repo_dir = Path(__file__).absolute().parent.parent
+sys.path.insert(0, str(repo_dir))
+
+from bench_fast_app import asgi_lifespan, make_scope
+from synthetic_configs import generate_configs, generate_workload
+
+
+def summarise(samples_ns: List[int], elapsed_s: float) -> dict:
+    samples = sorted(samples_ns)
+    n = len(samples)
+
+    def pct(p: float) -> float:
+        return samples[min(n - 1, int(p * n))] / 1000.0
+
+    return {
+        "n": n,
+        "p50_us": pct(0.50),
+        "p90_us": pct(0.90),
+        "p99_us": pct(0.99),
+        "max_us": samples[-1] / 1000.0,
+        "mean_us": statistics.fmean(samples) / 1000.0,
+        "throughput_per_s": n / elapsed_s if elapsed_s > 0 else None,
+    }
+
+
+def bench_load_all_defs(runs: int) -> dict:
+    from src.functions.iri_configs import load_all_defs
+    samples = []
+    t_start = time.perf_counter()
+    for _ in range(runs):
+        state = {}
+        t0 = time.perf_counter_ns()
+        load_all_defs(state)
+        samples.append(time.perf_counter_ns() - t0)
+    return summarise(samples, time.perf_counter() - t_start)
+
+
+async def _bench_make_redir(workload: list) -> dict:
+    from starlette.requests import Request
+    from src.functions.iri_redirect import make_redir
+    from src.routers.iri_redirect_router import lifespan
+
+    def run_one(host: str, path: str, request: Request):
+        # make_redir never awaits anything, so it can be run to completion with one send()
+        coro = make_redir("https", [host], path, {}, request)
+        try:
+            coro.send(None)
+        except StopIteration as e:
+            return e.value
+        raise RuntimeError("make_redir did not complete synchronously")
+
+    async with lifespan(None) as state:
+        requests = []
+        for (host, path, accept) in workload:
+            headers = [(b"accept", accept.encode("latin-1"))] if accept else []
+            requests.append((host, path, Request(make_scope(host, "/" + path, headers, state))))
+        for (host, path, request) in requests[:100]:
+            run_one(host, path, request)
+        samples = []
+        t_start = time.perf_counter()
+        for (host, path, request) in requests:
+            t0 = time.perf_counter_ns()
+            run_one(host, path, request)
+            samples.append(time.perf_counter_ns() - t0)
+        elapsed = time.perf_counter() - t_start
+    return summarise(samples, elapsed)
+
+
+def bench_make_redir(workload: list) -> dict:
+    return asyncio.run(_bench_make_redir(workload))
+
+
+async def _bench_asgi(fast: bool, workload: list) -> dict:
+    from src.factory import create_app
+    app = create_app(fast=fast)
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    statuses: Dict[int, int] = {}
+
+    async def send(message):
+        if message["type"] == "http.response.start":
+            statuses[message["status"]] = statuses.get(message["status"], 0) + 1
+
+    async with asgi_lifespan(app) as state:
+        scopes = []
+        for (host, path, accept) in workload:
+            headers = [(b"accept", accept.encode("latin-1"))] if accept else []
+            scopes.append(make_scope(host, "/" + path, headers, state))
+        for scope in scopes[:100]:
+            await app(dict(scope), receive, send)
+        statuses.clear()
+        samples = []
+        t_start = time.perf_counter()
+        for scope in scopes:
+            t0 = time.perf_counter_ns()
+            await app(scope, receive, send)
+            samples.append(time.perf_counter_ns() - t0)
+        elapsed = time.perf_counter() - t_start
+    result = summarise(samples, elapsed)
+    result["statuses"] = {str(k): v for k, v in sorted(statuses.items())}
+    return result
+
+
+def bench_asgi(fast: bool, workload: list) -> dict:
+    return asyncio.run(_bench_asgi(fast, workload))
+
+
+def git_revision() -> str:
+    try:
+        out = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=str(repo_dir), capture_output=True, text=True, check=True)
+        return out.stdout.strip()
+    except Exception:
+        return "unknown"
+
+
+def compare(old: dict, new: dict) -> list:
+    """Lines comparing the p50/p99 latencies of two runs."""
+    lines = []
+    for size, benches in new["results"].items():
+        old_benches = old.get("results", {}).get(size, {})
+        for name, r in benches.items():
+            o = old_benches.get(name, None)
+            if not o:
+                continue
+            lines.append(
+                f"{size:>8} {name:<16} p50 {o['p50_us']:10.1f} -> {r['p50_us']:10.1f} us ({r['p50_us'] / o['p50_us']:.2f}x)"
+                f"  p99 {o['p99_us']:10.1f} -> {r['p99_us']:10.1f} us ({r['p99_us'] / o['p99_us']:.2f}x)"
+            )
+    return lines
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", default="100,10000,100000", help="Comma separated total numbers of rules")
+    parser.add_argument("--hosts", type=int, default=4)
+    parser.add_argument("--requests", type=int, default=20000)
+    parser.add_argument("--load-runs", type=int, default=5)
+    parser.add_argument("--cache-size", default="0")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default=None, help="Write the results to this JSON file")
+    parser.add_argument("--compare", default=None, help="Compare with the results in this JSON file")
+    args = parser.parse_args()
+
+    os.environ["REDIR_CACHE_SIZE"] = args.cache_size
+    os.environ["CONFIG_SNAPSHOT_FILE"] = ""
+    from src import settings
+    settings["REDIR_CACHE_SIZE"] = args.cache_size
+    settings["CONFIG_SNAPSHOT_FILE"] = ""
+    settings["SERVER_NAME"] = ""
+
+    report = {
+        "revision": git_revision(),
+        "python": platform.python_version(),
+        "regex_engine": settings["REGEX_ENGINE"],
+        "hosts": args.hosts,
+        "requests": args.requests,
+        "cache_size": args.cache_size,
+        "results": {},
+    }
+    for size in (int(s) for s in args.sizes.split(",") if s.strip()):
+        with tempfile.TemporaryDirectory() as config_dir:
+            paths = generate_configs(config_dir, size, args.hosts)
+            workload = generate_workload(paths, args.requests, args.seed)
+            settings["CONFIG_DEFS_DIRECTORY"] = config_dir
+            results = {
+                "load_all_defs": bench_load_all_defs(args.load_runs),
+                "make_redir": bench_make_redir(workload),
+                "asgi_starlette": bench_asgi(False, workload),
+                "asgi_fast": bench_asgi(True, workload),
+            }
+        report["results"][str(size)] = results
+        for name, r in results.items():
+            print(f"{size:>8} {name:<16} p50 {r['p50_us']:10.1f} us  p99 {r['p99_us']:10.1f} us  {r['throughput_per_s']:10.1f}/s", file=sys.stderr)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+    if args.compare:
+        with open(args.compare) as f:
+            old = json.load(f)
+        for line in compare(old, report):
+            print(line, file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,247 @@
+"""
+Replay recorded requests against the redirect app, and check their Locations.
+
+Reads request records from a JSONL file (or stdin), one JSON object per line:
+
+    {"method": "GET", "host": "linked.data.gov.au", "path": "/dataset/bdr?_profile=x",
+     "headers": {"accept": "text/turtle"}, "expected_status": 307, "expected_location": "https://..."}
+
+Only ``path`` is required. ``method`` defaults to GET, ``host`` to --host, and ``scheme`` to https.
+``headers`` is an object, or a list of [name, value] pairs. When a record has an
+``expected_location`` (null for no Location) or an ``expected_status``, the response is checked
+against it, and the records that differ are reported.
+
+The records are read as a stream and sent by --concurrency workers, either straight to the ASGI
+app from create_app() in-process, or to a running server with --url:
+
+    python bench/replay_traffic.py traffic.jsonl --config-dir ./configs --concurrency 16
+    python bench/replay_traffic.py traffic.jsonl --fast --output report.json --mismatches diffs.jsonl
+    python bench/replay_traffic.py traffic.jsonl --url http://localhost:8000 --concurrency 64
+
+The report has the throughput, latency percentiles, status counts and mismatch count.
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, TextIO, Tuple
+from urllib.parse import quote, unquote
+
+repo_dir = Path(__file__).absolute().parent.parent
+sys.path.insert(0, str(repo_dir))
+
+from bench_fast_app import asgi_lifespan
+from bench_suite import git_revision, summarise
+
+# Mismatches kept in the report, the rest are only counted (and written to --mismatches)
+REPORT_MISMATCHES = 20
+
+# (method, scheme, host, path, query string, headers, record)
+ReplayRequest = Tuple[str, str, str, str, str, List[Tuple[str, str]], dict]
+# (status, location)
+ReplayResponse = Tuple[int, Optional[str]]
+
+
+def read_records(lines: Iterable[str], default_host: str) -> Iterator[ReplayRequest]:
+    for (line_no, line) in enumerate(lines, 1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            record = json.loads(line)
+            full_path = record["path"]
+        except (ValueError, KeyError, TypeError) as e:
+            print(f"Skipping bad record on line {line_no}: {e}", file=sys.stderr)
+            continue
+        headers = record.get("headers", None) or {}
+        if isinstance(headers, dict):
+            headers = list(headers.items())
+        (path, _, query) = full_path.partition("?")
+        yield (
+            str(record.get("method", "GET")).upper(),
+            record.get("scheme", "https"),
+            record.get("host", None) or default_host,
+            "/" + path.lstrip("/"),
+            query,
+            [(str(k).lower(), str(v)) for (k, v) in headers],
+            record,
+        )
+
+
+def asgi_sender(app, state: dict) -> Callable:
+    """Sends a request straight to the ASGI app, with the lifespan ``state``."""
+
+    async def send_request(request: ReplayRequest) -> ReplayResponse:
+        (method, scheme, host, path, query, headers, _) = request
+        scope = {
+            "type": "http", "http_version": "1.1", "method": method, "scheme": scheme,
+            "path": unquote(path), "raw_path": path.encode("latin-1", "replace"), "root_path": "",
+            "query_string": query.encode("latin-1", "replace"),
+            "headers": [(b"host", host.encode("latin-1"))] + [
+                (k.encode("latin-1"), v.encode("latin-1", "replace")) for (k, v) in headers if k != "host"
+            ],
+            "client": ("127.0.0.1", 1), "server": (host, 443 if scheme == "https" else 80), "state": dict(state),
+        }
+        response: Dict[str, Any] = {}
+
+        async def receive():
+            return {"type": "http.request", "body": b"", "more_body": False}
+
+        async def send(message):
+            if message["type"] == "http.response.start":
+                response["status"] = message["status"]
+                for (k, v) in message.get("headers", ()):
+                    if k.lower() == b"location":
+                        response["location"] = v.decode("latin-1")
+                        break
+
+        await app(scope, receive, send)
+        return response["status"], response.get("location", None)
+
+    return send_request
+
+
+def http_sender(client) -> Callable:
+    """Sends a request to a running server with an httpx.AsyncClient, with the record's Host header."""
+
+    async def send_request(request: ReplayRequest) -> ReplayResponse:
+        (method, _, host, path, query, headers, _) = request
+        url = quote(path, safe="/%:@!$&'()*+,;=~") + ("?" + query if query else "")
+        resp = await client.request(method, url, headers=[("host", host)] + [(k, v) for (k, v) in headers if k != "host"])
+        return resp.status_code, resp.headers.get("location", None)
+
+    return send_request
+
+
+def check_response(request: ReplayRequest, response: ReplayResponse) -> Optional[dict]:
+    """The mismatch of the response with the record's expected status and Location, or None if it matches."""
+    record = request[6]
+    (status, location) = response
+    expected_status = record.get("expected_status", None)
+    status_differs = expected_status is not None and int(expected_status) != status
+    location_differs = "expected_location" in record and record["expected_location"] != location
+    if not status_differs and not location_differs:
+        return None
+    return {
+        "method": request[0], "host": request[2], "path": request[3] + ("?" + request[4] if request[4] else ""),
+        "status": status, "expected_status": expected_status,
+        "location": location, "expected_location": record.get("expected_location", None),
+    }
+
+
+async def replay(
+    requests: Iterator[ReplayRequest],
+    send_request: Callable,
+    concurrency: int,
+    mismatches_out: Optional[TextIO] = None,
+) -> dict:
+    """Send the requests with ``concurrency`` workers, and report on their latencies and mismatches."""
+    samples: List[int] = []
+    statuses: Dict[int, int] = {}
+    mismatches: List[dict] = []
+    counts = {"mismatches": 0, "errors": 0}
+
+    async def worker():
+        # The workers share the one iterator, so the records are read as they are needed
+        for request in requests:
+            t0 = time.perf_counter_ns()
+            try:
+                response = await send_request(request)
+            except Exception as e:
+                counts["errors"] += 1
+                print(f"Error sending {request[0]} {request[2]}{request[3]}: {type(e).__name__}: {e}", file=sys.stderr)
+                continue
+            samples.append(time.perf_counter_ns() - t0)
+            statuses[response[0]] = statuses.get(response[0], 0) + 1
+            mismatch = check_response(request, response)
+            if mismatch is not None:
+                counts["mismatches"] += 1
+                if len(mismatches) < REPORT_MISMATCHES:
+                    mismatches.append(mismatch)
+                if mismatches_out is not None:
+                    mismatches_out.write(json.dumps(mismatch, ensure_ascii=False) + "\n")
+
+    t_start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(max(1, concurrency))))
+    elapsed = time.perf_counter() - t_start
+    report: Dict[str, Any] = summarise(samples, elapsed) if samples else {"n": 0}
+    report["statuses"] = {str(k): v for k, v in sorted(statuses.items())}
+    report["errors"] = counts["errors"]
+    report["mismatch_count"] = counts["mismatches"]
+    report["mismatches"] = mismatches
+    return report
+
+
+async def replay_in_process(requests: Iterator[ReplayRequest], fast: bool, concurrency: int, mismatches_out: Optional[TextIO] = None) -> dict:
+    from src.factory import create_app
+    app = create_app(fast=fast)
+    async with asgi_lifespan(app) as state:
+        return await replay(requests, asgi_sender(app, state), concurrency, mismatches_out)
+
+
+async def replay_url(requests: Iterator[ReplayRequest], url: str, concurrency: int, mismatches_out: Optional[TextIO] = None) -> dict:
+    try:
+        import httpx
+    except ImportError:
+        raise RuntimeError("httpx must be installed to replay requests against a URL")
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(base_url=url, follow_redirects=False, limits=limits, timeout=30.0) as client:
+        return await replay(requests, http_sender(client), concurrency, mismatches_out)
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("input", nargs="?", default="-", help="JSONL file of request records, or - for stdin")
+    parser.add_argument("--url", default=None, help="Replay against a running server at this base URL, instead of in-process")
+    parser.add_argument("--fast", action="store_true", help="Use create_app(fast=True) in-process")
+    parser.add_argument("--config-dir", default=None, help="Definitions directory, for the in-process app")
+    parser.add_argument("--host", default="localhost", help="Host for records that don't give one")
+    parser.add_argument("--concurrency", "-c", type=int, default=8)
+    parser.add_argument("--cache-size", default=None, help="REDIR_CACHE_SIZE for the in-process app")
+    parser.add_argument("--output", default=None, help="Write the report to this JSON file")
+    parser.add_argument("--mismatches", default=None, help="Write every mismatch to this JSONL file")
+    args = parser.parse_args(argv)
+
+    from src import settings
+    if args.config_dir is not None:
+        settings["CONFIG_DEFS_DIRECTORY"] = os.path.abspath(args.config_dir)
+    if args.cache_size is not None:
+        settings["REDIR_CACHE_SIZE"] = args.cache_size
+    in_file = sys.stdin if args.input == "-" else open(args.input, "r", encoding="utf-8")
+    mismatches_out = None if args.mismatches is None else open(args.mismatches, "w", encoding="utf-8")
+    try:
+        requests = read_records(in_file, args.host)
+        if args.url:
+            report = asyncio.run(replay_url(requests, args.url, args.concurrency, mismatches_out))
+        else:
+            report = asyncio.run(replay_in_process(requests, args.fast, args.concurrency, mismatches_out))
+    finally:
+        if in_file is not sys.stdin:
+            in_file.close()
+        if mismatches_out is not None:
+            mismatches_out.close()
+    report = {
+        "revision": git_revision(),
+        "target": args.url or ("asgi_fast" if args.fast else "asgi_starlette"),
+        "concurrency": args.concurrency,
+        "regex_engine": settings["REGEX_ENGINE"],
+        **report,
+    }
+    if report["n"]:
+        print(
+            f"{report['n']} requests, {report['throughput_per_s']:.1f}/s, p50 {report['p50_us']:.1f} us, "
+            f"p99 {report['p99_us']:.1f} us, {report['mismatch_count']} mismatches, {report['errors']} errors",
+            file=sys.stderr,
+        )
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
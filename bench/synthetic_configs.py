@@ -0,0 +1,146 @@
+"""
+Generator of synthetic redirect definition files, and of a request workload to go with them,
+for benchmarking the redirect engine at scale.
+
+The rules are spread over several virtualhosts, one definition file each. Every host gets
+static redirects (some of them to its own prez_v3 dest), regex redirects with distinct literal
+prefixes plus a few broad catch-alls, and pairs of conditional HTML / not-HTML redirects.
+
+    python bench/synthetic_configs.py ./tmp_configs --rules 10000 --hosts 4
+"""
+import argparse
+import json
+import random
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+# Share of the rules of each kind
+STATIC_SHARE = 0.60
+REGEX_SHARE = 0.25
+CONDITIONAL_SHARE = 0.15
+# Share of the static redirects that go to the prez_v3 dest
+DEST_SHARE = 0.2
+
+# Accept header mixes, with the share of requests that send each one
+ACCEPT_MIX: List[Tuple[str, float]] = [
+    ("text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,*/*;q=0.8", 0.40),
+    ("*/*", 0.20),
+    ("text/turtle", 0.15),
+    ("application/rdf+xml, text/rdf+n3, application/xhtml+xml, text/turtle;q=0.9, */*;q=0.1", 0.10),
+    ("application/ld+json", 0.10),
+    ("", 0.05),
+]
+# Share of the requests for paths that have no rule
+MISS_SHARE = 0.05
+
+
+def host_name(h: int) -> str:
+    return f"host{h}.example.org"
+
+
+def _toml_str(s: str) -> str:
+    return json.dumps(s)
+
+
+def generate_configs(out_dir: str, n_rules: int, n_hosts: int = 4) -> Dict[str, dict]:
+    """
+    Write ``n_hosts`` definition files with ``n_rules`` rules between them to ``out_dir``.
+    Returns, for each host, the paths that were generated for each kind of rule.
+    """
+    out = Path(out_dir)
+    out.mkdir(parents=True, exist_ok=True)
+    for old in out.glob("*.toml"):
+        old.unlink()
+    per_host = max(1, n_rules // n_hosts)
+    n_static = int(per_host * STATIC_SHARE)
+    n_regex = int(per_host * REGEX_SHARE)
+    n_cond = max(1, int(per_host * CONDITIONAL_SHARE) // 2)
+    n_dest = int(n_static * DEST_SHARE)
+    paths = {}
+    for h in range(n_hosts):
+        host = host_name(h)
+        lines = [
+            "[default]",
+            f"virtualhost = {_toml_str(host)}",
+            'code = "307"',
+            "qsa = true",
+            "",
+            "[redirects]",
+        ]
+        static_paths = []
+        dest_paths = []
+        for i in range(n_static):
+            path = f"static/s{i}"
+            if i < n_dest:
+                path = f"vocab/v{i}"
+                dest_paths.append(path)
+                lines.append(f"{_toml_str(path)} = {{ to=\"!prez{h}\", prez_kind=\"vocab\" }}")
+            else:
+                static_paths.append(path)
+                lines.append(f"{_toml_str(path)} = {_toml_str(f'https://target.example.com/{host}/{path}')}")
+        regex_paths = []
+        for i in range(n_regex):
+            pattern = f"^reg/r{i}/(.+)"
+            regex_paths.append(f"reg/r{i}/item{i}")
+            lines.append(f"{_toml_str(pattern)} = {{ to={_toml_str(f'https://target.example.com/{host}/r{i}/{{1}}')}, kind=\"regex\" }}")
+        # A few broad catch-alls, that every regex path must be checked against
+        for (pattern, to) in (
+            ("^reg/(.+)/(.+)/(.+)$", "https://fallback.example.com/{1}/{2}/{3}"),
+            ("^vocab/v(\\d+)/(.+)", "https://vocabs.example.com/{1}/{2}"),
+        ):
+            lines.append(f"{_toml_str(pattern)} = {{ to={_toml_str(to)}, kind=\"regex\" }}")
+        cond_paths = []
+        for i in range(n_cond):
+            path = f"cond/c{i}"
+            cond_paths.append(path)
+            lines.append(f"\"_c{i}_html\" = {{ from={_toml_str(path)}, to=\"https://web.example.com/c{i}\", condition={{mediatype=\"html\"}} }}")
+            lines.append(f"\"_c{i}_not_html\" = {{ from={_toml_str(path)}, to=\"https://api.example.com/c{i}\", condition={{not={{mediatype=\"html\"}}}} }}")
+        lines += [
+            "",
+            f"[dests.prez{h}]",
+            'kind = "prez_v3"',
+            'api_endpoint = "https://api.example.com/prez/"',
+            'web_endpoint = "https://web.example.com/"',
+            f"[dests.prez{h}.prefixes]",
+            f"v = {_toml_str(f'https://{host}/vocab/')}",
+            "",
+        ]
+        (out / f"synthetic_{h:03d}.toml").write_text("\n".join(lines), encoding="utf-8")
+        paths[host] = {"static": static_paths, "dest": dest_paths, "regex": regex_paths, "conditional": cond_paths}
+    return paths
+
+
+def generate_workload(paths: Dict[str, dict], n_requests: int, seed: int = 0) -> List[Tuple[str, str, str]]:
+    """A list of ``(host, path, accept)`` requests, mixing all kinds of rules, misses, and Accept headers."""
+    rnd = random.Random(seed)
+    accepts = [a for (a, _) in ACCEPT_MIX]
+    accept_weights = [w for (_, w) in ACCEPT_MIX]
+    kinds = ["static", "dest", "regex", "conditional"]
+    hosts = sorted(paths.keys())
+    workload = []
+    for _ in range(n_requests):
+        host = rnd.choice(hosts)
+        accept = rnd.choices(accepts, accept_weights)[0]
+        if rnd.random() < MISS_SHARE:
+            path = f"missing/m{rnd.randrange(1000000)}"
+        else:
+            candidates = [k for k in kinds if paths[host][k]]
+            kind = rnd.choice(candidates)
+            path = rnd.choice(paths[host][kind])
+        workload.append((host, path, accept))
+    return workload
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("out_dir")
+    parser.add_argument("--rules", type=int, default=10000)
+    parser.add_argument("--hosts", type=int, default=4)
+    args = parser.parse_args()
+    paths = generate_configs(args.out_dir, args.rules, args.hosts)
+    counts = {host: {k: len(v) for k, v in kinds.items()} for host, kinds in paths.items()}
+    print(json.dumps(counts, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -3,6 +3,10 @@ import logging
 import os
 from pathlib import Path
 
+# Set STARTUP_PROFILE=true to log import times and time to app ready for the cold start
+import startup_profile
+startup_profile.enable_if_configured()
+
 #------- Fix up Logging to Application Logger -------
 SYSTEM_LOG_PREFIX = "azure_functions_worker"
 SYSTEM_ERROR_LOG_PREFIX = "azure_functions_worker_errors"
@@ -91,9 +95,16 @@ else:
     # Strip off the trailing slash, if present
     ROOT_PATH = ROOT_PATH.rstrip("/")
 
-starlette_app = create_app(root_path=ROOT_PATH, router_only=True)
-
-app = AsgiFunctionApp(app=starlette_app, http_auth_level=auth_level)
+if settings["FUNCTION_APP_HANDLER"].strip().lower() == "native":
+    # Skip the ASGI translation layer, see NativeRedirectFunctionApp
+    from patched_azure_function_app import NativeRedirectFunctionApp
+    redirect_app = create_app(root_path=ROOT_PATH, fast=True)
+    app = NativeRedirectFunctionApp(redirect_app=redirect_app, http_auth_level=auth_level)
+else:
+    starlette_app = create_app(root_path=ROOT_PATH, router_only=True)
+    app = AsgiFunctionApp(app=starlette_app, http_auth_level=auth_level)
+startup_profile.report_imports(system_error_logger)
+startup_profile.mark(system_error_logger, "Function app created")
 
 if __name__ == "__main__":
     import asyncio
@@ -1,11 +1,18 @@
-from typing import Union, TYPE_CHECKING
+import asyncio
+import json
+from typing import Optional, Tuple, Union, TYPE_CHECKING
 from copy import copy
+from logging import getLogger
+from urllib.parse import unquote_to_bytes, urlsplit
 import azure.functions as func
 from azure.functions.decorators.http import HttpMethod
 from azure.functions._http_asgi import AsgiMiddleware, AsgiRequest, AsgiResponse
-from azure.functions._http_wsgi import WsgiMiddleware
 from azure.functions._abc import Context
 from azure.functions import HttpRequest
+import startup_profile
+if TYPE_CHECKING:
+    from azure.functions._http_wsgi import WsgiMiddleware
+    from src.routers.iri_redirect_fast import FastRedirectApp
 
 # -------------------
 # Create a patched AsgiFunctionApp to fix the ASGI scope state issue
@@ -35,18 +42,21 @@ class AsgiFunctionApp(func.AsgiFunctionApp):
         self.startup_task_done = False
 
     def _add_http_app(
-            self, http_middleware: Union[AsgiMiddleware, WsgiMiddleware]
+            self, http_middleware: Union[AsgiMiddleware, "WsgiMiddleware"],
+            function_name: str = "http_app_func",
     ) -> None:
         """Add an Asgi app integrated http function.
 
         :param http_middleware: :class:`WsgiMiddleware`
                                 or class:`AsgiMiddleware` instance.
+        :param function_name: The name of the registered function.
 
         :return: None
         """
 
         asgi_middleware: AsgiMiddleware = http_middleware
 
+        @self.function_name(name=function_name)
         @self.http_type(http_type="asgi")
         @self.route(
             methods=(method for method in HttpMethod),
@@ -59,5 +69,107 @@ class AsgiFunctionApp(func.AsgiFunctionApp):
                 if not success:
                     raise RuntimeError("ASGI middleware startup failed.")
                 self.startup_task_done = True
+                startup_profile.mark(getLogger(), "App ready")
 
             return await asgi_middleware.handle_async(req, context)
+
+
+# -------------------
+# Native function handler, that serves the redirects without the ASGI translation layer
+# -------------------
+def respond_func_batch(redirect_app: "FastRedirectApp", scheme: str, req: HttpRequest):
+    """
+    The response to a ``POST /redir/batch`` request. A Functions HttpResponse can't be
+    streamed, so all the NDJSON result lines are sent in one body.
+    """
+    from src.cors import TEXT_PLAIN, simple_headers
+    from src.routers.iri_batch import NDJSON_CONTENT_TYPE, BatchError, parse_batch, resolve_batch
+    from src.routers.iri_redirect_fast import RawHeaders, text_response
+    headers = RawHeaders.from_mapping(req.headers)
+    extra_headers = simple_headers(headers) if "origin" in headers else []
+    try:
+        items = parse_batch(req.get_body(), headers.get("content-type", None))
+    except BatchError as e:
+        return text_response(e.status_code, str(e).encode("utf-8"), TEXT_PLAIN, extra_headers)
+    results = resolve_batch(items, scheme, headers.get("host", None), redirect_app.state)
+    body = "".join(json.dumps(result, ensure_ascii=False) + "\n" for result in results).encode("utf-8")
+    return 200, [(b"content-type", NDJSON_CONTENT_TYPE.encode("latin-1"))] + extra_headers, body
+
+
+def split_content_type(content_type: Optional[str]) -> Tuple[Optional[str], Optional[str]]:
+    """The (mimetype, charset) of a Content-Type header value, each None if it isn't given."""
+    if not content_type:
+        return None, None
+    (mimetype, *params) = content_type.split(";")
+    charset = None
+    for param in params:
+        (name, _, value) = param.partition("=")
+        if name.strip().lower() == "charset":
+            charset = value.strip().strip('"') or None
+            break
+    return mimetype.strip() or None, charset
+
+
+def handle_func_request(redirect_app: "FastRedirectApp", req: HttpRequest) -> func.HttpResponse:
+    """
+    Serve a Functions HttpRequest with a FastRedirectApp, giving the same response as
+    the ASGI path through MyAsgiMiddleware, AsgiRequest and AsgiResponse would.
+    The headers, Content-Type included, are passed on as they are. The mimetype and charset
+    are taken from the Content-Type (AsgiResponse takes the charset from Content-Encoding).
+    """
+    from src.routers.iri_batch import BATCH_ROUTE
+    from src.routers.iri_redirect_fast import RawHeaders
+    url = urlsplit(req.url)
+    # AsgiRequest gives the ASGI app the decoded path
+    path = redirect_app.route_path(unquote_to_bytes(url.path).decode("utf-8"))
+    if req.method == "POST" and path == BATCH_ROUTE:
+        (status_code, raw_headers, body) = respond_func_batch(redirect_app, url.scheme, req)
+    else:
+        (status_code, raw_headers, body) = redirect_app.respond(
+            req.method, url.scheme, path, dict(req.params), RawHeaders.from_mapping(req.headers),
+        )
+    headers = {k.decode("latin-1"): v.decode("latin-1") for k, v in raw_headers}
+    (mimetype, charset) = split_content_type(headers.get("content-type", None))
+    return func.HttpResponse(
+        body=body,
+        status_code=status_code,
+        headers=headers,
+        mimetype=mimetype,
+        charset=charset,
+    )
+
+
+class NativeRedirectFunctionApp(func.FunctionApp):
+    """
+    A Function App with a single catch-all HTTP function, that calls the redirect resolver
+    directly with the HttpRequest and returns an HttpResponse. Selected with the
+    FUNCTION_APP_HANDLER=native setting, AsgiFunctionApp is the default.
+    """
+    def __init__(self, redirect_app: "FastRedirectApp", http_auth_level):
+        super(NativeRedirectFunctionApp, self).__init__(http_auth_level=http_auth_level)
+        self.redirect_app = redirect_app
+        self.startup_task_done = False
+        self._startup_lock: Optional[asyncio.Lock] = None
+        self._add_redirect_function()
+
+    async def startup(self):
+        if self._startup_lock is None:
+            self._startup_lock = asyncio.Lock()
+        async with self._startup_lock:
+            if not self.startup_task_done:
+                await self.redirect_app.startup()
+                self.startup_task_done = True
+                startup_profile.mark(getLogger(), "App ready")
+
+    def _add_redirect_function(self) -> None:
+        redirect_app = self.redirect_app
+
+        @self.route(
+            methods=(method for method in HttpMethod),
+            auth_level=self.auth_level,
+            route="{*route}",
+        )
+        async def http_app_func(req: HttpRequest, context: Context) -> func.HttpResponse:
+            if not self.startup_task_done:
+                await self.startup()
+            return handle_func_request(redirect_app, req)
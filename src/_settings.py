@@ -18,21 +18,59 @@ module = sys.modules[__name__]
 defaults = module.defaults = {
     "SERVER_NAME": "localhost",
     "FUNCTION_APP_AUTH_LEVEL": "FUNCTION",
+    "FUNCTION_APP_HANDLER": "asgi",
     "CONFIG_DEFS_DIRECTORY": "./configs",
     "APP_BASE_ROUTE": "/",
     "DEBUG_APP": "false",
     "WATCH_CONFIGS": "false",
     "WATCH_CONFIGS_INTERVAL": "300",
+    "REGEX_ENGINE": "loop",
+    "REGEX_LOWERING": "true",
+    "REDIR_CACHE_SIZE": "4096",
+    "REDIR_CACHE_TTL": "0",
+    "REDIR_TIMING": "false",
+    "REDIR_METRICS": "false",
+    "METRICS_ROUTE": "/_admin/metrics",
+    "REDIR_BATCH_MAX_ITEMS": "100000",
+    "ACCESS_LOG": "false",
+    "ACCESS_LOG_FILE": "",
+    "ACCESS_LOG_SAMPLE": "1.0",
+    "ACCESS_LOG_BATCH": "100",
+    "ACCESS_LOG_FLUSH_INTERVAL": "1.0",
+    "CONFIG_BLOB_CONTAINER": "",
+    "CONFIG_BLOB_PREFIX": "",
+    "CONFIG_BLOB_ACCOUNT_URL": "",
+    "CONFIG_BLOB_CONNECTION_STRING": "",
+    "CONFIG_SNAPSHOT_FILE": "./configs/.compiled_defs.pickle",
 }
 settings = module.settings = dict()
 
 settings['SERVER_NAME'] = getenv("SERVER_NAME", None)
 settings['FUNCTION_APP_AUTH_LEVEL'] = getenv("FUNCTION_APP_AUTH_LEVEL", None)
+settings['FUNCTION_APP_HANDLER'] = getenv("FUNCTION_APP_HANDLER", None)
 settings['CONFIG_DEFS_DIRECTORY'] = getenv("CONFIG_DEFS_DIRECTORY", None)
 settings['APP_BASE_ROUTE'] = getenv("APP_BASE_ROUTE", None)
 settings['DEBUG_APP'] = getenv("DEBUG_APP", None)
 settings['WATCH_CONFIGS'] = getenv("WATCH_CONFIGS", None)
 settings['WATCH_CONFIGS_INTERVAL'] = getenv("WATCH_CONFIGS_INTERVAL", None)
+settings['REGEX_ENGINE'] = getenv("REGEX_ENGINE", None)
+settings['REGEX_LOWERING'] = getenv("REGEX_LOWERING", None)
+settings['REDIR_CACHE_SIZE'] = getenv("REDIR_CACHE_SIZE", None)
+settings['REDIR_CACHE_TTL'] = getenv("REDIR_CACHE_TTL", None)
+settings['REDIR_TIMING'] = getenv("REDIR_TIMING", None)
+settings['REDIR_METRICS'] = getenv("REDIR_METRICS", None)
+settings['METRICS_ROUTE'] = getenv("METRICS_ROUTE", None)
+settings['REDIR_BATCH_MAX_ITEMS'] = getenv("REDIR_BATCH_MAX_ITEMS", None)
+settings['ACCESS_LOG'] = getenv("ACCESS_LOG", None)
+settings['ACCESS_LOG_FILE'] = getenv("ACCESS_LOG_FILE", None)
+settings['ACCESS_LOG_SAMPLE'] = getenv("ACCESS_LOG_SAMPLE", None)
+settings['ACCESS_LOG_BATCH'] = getenv("ACCESS_LOG_BATCH", None)
+settings['ACCESS_LOG_FLUSH_INTERVAL'] = getenv("ACCESS_LOG_FLUSH_INTERVAL", None)
+settings['CONFIG_BLOB_CONTAINER'] = getenv("CONFIG_BLOB_CONTAINER", None)
+settings['CONFIG_BLOB_PREFIX'] = getenv("CONFIG_BLOB_PREFIX", None)
+settings['CONFIG_BLOB_ACCOUNT_URL'] = getenv("CONFIG_BLOB_ACCOUNT_URL", None)
+settings['CONFIG_BLOB_CONNECTION_STRING'] = getenv("CONFIG_BLOB_CONNECTION_STRING", None)
+settings['CONFIG_SNAPSHOT_FILE'] = getenv("CONFIG_SNAPSHOT_FILE", None)
 
 # Apply default values for options that are not defined in ENVs
 for k, v in defaults.items():
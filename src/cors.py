@@ -0,0 +1,100 @@
+"""
+Static CORS handling for the redirect app.
+
+The CORS policy is fixed (any origin, any method, any header, expose all headers, with
+credentials), so the response headers are precomputed here once. StaticCORSMiddleware adds them
+to every response of a request with an Origin header, and answers preflight requests itself,
+without calling the app. The responses are the same as Starlette's CORSMiddleware gives for
+allow_origins=["*"], allow_credentials=True, allow_methods=["*"], allow_headers=["*"], expose_headers=["*"].
+"""
+from typing import Callable, Dict, List, Tuple
+
+ALL_METHODS = ("DELETE", "GET", "HEAD", "OPTIONS", "PATCH", "POST", "PUT")
+# Added to the response of every non-preflight request that has an Origin header
+SIMPLE_HEADERS: List[Tuple[bytes, bytes]] = [
+    (b"access-control-allow-origin", b"*"),
+    (b"access-control-allow-credentials", b"true"),
+    (b"access-control-expose-headers", b"*"),
+]
+PREFLIGHT_HEADERS: List[Tuple[bytes, bytes]] = [
+    (b"vary", b"Origin"),
+    (b"access-control-allow-methods", ", ".join(ALL_METHODS).encode("latin-1")),
+    (b"access-control-max-age", b"600"),
+    (b"access-control-allow-credentials", b"true"),
+]
+TEXT_PLAIN = b"text/plain; charset=utf-8"
+# The request headers the CORS policy looks at
+CORS_REQUEST_HEADERS = frozenset((
+    b"origin", b"cookie", b"access-control-request-method",
+    b"access-control-request-headers", b"access-control-request-private-network",
+))
+
+
+def is_preflight(method: str, headers) -> bool:
+    """``headers`` is anything with ``get()`` and ``in`` by lowercase header name."""
+    return method == "OPTIONS" and "origin" in headers and "access-control-request-method" in headers
+
+
+def preflight_response(headers) -> Tuple[int, List[Tuple[bytes, bytes]], bytes]:
+    """The (status code, headers, body) response to a preflight request."""
+    response_headers = list(PREFLIGHT_HEADERS)
+    response_headers.append((b"access-control-allow-origin", headers.get("origin").encode("latin-1")))
+    failures = []
+    if headers.get("access-control-request-method") not in ALL_METHODS:
+        failures.append("method")
+    requested_headers = headers.get("access-control-request-headers")
+    if requested_headers is not None:
+        # All headers are allowed, so the requested headers are mirrored back
+        response_headers.append((b"access-control-allow-headers", requested_headers.encode("latin-1")))
+    if "access-control-request-private-network" in headers:
+        failures.append("private-network")
+    body = ("Disallowed CORS " + ", ".join(failures)).encode("utf-8") if failures else b"OK"
+    response_headers.append((b"content-length", str(len(body)).encode("latin-1")))
+    response_headers.append((b"content-type", TEXT_PLAIN))
+    return (400 if failures else 200), response_headers, body
+
+
+def simple_headers(headers) -> List[Tuple[bytes, bytes]]:
+    """The CORS headers to add to the response of a request with an Origin header."""
+    if "cookie" in headers:
+        # With credentials, the specific origin must be given instead of '*'
+        return [
+            (b"access-control-allow-origin", headers.get("origin").encode("latin-1")),
+            (b"access-control-allow-credentials", b"true"),
+            (b"access-control-expose-headers", b"*"),
+            (b"vary", b"Origin"),
+        ]
+    return SIMPLE_HEADERS
+
+
+class StaticCORSMiddleware:
+    """ASGI middleware applying the static CORS policy, in place of Starlette's CORSMiddleware."""
+
+    def __init__(self, app: Callable):
+        self.app = app
+
+    async def __call__(self, scope: dict, receive: Callable, send: Callable):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        cors_headers: Dict[str, str] = {}
+        for (k, v) in scope["headers"]:
+            k = k.lower()
+            if k in CORS_REQUEST_HEADERS:
+                cors_headers.setdefault(k.decode("latin-1"), v.decode("latin-1"))
+        if "origin" not in cors_headers:
+            await self.app(scope, receive, send)
+            return
+        if is_preflight(scope["method"], cors_headers):
+            (status_code, headers, body) = preflight_response(cors_headers)
+            await send({"type": "http.response.start", "status": status_code, "headers": headers})
+            await send({"type": "http.response.body", "body": body})
+            return
+        extra_headers = simple_headers(cors_headers)
+
+        async def send_with_cors(message: dict):
+            if message["type"] == "http.response.start":
+                message["headers"] = list(message.get("headers", ())) + extra_headers
+            await send(message)
+
+        await self.app(scope, receive, send_with_cors)
@@ -1,37 +1,39 @@
 """
 Implements the factory pattern for creating the Starlette app
 """
-from contextlib import asynccontextmanager
+from contextlib import asynccontextmanager, AsyncExitStack
 from functools import partial
-from typing import Optional, List
+from typing import List
 
 from starlette.middleware import Middleware
-from starlette.middleware.cors import CORSMiddleware
-from starlette.routing import Route, Mount, Router
+from starlette.routing import Mount, Router
 from starlette.applications import Starlette
 from ._settings import settings
-from .routers import make_all_iri_redirect_routes
+from .cors import StaticCORSMiddleware
+from .routers import FastRedirectApp, make_all_iri_redirect_routes, make_batch_routes
 
 async def multi_lifespan(lifespan_contexts: List, app):
     state = {}
-    try:
+    # Keep every lifespan context entered while the app is serving,
+    # so their background tasks keep running and their cleanup runs at shutdown
+    async with AsyncExitStack() as stack:
         for lifespan_context in lifespan_contexts:
-            async with lifespan_context(app) as maybe_state:
-                if maybe_state is not None:
-                    state.update(maybe_state)
+            maybe_state = await stack.enter_async_context(lifespan_context(app))
+            if maybe_state is not None:
+                state.update(maybe_state)
         yield state
-    finally:
-        # cleanup
-        pass
 
 def create_app(
     *,  # All parameters are keyword-only
     root_path: str = "",
     # if True, we don't return a Starlette app, only an ASGI Router
     router_only: bool = False,
+    # if True, we return a minimal pure-ASGI app that serves the same redirects, see routers/iri_redirect_fast.py
+    fast: bool = False,
     **kwargs
 ):
-    route_makers = [make_all_iri_redirect_routes]
+    # The batch route must come before the catch-all redirect route
+    route_makers = [make_batch_routes, make_all_iri_redirect_routes]
 
     routes = []
     lifespan_contexts = []
@@ -48,14 +50,10 @@ def create_app(
         lifespan = asynccontextmanager(lifespan_fn)
     else:
         lifespan = None
-    middlewares = [Middleware(
-        CORSMiddleware,
-        allow_origins=["*"],
-        allow_credentials=True,
-        allow_methods=["*"],
-        allow_headers=["*"],
-        expose_headers=["*"],
-    )]
+    if fast:
+        return FastRedirectApp(lifespan=lifespan, root_path=root_path, debug=settings["DEBUG_APP"])
+    # Allows any origin, method and header, and exposes all headers, see cors.py
+    middlewares = [Middleware(StaticCORSMiddleware)]
 
     if root_path is not None and not (root_path is "" or root_path is "/"):
         routes = [Mount(root_path, None, routes, "root")]
@@ -1,15 +1,38 @@
-from typing import Optional, List, Tuple, Mapping
+from functools import lru_cache
+from typing import Optional, Tuple, Mapping
 
-from starlette.datastructures import Headers
+from .iri_headers import RawHeaders
 
+# Real clients send very few distinct Accept strings, so the parsed results are
+# memoised on the raw header values and query params they are parsed from.
+# Results are tuples, so a cached result can't be modified by a caller.
+CONNEG_CACHE_SIZE = 1024
 
-def profile_extract(r_headers: Headers, r_query: Mapping[str, str]) -> List[Tuple[float, str]]:
+QList = Tuple[Tuple[float, str], ...]
+
+
+def profile_extract(r_headers: RawHeaders, r_query: Mapping[str, str]) -> QList:
+    return parse_profiles(
+        r_headers.accept_profile,
+        r_headers.link,
+        r_headers.prefer,
+        r_query.get("_profile", None),
+        r_query.get("_view", None),
+    )
+
+@lru_cache(maxsize=CONNEG_CACHE_SIZE)
+def parse_profiles(
+    accept_profiles_list: Tuple[str, ...],
+    link_list: Tuple[str, ...],
+    prefer_list: Tuple[str, ...],
+    q_profile: Optional[str],
+    q_view: Optional[str],
+) -> QList:
     # QSA takes precedence over Accept-Profile header
-    if "_profile" in r_query:
-        return [(1.0,r_query['_profile'])]
+    if q_profile is not None:
+        return ((1.0, q_profile),)
     ret_list = []
     # Accept-profile disables lookup of "Link" and "Prefer"
-    accept_profiles_list = r_headers.getlist("accept-profile")
     if len(accept_profiles_list) > 0:
         all_accept_profile = []
         _ = [all_accept_profile.extend((a.strip() for a in ap.split(','))) for ap in accept_profiles_list]
@@ -26,7 +49,6 @@ def profile_extract(r_headers: Headers, r_query: Mapping[str, str]) -> List[Tupl
                     break
             ret_list.append((q, profile))
     if len(ret_list) < 1:
-        link_list = r_headers.getlist("link")
         if len(link_list) > 1:
             all_link_list = []
             _ = [all_link_list.extend((l.strip() for l in ll.split(','))) for ll in link_list]
@@ -42,7 +64,6 @@ def profile_extract(r_headers: Headers, r_query: Mapping[str, str]) -> List[Tupl
                 if is_rel_profile:
                     ret_list.append((1.0, href.strip("<>\"'")))
     if len(ret_list) < 1:
-        prefer_list = r_headers.getlist("prefer")
         if len(prefer_list) > 0:
             all_prefer_list = []
             _ = [all_prefer_list.extend((p.strip() for p in pl.split(','))) for pl in prefer_list]
@@ -58,10 +79,10 @@ def profile_extract(r_headers: Headers, r_query: Mapping[str, str]) -> List[Tupl
                             pass
                         else:
                             break
-    if len(ret_list) < 1 and "_view" in r_query:
+    if len(ret_list) < 1 and q_view is not None:
         # View is an old LDAPI form of "_profile"
-        return [(1.0,r_query['_view'])]
-    return sorted(ret_list, reverse=True)
+        return ((1.0, q_view),)
+    return tuple(sorted(ret_list, reverse=True))
 
 EXT_TO_MEDIATYPE = {
     "ttl": "text/turtle",
@@ -72,14 +93,31 @@ EXT_TO_MEDIATYPE = {
 }
 
 
-def mediatype_extract(r_headers: Headers, r_query: Mapping[str, str], f_ext: Optional[str]) -> List[Tuple[float, str]]:
+def mediatype_extract(r_headers: RawHeaders, r_query: Mapping[str, str], f_ext: Optional[str]) -> QList:
+    return parse_mediatypes(
+        r_headers.accept,
+        r_headers.prefer,
+        r_query.get("_mediatype", None),
+        r_query.get("_format", None),
+        f_ext,
+    )
+
+@lru_cache(maxsize=CONNEG_CACHE_SIZE)
+def parse_mediatypes(
+    accept_content_list: Tuple[str, ...],
+    prefer_list: Tuple[str, ...],
+    q_mediatype: Optional[str],
+    q_format: Optional[str],
+    f_ext: Optional[str],
+) -> QList:
     # QSA takes precedence over Accept header
-    if "_mediatype" in r_query:
-        return [(1.0,r_query['_mediatype'])]
+    if q_mediatype is not None:
+        return ((1.0, q_mediatype),)
     ret_list = []
     # Accept header disables lookup of "Prefer"
-    accept_content_list = r_headers.getlist("accept")
-    has_wildcard: Optional[str] = None
+    # Wildcard ranges are kept, with their q-values, for the negotiation in MediaNegotiation.
+    # An Accept header with only wildcards still lets _format and the extension choose.
+    wildcards = []
     if len(accept_content_list) > 0:
         all_accept_content = []
         _ = [all_accept_content.extend((a.strip() for a in ac.split(','))) for ac in accept_content_list]
@@ -95,12 +133,13 @@ def mediatype_extract(r_headers: Headers, r_query: Mapping[str, str], f_ext: Opt
                     except ValueError:
                         q = 0.0
                     break
-            if profile == "*/*" or profile == "*" and q == 1.0:
-                has_wildcard = profile
+            if profile == "*/*" or profile == "*":
+                wildcards.append((q, "*/*"))
             else:
                 ret_list.append((q, profile))
+    if len(ret_list) > 0:
+        return tuple(sorted(ret_list + wildcards, reverse=True))
     if len(ret_list) < 1:
-        prefer_list = r_headers.getlist("prefer")
         if len(prefer_list) > 0:
             all_prefer_list = []
             _ = [all_prefer_list.extend((p.strip() for p in pl.split(','))) for pl in prefer_list]
@@ -116,12 +155,127 @@ def mediatype_extract(r_headers: Headers, r_query: Mapping[str, str], f_ext: Opt
                             pass
                         else:
                             break
-    if len(ret_list) < 1 and "_format" in r_query:
+    if len(ret_list) < 1 and q_format is not None:
         # _format is an old version of "_mediatype"
-        return [(1.0,r_query['_format'])]
+        return ((1.0, q_format),)
     elif len(ret_list) < 1 and f_ext is not None:
         if f_ext in EXT_TO_MEDIATYPE:
-            return [(1.0, EXT_TO_MEDIATYPE[f_ext])]
-    elif len(ret_list) < 1 and has_wildcard is not None:
-        return [(1.0, has_wildcard)]
-    return sorted(ret_list, reverse=True)
\ No newline at end of file
+            return ((1.0, EXT_TO_MEDIATYPE[f_ext]),)
+    elif len(ret_list) < 1 and len(wildcards) > 0:
+        return tuple(sorted(wildcards, reverse=True))
+    return tuple(sorted(ret_list, reverse=True))
+
+
+HTML_MEDIATYPES = ("text/html", "application/xhtml+xml")
+RDF_MEDIATYPES = ("text/turtle", "application/rdf+xml", "application/ld+json", "application/json")
+
+# Short names that can be used in place of a full mediatype in a conditional rule
+MEDIATYPE_EXPANDS = {
+    "html": "text/html",
+    "xhtml": "application/xhtml+xml",
+    "xml": "application/xml",
+    "rdf": "application/rdf+xml",
+    "ttl": "text/turtle",
+    "turtle": "text/turtle",
+    "n3": "text/n3",
+    "nt": "text/n3",
+    "jsonld": "application/ld+json",
+    "json-ld": "application/ld+json",
+    "json": "application/json",
+}
+
+# The mediatypes the dests know how to serve, in server preference order. When the client
+# rates several of them equally, the first one wins. RDF comes first, so a client that sends
+# only */* (or no Accept header at all) is sent to the API rather than to the web frontend.
+SERVER_MEDIATYPES = tuple(dict.fromkeys(RDF_MEDIATYPES + HTML_MEDIATYPES + tuple(MEDIATYPE_EXPANDS.values())))
+SERVER_MEDIATYPE_SET = frozenset(SERVER_MEDIATYPES)
+MEDIA_CLASSES = {**{m: "rdf" for m in RDF_MEDIATYPES}, **{m: "html" for m in HTML_MEDIATYPES}}
+
+Rank = Tuple[float, int]
+NOT_ACCEPTABLE: Rank = (0.0, -1)
+
+
+def media_range_rank(mediatypes: QList, mt: str) -> Rank:
+    """
+    How the client rates a (lowercase) mediatype: the q-value of the most specific media range
+    that matches it, and that range's specificity (2 exact, 1 type/*, 0 */*).
+    Returns NOT_ACCEPTABLE if no range matches, or the matching range has q=0.
+    An empty list means the client accepts anything.
+    """
+    if len(mediatypes) < 1:
+        return (1.0, 0)
+    type_range = mt.split("/", 1)[0] + "/*"
+    rank = NOT_ACCEPTABLE
+    for (q, media_range) in mediatypes:
+        media_range = media_range.lower()
+        if media_range == mt:
+            # The list is sorted by q-value, so the first exact match is the one that counts
+            rank = (q, 2)
+            break
+        elif media_range == type_range:
+            specificity = 1
+        elif media_range == "*/*":
+            specificity = 0
+        else:
+            continue
+        if specificity > rank[1]:
+            rank = (q, specificity)
+    return rank if rank[0] > 0 else NOT_ACCEPTABLE
+
+
+class MediaNegotiation:
+    """
+    The result of negotiating a request's mediatypes against SERVER_MEDIATYPES.
+    Worked out once per distinct mediatype list, and shared by the conditional rules and the dests.
+
+    ``best`` is the client's best match (highest q-value, then most specific range, then server
+    preference), or None if the client accepts none of them. ``media_class`` is "html" or "rdf",
+    the class of the best match among HTML_MEDIATYPES and RDF_MEDIATYPES, or None.
+
+    ``preferred`` is the best match that the conditional rules see. It is None when the client
+    has ``no_preference``, that is no Accept header or only ``*/*`` ranges, so a ``mediatype``
+    condition only holds for a mediatype the client asked for, and ``best`` is only the server's
+    pick for the dests.
+    """
+    __slots__ = ("mediatypes", "best", "rank", "media_class", "no_preference", "preferred")
+
+    def __init__(self, mediatypes: QList):
+        self.mediatypes = mediatypes
+        best: Optional[str] = None
+        rank = NOT_ACCEPTABLE
+        best_classed: Optional[str] = None
+        classed_rank = NOT_ACCEPTABLE
+        for mt in SERVER_MEDIATYPES:
+            mt_rank = media_range_rank(mediatypes, mt)
+            if mt_rank > rank:
+                best, rank = mt, mt_rank
+            if mt_rank > classed_rank and mt in MEDIA_CLASSES:
+                best_classed, classed_rank = mt, mt_rank
+        self.best = best
+        self.rank = rank
+        self.media_class = None if best_classed is None else MEDIA_CLASSES[best_classed]
+        self.no_preference = all(media_range == "*/*" for (q, media_range) in mediatypes)
+        self.preferred = None if self.no_preference else best
+
+    def accepts(self, mt: str) -> bool:
+        """
+        Whether ``mt`` (a mediatype, or a short name like "html") is the one the client wants.
+        A mediatype the server doesn't know about matches if the client rates it above ``best``.
+        Nothing matches when the client has no preference.
+        """
+        mt = MEDIATYPE_EXPANDS.get(mt, mt).lower()
+        if self.no_preference:
+            return False
+        elif mt == self.best:
+            return True
+        elif mt in SERVER_MEDIATYPE_SET:
+            return False
+        return media_range_rank(self.mediatypes, mt) > self.rank
+
+    def __repr__(self):
+        return f"MediaNegotiation(best={self.best!r}, preferred={self.preferred!r}, media_class={self.media_class!r})"
+
+
+@lru_cache(maxsize=CONNEG_CACHE_SIZE)
+def negotiate_mediatypes(mediatypes: QList) -> MediaNegotiation:
+    return MediaNegotiation(mediatypes)
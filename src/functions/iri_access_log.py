@@ -0,0 +1,155 @@
+"""
+Structured access log of the resolved redirects.
+
+When ACCESS_LOG is on, the lifespan state holds an AccessLog, and resolve_redir records each
+request in it (or a sample of them, with ACCESS_LOG_SAMPLE). Recording only puts a log record
+with the request's fields on a queue. A QueueListener thread turns the records into NDJSON
+lines and writes them to ACCESS_LOG_FILE (or stderr), in batches of ACCESS_LOG_BATCH lines.
+When requests are slow to come, a smaller batch is written once it is ACCESS_LOG_FLUSH_INTERVAL
+seconds since the last write, even if no more requests come, and the rest are written when the
+app shuts down:
+
+    {"ts": 1700000000.123, "host": "linked.data.gov.au", "path": "dataset/bdr", "virtualhost": "linked.data.gov.au",
+     "rule": "dataset/bdr", "status": 307, "location": "https://...", "duration_us": 41.2}
+
+``rule`` is the key of the rule that made the redirect, it is null for a miss.
+"""
+import json
+import logging
+import sys
+from logging.handlers import QueueHandler, QueueListener
+from queue import Empty, SimpleQueue
+from random import random
+from time import monotonic
+from typing import IO, List, Optional
+
+from .iri_rules import Rule
+
+# The logger name of the access log records
+ACCESS_LOGGER_NAME = "iri_redirect.access"
+
+
+class NDJSONBatchHandler(logging.Handler):
+    """
+    Writes access log records as NDJSON lines, in batches. Runs on the QueueListener thread.
+    A batch is written when it has ``batch_size`` lines, or ``flush_interval`` seconds after the
+    last write, and when the handler is flushed or closed. The listener calls flush_if_due()
+    when it has waited ``due_in()`` seconds for a record, so a batch isn't held back when no more come.
+    """
+
+    def __init__(self, stream: IO[str], batch_size: int = 100, flush_interval: float = 1.0, close_stream: bool = False):
+        super().__init__()
+        self.stream = stream
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.close_stream = close_stream
+        self.lines: List[str] = []
+        self.last_write = monotonic()
+
+    def emit(self, record: logging.LogRecord):
+        try:
+            (host, path, virtualhost, rule_key, status, location, ns) = record.access
+            self.lines.append(json.dumps({
+                "ts": round(record.created, 3),
+                "host": host,
+                "path": path,
+                "virtualhost": virtualhost,
+                "rule": rule_key,
+                "status": status,
+                "location": location,
+                "duration_us": round(ns / 1000, 1),
+            }, ensure_ascii=False))
+            if len(self.lines) >= self.batch_size or monotonic() - self.last_write >= self.flush_interval:
+                self.flush()
+        except Exception:
+            self.handleError(record)
+
+    def due_in(self) -> Optional[float]:
+        """Seconds until the lines waiting to be written are due, or None if there are none."""
+        if not self.lines:
+            return None
+        return max(self.flush_interval - (monotonic() - self.last_write), 0.0)
+
+    def flush_if_due(self):
+        if self.lines and monotonic() - self.last_write >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        self.acquire()
+        try:
+            if self.lines:
+                self.stream.write("\n".join(self.lines) + "\n")
+                self.stream.flush()
+                self.lines = []
+            self.last_write = monotonic()
+        finally:
+            self.release()
+
+    def close(self):
+        try:
+            self.flush()
+            if self.close_stream:
+                self.stream.close()
+        finally:
+            super().close()
+
+
+class _AccessQueueHandler(QueueHandler):
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # The record has no message to format, its fields are only read by NDJSONBatchHandler
+        return record
+
+
+class _AccessQueueListener(QueueListener):
+    def dequeue(self, block: bool) -> logging.LogRecord:
+        # Waits no longer than the handler's batch is due, and writes it when no record came in time
+        handler: NDJSONBatchHandler = self.handlers[0]
+        while True:
+            try:
+                return self.queue.get(block, handler.due_in())
+            except Empty:
+                if not block:
+                    raise
+                handler.flush_if_due()
+
+
+class AccessLog:
+    """
+    Puts access log records on a queue, through a QueueHandler, for a QueueListener thread to write.
+    The records are made directly, rather than through a Logger, so recording a request doesn't walk the stack.
+    """
+    __slots__ = ("sample_rate", "_queue_handler", "_listener", "_handler")
+
+    def __init__(self, handler: NDJSONBatchHandler, sample_rate: float = 1.0):
+        self.sample_rate = sample_rate
+        queue: SimpleQueue = SimpleQueue()
+        self._handler = handler
+        self._queue_handler = _AccessQueueHandler(queue)
+        self._listener = _AccessQueueListener(queue, handler)
+
+    def start(self):
+        self._listener.start()
+
+    def stop(self):
+        """Write out the queued records, and stop the listener thread."""
+        self._listener.stop()
+        self._handler.close()
+
+    def record(self, host: Optional[str], path: str, virtualhost: str, rule: Optional[Rule], status: int, location: Optional[str], ns: int):
+        sample_rate = self.sample_rate
+        if sample_rate < 1.0 and random() >= sample_rate:
+            return
+        record = logging.LogRecord(ACCESS_LOGGER_NAME, logging.INFO, __file__, 0, "access", None, None)
+        record.access = (host, path, virtualhost, None if rule is None else rule.key, status, location, ns)
+        self._queue_handler.handle(record)
+
+
+def make_access_log(file_name: str, sample_rate: float, batch_size: int, flush_interval: float) -> AccessLog:
+    """An AccessLog writing to the file, or to stdout for "-", or to stderr for an empty name."""
+    if not file_name:
+        handler = NDJSONBatchHandler(sys.stderr, batch_size, flush_interval)
+    elif file_name == "-":
+        handler = NDJSONBatchHandler(sys.stdout, batch_size, flush_interval)
+    else:
+        handler = NDJSONBatchHandler(open(file_name, "a", encoding="utf-8"), batch_size, flush_interval, close_stream=True)
+    return AccessLog(handler, min(max(sample_rate, 0.0), 1.0))
@@ -0,0 +1,78 @@
+"""
+Bounded cache of resolved redirects, in front of make_redir.
+
+The cache key is built from the resolved inputs of a redirect: the scheme, the candidate host
+list, the path, and the parsed mediatype and profile lists. Those lists are what the conditional
+rules and the dests read from the Accept, Accept-Profile, Link and Prefer headers, the
+_mediatype, _format, _profile and _view query params and the path's extension, so requests whose
+headers differ only in whitespace or the order of equal q-values share an entry. Other query
+params don't change the rule or the dest, so they aren't part of the key. For a qsa rule the
+cached Location is stored without them, and the request's query params are appended on each hit.
+
+A hit returns the stored status code and Location without running the rules again.
+The cache is cleared whenever the redirect definitions are reloaded.
+"""
+from logging import getLogger
+from typing import Any, Hashable, List, Optional, Tuple
+
+from cachetools import LRUCache, TTLCache
+
+from .connegp import QList
+
+logger = getLogger()  # Root logger
+
+
+def redir_cache_key(proto: str, host_list: List[str], path: str, mediatype: QList, profile: QList) -> Hashable:
+    return (proto, tuple(host_list), path, mediatype, profile)
+
+
+class RedirCache:
+    """
+    A size-bounded LRU cache (or LRU+TTL cache, when ``ttl`` is given) of
+    ``(status_code, location, virtualhost, rule)`` results, that counts its hits and misses.
+    The virtualhost and rule that made the redirect are kept for the metrics.
+    """
+
+    def __init__(self, maxsize: int, ttl: float = 0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._cache = TTLCache(maxsize, ttl) if ttl > 0 else LRUCache(maxsize)
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: Hashable) -> Optional[Tuple[int, str, str, Any]]:
+        try:
+            found = self._cache[key]
+        except KeyError:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return found
+
+    def put(self, key: Hashable, status_code: int, location: str, virtualhost: str = "", rule: Any = None):
+        self._cache[key] = (status_code, location, virtualhost, rule)
+
+    def clear(self):
+        logger.info(f"[REDIRS] Clearing redirect cache. {self.stats()}")
+        self._cache.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def stats(self) -> dict:
+        return {"size": len(self._cache), "maxsize": self.maxsize, "hits": self.hits, "misses": self.misses}
+
+    def __len__(self):
+        return len(self._cache)
+
+
+def make_redir_cache(maxsize, ttl) -> Optional[RedirCache]:
+    """Make a RedirCache from the REDIR_CACHE_SIZE and REDIR_CACHE_TTL settings. Size 0 disables the cache."""
+    try:
+        maxsize = int(maxsize)
+        ttl = float(ttl)
+    except (TypeError, ValueError):
+        logger.warning(f"[REDIRS] Bad redirect cache settings: size={maxsize}, ttl={ttl}. Cache disabled.")
+        return None
+    if maxsize < 1:
+        return None
+    return RedirCache(maxsize, ttl)
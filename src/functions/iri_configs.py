@@ -1,11 +1,18 @@
+import asyncio
 from functools import partial
-from pathlib import Path
 from logging import getLogger
-from tomli import load as load_toml
+from types import MappingProxyType
+from typing import Callable, Dict, List, Optional, Tuple
 import regex
 
 from .. import settings
-from .iri_dests import dest_kind_map
+from .iri_cache import RedirCache
+from .iri_dests import dest_kind_map, dest_rule_params_map, dest_setup_map
+from .iri_sources import DefFiles, DefsSource, make_defs_source
+from .iri_hosts import HostIndex
+from .iri_rules import (
+    EMPTY_MAPPING, REGEX_ENGINES, RESERVED_DEST_KWARGS, RULE_KEYS, Condition, Rule, RuleSet, RuleSetBuilder, lowered_rules,
+)
 
 logger = getLogger()  # Root logger
 
@@ -21,59 +28,76 @@ def find_regex_startsmatch(re_string: str):
         startsmatch_string += c
     return startsmatch_string.lower()
 
-def load_all_defs(state: dict, force: bool = False):
-    try:
-        defs_ctx = state["defs"]
-    except LookupError:
-        state["defs"] = defs_ctx = {}
-    try:
-        dests_ctx = state["dests"]
-    except LookupError:
-        state["dests"] = dests_ctx = {}
-    logger.info("[REDIRS] Loading definition files.")
-    if len(defs_ctx) < 1:
-        defs_ctx[""] = {"redirects": {}, "rewrites": {}, "conditional_rewrites": {}, "conditional_redirects":{}, "_default_redir_code": 307}
-        defs_ctx["_file_mtimes"] = {}
-    defs_dir = Path(settings["CONFIG_DEFS_DIRECTORY"]).absolute()
-    logger.info("[REDIRS] Using definition directory: "+str(defs_dir))
-    if not defs_dir.exists():
-        raise RuntimeError(f"Directory {defs_dir} does not exist!")
-    if not defs_dir.is_dir():
-        raise RuntimeError(f"Directory {defs_dir} is not a directory!")
-    for conf_filename in defs_dir.glob("*.toml"):
-        conf_file = conf_filename.absolute()
-        try:
-            stats = conf_file.stat()
-            mtime = stats.st_mtime
-        except Exception:
-            logger.info("Cannot get file modification date. Ignoring.")
-            mtime = 1
+def _make_rule(key: str, pattern: str, entry: dict, *, is_regex: bool, default_redir_code: int, default_qsa: bool) -> Optional[Rule]:
+    compiled_regex = None
+    startsmatch_string = ""
+    if is_regex:
         try:
-            old_mtime = defs_ctx['_file_mtimes'][conf_file]
-        except LookupError:
-            old_mtime = 0
-        if not force and (mtime <= old_mtime):
-            logger.debug(f"[REDIRS] File not modified. {conf_file}")
-            continue
-        else:
-            defs_ctx['_file_mtimes'][conf_file] = mtime
+            compiled_regex = regex.compile(pattern, flags=regex.IGNORECASE)
+        except regex.error as e:
+            logger.warning(f"Cannot compile regex. Error:\n{str(e)}")
+            return None
+        startsmatch_string = find_regex_startsmatch(pattern)
+    params = {k: v for k, v in entry.items() if k not in RULE_KEYS and k not in RESERVED_DEST_KWARGS}
+    return Rule(
+        key,
+        pattern,
+        str(entry["to"]),
+        regex=compiled_regex,
+        startsmatch=startsmatch_string,
+        condition=Condition(entry["condition"]) if "condition" in entry else None,
+        code=int(entry.get("code", default_redir_code)),
+        qsa=bool(entry.get("qsa", default_qsa)),
+        append_route=bool(entry.get("append_route", False)),
+        params=MappingProxyType(params) if params else EMPTY_MAPPING,
+    )
 
-        try:
-            f = open(conf_file, "rb")
-        except Exception:
-            logger.error(f"[REDIRS] Cannot open {conf_file}!")
-            raise
+def _prepare_dest_rule(dest_defs: Dict[str, Tuple[str, dict]], rule: Rule) -> Rule:
+    """Do the static per-rule work of the dest the rule redirects to, if it has any."""
+    if not rule.to.startswith("!") or rule.to[1:] not in dest_defs:
+        return rule
+    (kind, desc) = dest_defs[rule.to[1:]]
+    rule_params_fn = dest_rule_params_map.get(kind, None)
+    if rule_params_fn is None:
+        return rule
+    params = rule_params_fn(desc, rule.params)
+    if params is rule.params:
+        return rule
+    return rule.with_params(MappingProxyType(dict(params)))
 
-        try:
-            this_def = load_toml(f)
-            logger.info(f"[REDIRS] Reading {conf_file}")
-        except Exception as e:
-            logger.error(f"[REDIRS] Cannot read or load {conf_file}.")
-            logger.exception(f"Error reading or loading {conf_file}:")
+def lowering_report(defs: Dict[str, RuleSet]) -> List[Tuple[str, str, str, str]]:
+    """
+    (virtualhost, "regex_rewrites" or "regex_redirects", rule key, "literal" or "prefix_split")
+    for each regex rule that the optimiser lowered. Host aliases are not repeated.
+    """
+    report = []
+    seen = set()
+    for virtualhost, rule_set in defs.items():
+        if id(rule_set) in seen:
             continue
-        finally:
-            f.close()
+        seen.add(id(rule_set))
+        for index_name in ("regex_rewrites", "regex_redirects"):
+            for (rule, lowered_to) in lowered_rules(getattr(rule_set, index_name)):
+                report.append((virtualhost, index_name, rule.key, lowered_to))
+    return report
 
+def compile_defs(all_defs: List[dict]) -> Tuple[Dict[str, RuleSet], Dict[str, Callable]]:
+    """
+    Compile parsed definition files into a host->RuleSet table and a name->dest table.
+    Rules from several files for the same virtualhost are merged, in the order given.
+    A dest name defined more than once is logged as an error, and the last definition is used.
+    """
+    regex_engine = str(settings["REGEX_ENGINE"]).strip().lower()
+    if regex_engine not in REGEX_ENGINES:
+        logger.warning(f"[REDIRS] Unknown REGEX_ENGINE \"{regex_engine}\", using \"loop\".")
+        regex_engine = "loop"
+    lower = str(settings["REGEX_LOWERING"]).strip().lower() in TRUTH_VALUES
+    builders: Dict[str, RuleSetBuilder] = {"": RuleSetBuilder("")}
+    aliases: Dict[str, str] = {}
+    dests_ctx: Dict[str, Callable] = {}
+    # dest name -> (kind, dest definition)
+    dest_defs: Dict[str, Tuple[str, dict]] = {}
+    for this_def in all_defs:
         default_redir_code = 307
         default_route_prefix = '/'
         default_allow_slash = False
@@ -100,25 +124,25 @@ def load_all_defs(state: dict, force: bool = False):
             virtualhost = ""
         else:
             logger.info(f"[REDIRS] Loading definitions for virtualhost: {virtualhost}")
-        if virtualhost in defs_ctx:
+        if virtualhost in aliases:
+            virtualhost = aliases[virtualhost]
+        if virtualhost in builders:
             logger.info("[REDIRS] Appending redirect rules to existing host rules.")
-            host_def = defs_ctx[virtualhost]
+            host_def = builders[virtualhost]
         else:
-            defs_ctx[virtualhost] = host_def = {"redirects": {}, "rewrites": {}, "conditional_redirects": {}, "conditional_rewrites": {}}
+            builders[virtualhost] = host_def = RuleSetBuilder(virtualhost)
 
         for alias in host_aliases:
-            if alias in defs_ctx:
-                if not defs_ctx[alias] is host_def:
+            if alias in builders or alias in aliases:
+                if aliases.get(alias, None) != virtualhost:
                     logger.error(f"[REDIRS] Host alias {alias} already exists for a different virtualhost!")
                 continue
-            defs_ctx[alias] = host_def
-        host_def['_default_redir_code'] = default_redir_code
-        host_def['_default_qsa'] = default_qsa
+            aliases[alias] = virtualhost
+        make_rule = partial(_make_rule, default_redir_code=default_redir_code, default_qsa=default_qsa)
 
         if 'redirects' in this_def:
-            has_regex = []
-            has_conditional_regex = []
             for k, v in this_def['redirects'].items():
+                rule_key = k
                 is_conditional = False
                 # redirect is just a string
                 if isinstance(v, (bytes, str)):
@@ -133,27 +157,20 @@ def load_all_defs(state: dict, force: bool = False):
                         is_conditional = True
                     if "from" in v:
                         k = v['from']
-                        if not is_conditional and k in host_def['redirects']:
+                        if not is_conditional and k in host_def.redirects:
                             raise RuntimeError(f"Non-Conditional redirect rule: {k} already exists.")
                 else:
                     raise RuntimeError(f"Bad redirect value for {k}")
                 kind = new_entry.get("kind", "simple")
-
-                if str(kind).lower() == "regex":
-                    try:
-                        new_entry['_regex'] = regex.compile(k, flags=regex.IGNORECASE)
-                    except regex.error as e:
-                        logger.warning(f"Cannot compile regex. Error:\n{str(e)}")
-                        continue
-                    startsmatch_string = find_regex_startsmatch(k)
-                    new_entry['_startsmatch'] = startsmatch_string
-                    if is_conditional:
-                        has_conditional_regex.append(k)
-                    else:
-                        has_regex.append(k)
-                    allow_slash = False
-                else:
-                    allow_slash = new_entry.get("allow_slash", default_allow_slash)
+                is_regex = str(kind).lower() == "regex"
+                rule = make_rule(rule_key, k, new_entry, is_regex=is_regex)
+                if rule is None:
+                    continue
+                if is_regex:
+                    host_def.add_redirect(k, rule)
+                    logger.debug("[REDIRS] Assigned regex redirect: \"%s\" -> \"%s\"", k, rule.to)
+                    continue
+                allow_slash = new_entry.get("allow_slash", default_allow_slash)
                 match_route = '/'.join((pfx.rstrip('/'), k)).lstrip('/')
                 if allow_slash:
                     # Remove the trailing slash, so we can a second one
@@ -162,25 +179,12 @@ def load_all_defs(state: dict, force: bool = False):
                     match_routes = [match_route, match_route+'/']
                 else:
                     match_routes = [match_route]
-
-                if is_conditional:
-                    for match_route in match_routes:
-                        if match_route not in host_def['conditional_redirects']:
-                            host_def['conditional_redirects'][match_route] = []
-                        host_def['conditional_redirects'][match_route].append(new_entry)
-                        logger.debug(
-                            f"[REDIRS] Assigned conditional redirect: \"{match_route}\" -> \"{new_entry['to']}\""
-                        )
-                else:
-                    for match_route in match_routes:
-                        host_def['redirects'][match_route] = new_entry
-                        logger.debug(f"[REDIRS] Assigned redirect: \"{match_route}\" -> \"{new_entry['to']}\"")
-            host_def['redirects']["_has_regex"] = has_regex
-            host_def['conditional_redirects']["_has_regex"] = has_conditional_regex
+                for match_route in match_routes:
+                    host_def.add_redirect(match_route, rule)
+                    logger.debug("[REDIRS] Assigned redirect: \"%s\" -> \"%s\"", match_route, rule.to)
         if 'rewrites' in this_def:
-            has_regex = []
-            has_conditional_regex = []
             for k, v in this_def['rewrites'].items():
+                rule_key = k
                 is_conditional = False
                 # rewrite is just a string
                 if isinstance(v, (bytes, str)):
@@ -193,42 +197,130 @@ def load_all_defs(state: dict, force: bool = False):
                         is_conditional = True
                     if "from" in v:
                         k = v['from']
-                        if not is_conditional and k in host_def['rewrites']:
+                        if not is_conditional and k in host_def.rewrites:
                             raise RuntimeError(f"Non-Conditional rewrite rule: {k} already exists.")
                 else:
                     raise RuntimeError(f"Bad rewrite value for {k}")
                 kind = new_entry.get("kind", "simple")
-                if str(kind).lower() == "regex":
-                    try:
-                        new_entry['_regex'] = regex.compile(k, flags=regex.IGNORECASE)
-                    except regex.error as e:
-                        logger.warning(f"Cannot compile regex. Error:\n{str(e)}")
-                        continue
-                    startsmatch_string = find_regex_startsmatch(k)
-                    new_entry['_startsmatch'] = startsmatch_string
-                    if is_conditional:
-                        has_conditional_regex.append(k)
-                    else:
-                        has_regex.append(k)
-                if is_conditional:
-                    if k not in host_def['conditional_rewrites']:
-                        host_def['conditional_rewrites'][k] = []
-                    host_def['conditional_rewrites'][k].append(new_entry)
-                    logger.debug(f"[REDIRS] Assigned conditional rewrite: \"{k}\" -> \"{new_entry['to']}\"")
-                else:
-                    host_def['rewrites'][k] = new_entry
-                    logger.debug(f"[REDIRS] Assigned rewrite: \"{k}\" -> \"{new_entry['to']}\"")
-            host_def['rewrites']["_has_regex"] = has_regex
-            host_def['conditional_rewrites']["_has_regex"] = has_regex
+                is_regex = str(kind).lower() == "regex"
+                rule = make_rule(rule_key, k, new_entry, is_regex=is_regex)
+                if rule is None:
+                    continue
+                host_def.add_rewrite(k, rule)
+                logger.debug("[REDIRS] Assigned rewrite: \"%s\" -> \"%s\"", k, rule.to)
         if 'dests' in this_def:
             for name, desc in this_def['dests'].items():
-                if 'name' in dests_ctx:
-                    raise RuntimeError(f"Destination name {name} already defined!")
+                if name in dests_ctx:
+                    logger.error(f"[REDIRS] Destination name {name} already defined, using the later definition.")
                 if 'kind' not in desc:
                     raise RuntimeError(f"Destination {name} does not have a 'kind' value.")
                 kind = desc['kind']
                 if kind not in dest_kind_map:
                     raise RuntimeError(f"Destination {name} has an unknown 'kind' value: {kind}")
                 dest_fn = dest_kind_map[kind]
-                parameterized_dest_fn = partial(dest_fn, dest_params=desc)
+                dest_setup_fn = dest_setup_map.get(kind, None)
+                setup_kwargs = {} if dest_setup_fn is None else dest_setup_fn(desc)
+                parameterized_dest_fn = partial(dest_fn, dest_params=desc, **setup_kwargs)
                 dests_ctx[name] = parameterized_dest_fn
+                dest_defs[name] = (kind, desc)
+
+    # Dests can be defined after the rules that use them, so their per-rule work is done last
+    prepare_rule = partial(_prepare_dest_rule, dest_defs)
+    for builder in builders.values():
+        builder.map_redirects(prepare_rule)
+    defs_ctx: Dict[str, RuleSet] = {host: builder.build(regex_engine, lower) for host, builder in builders.items()}
+    if lower:
+        report = lowering_report(defs_ctx)
+        literal_count = sum(1 for r in report if r[3] == "literal")
+        logger.info(f"[REDIRS] Lowered {literal_count} literal and {len(report) - literal_count} prefix regex rules.")
+        for (virtualhost, index_name, key, lowered_to) in report:
+            logger.debug("[REDIRS] Lowered %s rule \"%s\" on \"%s\" to %s", index_name, key, virtualhost, lowered_to)
+    for alias, virtualhost in aliases.items():
+        defs_ctx[alias] = defs_ctx[virtualhost]
+    return defs_ctx, dests_ctx
+
+class DefsSnapshot:
+    """
+    One complete, compiled set of redirect definitions. A snapshot is never modified
+    after it is built; a reload builds a new snapshot and swaps it in.
+    """
+    __slots__ = ("defs", "hosts", "dests", "def_files")
+
+    def __init__(self, defs: Dict[str, RuleSet], dests: Dict[str, Callable], def_files: DefFiles):
+        # host -> RuleSet
+        self.defs = defs
+        # Normalised host, alias and wildcard lookups of defs
+        self.hosts = HostIndex(defs)
+        # dest name -> dest function
+        self.dests = dests
+        # definition file -> (version, parsed definition), used to skip unmodified files on reload
+        self.def_files = def_files
+
+
+class RedirDefs:
+    """
+    Holds the current DefsSnapshot. Each request's ``state`` is a shallow copy of the app
+    state, so this object is shared by all of them, and replacing ``current`` in one
+    assignment swaps the snapshot atomically for every request that starts afterwards.
+    """
+    __slots__ = ("current", "source", "redir_cache")
+
+    def __init__(self, source: Optional[DefsSource] = None, redir_cache: Optional[RedirCache] = None):
+        self.current: Optional[DefsSnapshot] = None
+        self.source: DefsSource = make_defs_source() if source is None else source
+        self.redir_cache = redir_cache
+
+    def swap(self, snapshot: DefsSnapshot):
+        self.current = snapshot
+        if self.redir_cache is not None:
+            # Cached redirects may have been made by the old rules
+            self.redir_cache.clear()
+
+
+def read_defs_snapshot(source: DefsSource, previous: Optional[DefsSnapshot] = None, force: bool = False) -> Optional[DefsSnapshot]:
+    """
+    Read the definition files from the source and compile them into a new DefsSnapshot.
+
+    Files that have not changed since the ``previous`` snapshot are not parsed again.
+    Returns None if ``previous`` is given and no file was added, removed or modified.
+    """
+    logger.info("[REDIRS] Loading definition files.")
+    def_files, changed = source.read({} if previous is None else previous.def_files, force)
+    if previous is not None and not changed:
+        return None
+    defs_ctx, dests_ctx = compile_defs([this_def for (_, this_def) in def_files.values() if this_def is not None])
+    return DefsSnapshot(defs_ctx, dests_ctx, def_files)
+
+def load_all_defs(state: dict, force: bool = False) -> bool:
+    """
+    Load the definition files into the RedirDefs held in ``state["redir_defs"]``,
+    creating it if needed. Returns True if a new snapshot was swapped in.
+    """
+    try:
+        redir_defs: RedirDefs = state["redir_defs"]
+    except LookupError:
+        state["redir_defs"] = redir_defs = RedirDefs()
+    snapshot = read_defs_snapshot(redir_defs.source, redir_defs.current, force)
+    if snapshot is None:
+        return False
+    redir_defs.swap(snapshot)
+    return True
+
+async def watch_defs(redir_defs: RedirDefs, interval: float):
+    """
+    Background task that checks the definition files every ``interval`` seconds.
+    Changed files are parsed and compiled in a worker thread, off the request path,
+    then the new snapshot is swapped in on the event loop.
+    """
+    logger.info(f"[REDIRS] Watching definition files every {interval} seconds.")
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            snapshot = await asyncio.to_thread(read_defs_snapshot, redir_defs.source, redir_defs.current)
+        except Exception:
+            # Keep serving the previous snapshot
+            logger.exception("[REDIRS] Error reloading definition files:")
+            continue
+        if snapshot is not None:
+            redir_defs.swap(snapshot)
+            logger.info("[REDIRS] Reloaded definition files.")
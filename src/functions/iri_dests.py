@@ -1,15 +1,28 @@
-from typing import Optional
+from typing import Any, Dict, Mapping, Optional
 
-from .connegp import profile_extract, mediatype_extract
+from .connegp import mediatype_extract, negotiate_mediatypes, profile_extract
+from .iri_headers import redir_headers
 
+_unset = object()
 
-def apply_prez_curie(ns, localname, prefixes) -> Optional[str]:
-    for prefix, ns2 in prefixes.items():
-        if ns2 == ns:
-            return f"{prefix}:{localname}"
-    return None
 
-def uri_to_curie(uri: str, prefixes: dict) -> Optional[str]:
+def invert_prefixes(prefixes: Optional[Mapping[str, str]]) -> Dict[str, str]:
+    """
+    The namespace -> prefix index of a ``prefixes`` table. Where several prefixes have the
+    same namespace the first one is kept, the one a scan of the table would find first.
+    """
+    ns_prefixes: Dict[str, str] = {}
+    for prefix, ns in (prefixes or {}).items():
+        ns_prefixes.setdefault(ns, prefix)
+    return ns_prefixes
+
+def apply_prez_curie(ns, localname, ns_prefixes: Mapping[str, str]) -> Optional[str]:
+    prefix = ns_prefixes.get(ns, None)
+    if prefix is None:
+        return None
+    return f"{prefix}:{localname}"
+
+def uri_to_curie(uri: str, ns_prefixes: Mapping[str, str]) -> Optional[str]:
     frag_parts = uri.split("#", 1)
     if len(frag_parts) > 1:
         ns, localname = frag_parts
@@ -21,12 +34,42 @@ def uri_to_curie(uri: str, prefixes: dict) -> Optional[str]:
             ns = ns + "/"
         else:
             return None
-    return apply_prez_curie(ns, localname, prefixes)
+    return apply_prez_curie(ns, localname, ns_prefixes)
+
+def prez_parent_to_curie(prez_parent: Optional[str], ns_prefixes: Mapping[str, str]) -> Optional[str]:
+    if prez_parent:
+        if prez_parent.startswith("http://") or prez_parent.startswith("https://") or prez_parent.startswith("urn:"):
+            return uri_to_curie(prez_parent, ns_prefixes)
+        elif ":" in prez_parent:
+            return prez_parent
+    return None
 
-HTML_MEDIATYPES = ["text/html", "application/xhtml+xml"]
-RDF_MEDIATYPES = ["text/turtle", "application/rdf+xml", "application/ld+json", "application/json"]
+def prez_v3_setup(dest_params: Mapping[str, Any]) -> Dict[str, Any]:
+    """The keyword args bound to a prez_v3 dest when it is created: the inverted prefix table, and the dest's parent CURIE."""
+    ns_prefixes = invert_prefixes(dest_params.get("prefixes", None))
+    return {
+        "ns_prefixes": ns_prefixes,
+        "prez_parent_curie": prez_parent_to_curie(dest_params.get("prez_parent", None), ns_prefixes),
+    }
 
-def prez_v3_dest(proto, host, path, fragment: Optional[str], request, *, dest_params, **kwargs) -> str:
+def prez_v3_rule_params(dest_params: Mapping[str, Any], params: Mapping[str, Any]) -> Mapping[str, Any]:
+    """
+    The params of a rule that redirects to a prez_v3 dest, with its inverted prefix table and
+    its parent CURIE added, when the rule gives its own prefixes or prez_parent.
+    """
+    if "prefixes" not in params and "prez_parent" not in params:
+        return params
+    new_params = dict(params)
+    if "prefixes" in params:
+        new_params["ns_prefixes"] = ns_prefixes = invert_prefixes(params["prefixes"])
+    else:
+        ns_prefixes = invert_prefixes(dest_params.get("prefixes", None))
+    new_params["prez_parent_curie"] = prez_parent_to_curie(
+        params.get("prez_parent", dest_params.get("prez_parent", None)), ns_prefixes
+    )
+    return new_params
+
+def prez_v3_dest(proto, host, path, fragment: Optional[str], request, *, dest_params, ns_prefixes=None, prez_parent_curie=_unset, **kwargs) -> str:
     # In general, Prezv3 translation does not work with trailing slashes in the path
     # This is because the path splitting will split on the trailing slash
     # and curie generation will not work correctly.
@@ -48,40 +91,29 @@ def prez_v3_dest(proto, host, path, fragment: Optional[str], request, *, dest_pa
             extension = path_parts[1]
         else:
             extension = None
-    if "mediatype" in kwargs:
-        mediatype = kwargs["mediatype"]
+    if "negotiation" in kwargs:
+        negotiation = kwargs["negotiation"]
     else:
-        mediatype = mediatype_extract(request.headers, query_params, extension)
+        if "mediatype" in kwargs:
+            mediatype = kwargs["mediatype"]
+        else:
+            mediatype = mediatype_extract(redir_headers(request), query_params, extension)
+        negotiation = negotiate_mediatypes(tuple(mediatype or ()))
     if "profile" in kwargs:
         profile = kwargs["profile"]
     else:
-        profile = profile_extract(request.headers, query_params)
-    curie: Optional[str] = None
-    prefixes: Optional[dict] = kwargs.get("prefixes", dest_params.get("prefixes", None))
-    if prefixes:
-        curie = apply_prez_curie(ns, localname, prefixes)
+        profile = profile_extract(redir_headers(request), query_params)
+    if ns_prefixes is None:
+        # Not set up by prez_v3_setup and prez_v3_rule_params, invert the prefix table now
+        ns_prefixes = invert_prefixes(kwargs.get("prefixes", dest_params.get("prefixes", None)))
+    curie: Optional[str] = apply_prez_curie(ns, localname, ns_prefixes)
     prez_kind = kwargs.get("prez_kind", dest_params.get("prez_kind", None))
-    prez_parent = kwargs.get("prez_parent", dest_params.get("prez_parent", None))
-    parent_curie: Optional[str] = None
-    if prez_parent:
-        if prez_parent.startswith("http://") or prez_parent.startswith("https://") or prez_parent.startswith("urn:"):
-            parent_curie = uri_to_curie(prez_parent, prefixes)
-        elif ":" in prez_parent:
-            parent_curie = prez_parent
-    if mediatype is None or len(mediatype) < 1:
-        prez_end = "backend"
+    parent_curie: Optional[str]
+    if prez_parent_curie is _unset:
+        parent_curie = prez_parent_to_curie(kwargs.get("prez_parent", dest_params.get("prez_parent", None)), ns_prefixes)
     else:
-        # this should already be ordered by highest preference first
-        for (q, m) in mediatype:
-            if m in HTML_MEDIATYPES:
-                prez_end = "frontend"
-            elif m in RDF_MEDIATYPES:
-                prez_end = "backend"
-            else:
-                continue
-            break
-        else:
-            prez_end = "backend"
+        parent_curie = prez_parent_curie
+    prez_end = "frontend" if negotiation.media_class == "html" else "backend"
     web_endpoint = kwargs.get("web_endpoint", dest_params.get("web_endpoint", None))
     api_endpoint = kwargs.get("api_endpoint", dest_params.get("api_endpoint", None))
     if web_endpoint is None or api_endpoint is None:
@@ -117,4 +149,13 @@ def prez_v4_dest(proto, host, path, fragment: Optional[str], query_args, headers
 dest_kind_map = {
     "prez_v3": prez_v3_dest,
     "prez_v4": prez_v4_dest
+}
+# dest kind -> function of the dest definition, giving keyword args to bind to the dest function
+dest_setup_map = {
+    "prez_v3": prez_v3_setup,
+}
+# dest kind -> function of the dest definition and a rule's params, giving the params with
+# the static per-rule work done, for the rules that redirect to a dest of that kind
+dest_rule_params_map = {
+    "prez_v3": prez_v3_rule_params,
 }
\ No newline at end of file
@@ -0,0 +1,120 @@
+"""
+The request headers, parsed once per request.
+
+RawHeaders groups the raw ``scope["headers"]`` byte pairs by name in one pass. It has the
+``getlist``, ``get`` and ``in`` of Starlette's Headers, and attributes for the headers the
+resolver reads: Host and the proxy forwarding headers that pick the proto and virtualhost,
+and the content-negotiation headers that connegp.py reads. The router, the redirect cache
+and the conneg functions all share the one RawHeaders of the request, see redir_headers().
+"""
+from typing import Dict, Iterable, List, Mapping, Optional, Tuple
+
+
+def _header(name: str) -> property:
+    def values(self) -> Tuple[str, ...]:
+        return self._lists.get(name, ())
+    values.__doc__ = f"Every {name} header value, in request order, ``()`` if there are none."
+    return property(values)
+
+
+class RawHeaders:
+    """
+    The request headers, grouped by lowercase name in one pass over ``scope["headers"]``,
+    each name with a tuple of its values in request order.
+    """
+    __slots__ = ("_lists",)
+
+    def __init__(self, raw: Iterable[Tuple[bytes, bytes]]):
+        lists: Dict[str, List[str]] = {}
+        for (k, v) in raw:
+            name = k.decode("latin-1").lower()
+            try:
+                lists[name].append(v.decode("latin-1"))
+            except KeyError:
+                lists[name] = [v.decode("latin-1")]
+        self._lists: Dict[str, Tuple[str, ...]] = {k: tuple(v) for (k, v) in lists.items()}
+
+    @classmethod
+    def from_mapping(cls, headers: Mapping[str, str]) -> "RawHeaders":
+        """From a mapping of header name to (comma-joined) value, like an Azure Functions HttpRequest's headers."""
+        self = cls.__new__(cls)
+        self._lists = {k.lower(): (v,) for k, v in headers.items()}
+        return self
+
+    def getlist(self, key: str) -> List[str]:
+        return list(self._lists.get(key.lower(), ()))
+
+    def get(self, key: str, default: Optional[str] = None) -> Optional[str]:
+        values = self._lists.get(key.lower(), None)
+        return default if not values else values[0]
+
+    def __contains__(self, key: str) -> bool:
+        return key.lower() in self._lists
+
+    host = _header("host")
+    forwarded = _header("forwarded")
+    x_forwarded_host = _header("x-forwarded-host")
+    x_forwarded_proto = _header("x-forwarded-proto")
+    x_forwarded_ssl = _header("x-forwarded-ssl")
+    accept = _header("accept")
+    accept_profile = _header("accept-profile")
+    link = _header("link")
+    prefer = _header("prefer")
+
+    def request_host(self) -> Optional[str]:
+        """The host name of the Host header, lowercase and without a port, or None if there is no Host header."""
+        host = self.host
+        if not host:
+            return None
+        return host[0].split(",", 1)[0].split(":", 1)[0].strip().lower()
+
+    def forwarded_proto_host(self) -> Tuple[Optional[str], Optional[str]]:
+        """
+        The (proto, host) a reverse proxy says the client used, from the Forwarded header,
+        or else from the X-Forwarded-Host, X-Forwarded-Proto and X-Forwarded-Ssl headers.
+        """
+        proto = None
+        host = None
+        forwarded = self.forwarded
+        if forwarded:
+            forwarded_str = forwarded[0].split(",", 1)[0]
+            for c in forwarded_str.split(";"):
+                c = c.strip()
+                if host is None and c.startswith("host="):
+                    host = c[5:]
+                elif proto is None and c.startswith("proto="):
+                    proto = c[6:]
+            return proto, host
+        x_forwarded_host = self.x_forwarded_host
+        if x_forwarded_host:
+            forwarded_host = x_forwarded_host[0].split(",", 1)[0]
+            if forwarded_host:
+                host = forwarded_host.split(":", 1)[0].strip().lower()
+        x_forwarded_proto = self.x_forwarded_proto
+        if x_forwarded_proto:
+            proto = x_forwarded_proto[0].split(",", 1)[0]
+            if proto:
+                proto = proto.strip().lower()
+        x_forwarded_ssl = self.x_forwarded_ssl
+        if proto is None and x_forwarded_ssl:
+            ssl_header = x_forwarded_ssl[0].split(",", 1)[0].strip().lower()
+            if ssl_header in ("on", "true", "yes"):
+                proto = "https"
+            elif ssl_header in ("off", "false", "no"):
+                proto = "http"
+        return proto, host
+
+
+def redir_headers(request) -> RawHeaders:
+    """
+    The RawHeaders of a Starlette Request or a FastRequest. A FastRequest already has them, a
+    Starlette Request's are parsed on first use and kept on ``request.state`` for the rest of the request.
+    """
+    headers = request.headers
+    if isinstance(headers, RawHeaders):
+        return headers
+    state = request.state
+    found = getattr(state, "redir_headers", None)
+    if found is None:
+        state.redir_headers = found = RawHeaders(request.scope["headers"])
+    return found
@@ -0,0 +1,98 @@
+"""
+Virtualhost selection.
+
+A HostIndex is built once for each DefsSnapshot. Its table keys are the normalised virtualhost
+names and ``host_aliases`` of the definition files: lowercase, without a port or a trailing dot.
+A virtualhost or alias of ``*.example.org`` is a wildcard. It matches any subdomain of
+example.org, but not example.org itself, and the most specific wildcard wins.
+
+Host names from requests are normalised the same way before they are looked up, and the
+result of each raw host name is cached, so picking the RuleSet of a request is one dict lookup.
+"""
+from typing import Dict, List, Optional, Tuple
+
+from .iri_rules import RuleSet
+
+# Most raw host names that are requested, at most. The cache is emptied when it is full,
+# so unknown Host headers from clients can't grow it without bound.
+HOST_CACHE_SIZE = 1024
+
+
+def normalize_host(raw: str) -> str:
+    """The host name of a Host header style value, lowercase and without a port or a trailing dot."""
+    host = raw.split(",", 1)[0].strip().lower()
+    if host.startswith("["):
+        # IPv6 literal, "[::1]:8080"
+        end = host.find("]")
+        if end > 0:
+            return host[:end + 1]
+        return host
+    (name, sep, port) = host.rpartition(":")
+    if sep and name and port.isdigit():
+        host = name
+    return host.rstrip(".")
+
+
+class HostIndex:
+    """The RuleSet for each host name of a DefsSnapshot."""
+    __slots__ = ("defs", "exact", "wildcards", "_cache")
+
+    def __init__(self, defs: Dict[str, RuleSet]):
+        self.defs = defs
+        exact: Dict[str, RuleSet] = {}
+        wildcards: Dict[str, RuleSet] = {}
+        for (name, rule_set) in defs.items():
+            if name.startswith("*."):
+                # Stored by the domain after the "*."
+                wildcards.setdefault(normalize_host(name[2:]), rule_set)
+            else:
+                exact.setdefault(normalize_host(name), rule_set)
+        self.exact = exact
+        self.wildcards = wildcards
+        # raw host name -> (normalised host name, RuleSet or None for a host that has no definitions)
+        self._cache: Dict[str, Tuple[str, Optional[RuleSet]]] = {}
+
+    def __reduce__(self):
+        # The index is pickled with its DefsSnapshot, rebuild it rather than pickling the cache
+        return HostIndex, (self.defs,)
+
+    def lookup(self, raw_host: str) -> Tuple[str, Optional[RuleSet]]:
+        """The normalised host name, and its RuleSet or None if there are no definitions for it."""
+        cache = self._cache
+        try:
+            return cache[raw_host]
+        except KeyError:
+            pass
+        host = normalize_host(raw_host)
+        found = self.exact.get(host, None) if host else None
+        if found is None and self.wildcards:
+            parts = host.split(".")
+            for i in range(1, len(parts)):
+                found = self.wildcards.get(".".join(parts[i:]), None)
+                if found is not None:
+                    break
+        if len(cache) >= HOST_CACHE_SIZE:
+            cache.clear()
+        cache[raw_host] = result = (host, found)
+        return result
+
+    def find(self, raw_host: str) -> Optional[RuleSet]:
+        """The RuleSet of the host, or None if there are no definitions for it."""
+        return self.lookup(raw_host)[1]
+
+    def select(self, host_list: List[str], server_name: Optional[str] = None) -> Tuple[Optional[str], RuleSet]:
+        """
+        The first host of ``host_list`` that has definitions, normalised, and its RuleSet. If none
+        of them have definitions, the server name's RuleSet or else the default RuleSet is used,
+        and the host is None.
+        """
+        lookup = self.lookup
+        for possible_host in host_list:
+            (host, found) = lookup(possible_host)
+            if found is not None:
+                return host, found
+        if server_name:
+            found = lookup(server_name)[1]
+            if found is not None:
+                return None, found
+        return None, self.exact[""]
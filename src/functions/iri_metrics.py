@@ -0,0 +1,123 @@
+"""
+In-process redirect metrics, and their Prometheus text exposition.
+
+When REDIR_METRICS is on, the lifespan state holds a RedirMetrics, and resolve_redir records
+every request in it: a hit and a latency for the rule that made the redirect (by virtualhost
+and rule key), a hit for the dest the rule sent it to, or a 404 for the virtualhost. The
+metrics are served in Prometheus text format on the METRICS_ROUTE admin route.
+"""
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from .iri_cache import RedirCache
+from .iri_rules import Rule
+from .iri_timing import BUCKET_BOUNDS_US, StageHistogram, StageTimings
+
+PROMETHEUS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+class RedirMetrics:
+    """
+    Counters and latency histograms of the resolved redirects.
+
+    Nothing is locked. Requests are resolved on the event loop thread, so at worst
+    a count is lost when requests are resolved on several threads at once.
+    """
+    __slots__ = ("rule_hits", "rule_latency", "dest_hits", "not_found")
+
+    def __init__(self):
+        # (virtualhost, rule key) -> count
+        self.rule_hits: Dict[Tuple[str, str], int] = {}
+        # (virtualhost, rule key) -> latency histogram
+        self.rule_latency: Dict[Tuple[str, str], StageHistogram] = {}
+        # dest name -> count
+        self.dest_hits: Dict[str, int] = {}
+        # virtualhost -> count
+        self.not_found: Dict[str, int] = {}
+
+    def record(self, virtualhost: str, rule: Optional[Rule], ns: int):
+        """Record one request, ``rule`` is the rule that made the redirect, or None for a 404."""
+        if rule is None:
+            not_found = self.not_found
+            not_found[virtualhost] = not_found.get(virtualhost, 0) + 1
+            return
+        key = (virtualhost, rule.key)
+        rule_hits = self.rule_hits
+        rule_hits[key] = rule_hits.get(key, 0) + 1
+        try:
+            self.rule_latency[key].observe(ns)
+        except KeyError:
+            self.rule_latency[key] = histogram = StageHistogram()
+            histogram.observe(ns)
+        if rule.to.startswith("!"):
+            dest_hits = self.dest_hits
+            dest_hits[rule.to[1:]] = dest_hits.get(rule.to[1:], 0) + 1
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def _labels(pairs: Iterable[Tuple[str, str]]) -> str:
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for (k, v) in pairs) + "}"
+
+
+def _counter(lines: List[str], name: str, help_text: str, values: Dict[Tuple[Tuple[str, str], ...], int]):
+    lines.append(f"# HELP {name} {help_text}")
+    lines.append(f"# TYPE {name} counter")
+    for labels, value in sorted(values.items()):
+        lines.append(f"{name}{_labels(labels) if labels else ''} {value}")
+
+
+def _histogram(lines: List[str], name: str, help_text: str, values: Dict[Tuple[Tuple[str, str], ...], Tuple[Tuple[int, ...], int, int]]):
+    lines.append(f"# HELP {name} {help_text}")
+    lines.append(f"# TYPE {name} histogram")
+    for labels, (counts, count, sum_ns) in sorted(values.items()):
+        cumulative = 0
+        for bound_us, n in zip(BUCKET_BOUNDS_US + (None,), counts):
+            cumulative += n
+            le = "+Inf" if bound_us is None else repr(bound_us / 1000000)
+            lines.append(f"{name}_bucket{_labels(labels + (('le', le),))} {cumulative}")
+        lines.append(f"{name}_sum{_labels(labels) if labels else ''} {sum_ns / 1000000000!r}")
+        lines.append(f"{name}_count{_labels(labels) if labels else ''} {count}")
+
+
+def render_prometheus(
+    metrics: Optional[RedirMetrics],
+    timings: Optional[StageTimings] = None,
+    redir_cache: Optional[RedirCache] = None,
+) -> str:
+    """The metrics in Prometheus text exposition format."""
+    lines: List[str] = []
+    if metrics is not None:
+        _counter(
+            lines, "iri_redir_rule_hits_total", "Redirects made by each rule.",
+            {(("virtualhost", vh), ("rule", key)): n for (vh, key), n in list(metrics.rule_hits.items())},
+        )
+        _histogram(
+            lines, "iri_redir_rule_duration_seconds", "Time to resolve the redirects made by each rule.",
+            {
+                (("virtualhost", vh), ("rule", key)): (tuple(h.counts), h.count, h.sum_ns)
+                for (vh, key), h in list(metrics.rule_latency.items())
+            },
+        )
+        _counter(
+            lines, "iri_redir_dest_hits_total", "Redirects sent to each dest.",
+            {(("dest", dest),): n for dest, n in list(metrics.dest_hits.items())},
+        )
+        _counter(
+            lines, "iri_redir_not_found_total", "Requests with no redirect, by virtualhost.",
+            {(("virtualhost", vh),): n for vh, n in list(metrics.not_found.items())},
+        )
+    if timings is not None:
+        _histogram(
+            lines, "iri_redir_stage_duration_seconds", "Time spent in each stage of resolving a redirect.",
+            {(("stage", stage),): values for stage, values in timings.snapshot().items()},
+        )
+    if redir_cache is not None:
+        stats = redir_cache.stats()
+        _counter(lines, "iri_redir_cache_hits_total", "Redirect cache hits.", {(): stats["hits"]})
+        _counter(lines, "iri_redir_cache_misses_total", "Redirect cache misses.", {(): stats["misses"]})
+        lines.append("# HELP iri_redir_cache_size Redirects in the redirect cache.")
+        lines.append("# TYPE iri_redir_cache_size gauge")
+        lines.append(f"iri_redir_cache_size {stats['size']}")
+    return "\n".join(lines) + "\n"
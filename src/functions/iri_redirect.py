@@ -1,16 +1,17 @@
-from contextlib import asynccontextmanager
-from distutils.core import extension_keywords
-from selectors import SelectSelector
-from typing import List, Any, Optional, Tuple, Dict
+from time import perf_counter_ns
+from typing import FrozenSet, List, Optional, Tuple, Dict
 from urllib.parse import urlsplit, parse_qsl, urlencode, urlunsplit
 
-from starlette.datastructures import Headers
-from starlette.routing import Router, Route, Mount
 from starlette.requests import Request
 from starlette.responses import HTMLResponse, Response
-from .._settings import settings
-from .iri_configs import load_all_defs
-from .connegp import profile_extract, mediatype_extract
+from .iri_access_log import AccessLog
+from .iri_cache import RedirCache, redir_cache_key
+from .iri_headers import redir_headers
+from .iri_configs import DefsSnapshot, RedirDefs
+from .iri_rules import DecisionTable, Rule, RuleSet
+from .connegp import MediaNegotiation, QList, mediatype_extract, negotiate_mediatypes, profile_extract
+from .iri_metrics import RedirMetrics
+from .iri_timing import StageTimer, StageTimings
 
 from logging import getLogger
 
@@ -19,46 +20,74 @@ undef = object()
 # The root logger, this is overridden by Azure Function App logger.
 logger = getLogger()
 
-mediatype_expands = {
-    "html": "text/html",
-    "xhtml": "application/xhtml+xml",
-    "xml": "application/xml",
-    "rdf": "application/rdf+xml",
-    "ttl": "text/turtle",
-    "turtle": "text/turtle",
-    "n3": "text/n3",
-    "nt": "text/n3",
-    "jsonld": "application/ld+json",
-    "json-ld": "application/ld+json",
-    "json": "application/json",
-}
+# (status code, Location, message). Location is None when no redirect was found,
+# then the message is the HTML body to send with the status code.
+RedirResult = Tuple[int, Optional[str], Optional[str]]
+# The result, with the virtualhost of the RuleSet used and the Rule that made the redirect (None for a miss)
+RedirMatch = Tuple[RedirResult, str, Optional[Rule]]
 
-def match_mediatype(mediatypes: List[Tuple[float, str]], mt: str) -> bool:
-    mt = mediatype_expands.get(mt, mt)
-    # The mediatype list should already be sorted by qval
-    return any(mt == mt_str for (q, mt_str) in mediatypes)
 
-def match_profile(profiles: List[Tuple[float, str]], profile: str) -> bool:
-    # The profile list should already be sorted by qval
-    return any(profile == profile_str for (q, profile_str) in profiles)
+def _append_query_params(redir_to: str, query_params: Dict[str, str]) -> str:
+    """The Location with the request's query params appended, for a qsa rule. The Location's own params win."""
+    _scheme, _netloc, _path, _query, _fragment = urlsplit(redir_to)
+    _new_query_params = dict(parse_qsl(_query, keep_blank_values=True))
+    query_params.update(_new_query_params)
+    _new_query_string = urlencode(query_params, doseq=True)
+    return urlunsplit((_scheme, _netloc, _path, _new_query_string, _fragment))
 
-def _evaluate_conditional(cond: dict, profiles: List[Tuple[float, str]], mediatypes: List[Tuple[float, str]], request: Request) -> bool:
-    resps = {}
-    for k, v in cond.items():
-        if k == "not":
-            if len(v) < 1:
-                resps[k] = False
-            else:
-                resps[k] = not _evaluate_conditional(v, profiles, mediatypes, request)
-        elif k == "mediatype":
-            resps[k] = match_mediatype(mediatypes, v)
-        elif k == "profile":
-            resps[k] = match_profile(profiles, v)
 
-    # AND all conditions together to get the final result
-    return len(resps) < 1 or all(bool(v) for k, v in resps.items())
+def _negotiate(request, query_params: Dict[str, str], extension: Optional[str]) -> Tuple[QList, MediaNegotiation, QList, FrozenSet[str]]:
+    headers = redir_headers(request)
+    mediatype = mediatype_extract(headers, query_params, extension)
+    negotiation = negotiate_mediatypes(mediatype)
+    profile = profile_extract(headers, query_params)
+    return mediatype, negotiation, profile, frozenset(p for (q, p) in profile)
 
-async def make_redir(proto, host_list: List[str], path: str, query_params: Dict[str, str], request: Request) -> Response:
+
+def resolve_redir(proto, host_list: List[str], path: str, query_params: Dict[str, str], request) -> RedirResult:
+    """
+    Find the redirect for a request, without making a Response.
+
+    ``request`` can be a Starlette Request, or any object with the same ``state``
+    (``conf_server_name``, ``conf_debug``, ``redir_defs``, ``redir_timings``, ``redir_metrics``, ``redir_access_log``)
+    and ``headers`` (``getlist``) attributes. When ``redir_timings`` is set, the stages are timed, the StageTimer is
+    left in ``request.state.stage_timer`` for the Server-Timing header, and the timings are added to the histograms.
+    When ``redir_metrics`` is set, the request is counted for the rule that made the redirect.
+    When ``redir_access_log`` is set, the request is written to the access log.
+    """
+    state = request.state
+    redir_timings: Optional[StageTimings] = state.redir_timings
+    redir_metrics: Optional[RedirMetrics] = state.redir_metrics
+    access_log: Optional[AccessLog] = state.redir_access_log
+    if redir_timings is None:
+        if redir_metrics is None and access_log is None:
+            return _resolve_redir(proto, host_list, path, query_params, request, None)[0]
+        start = perf_counter_ns()
+        (result, virtualhost, rule) = _resolve_redir(proto, host_list, path, query_params, request, None)
+        ns = perf_counter_ns() - start
+    else:
+        timer = StageTimer()
+        (result, virtualhost, rule) = _resolve_redir(proto, host_list, path, query_params, request, timer)
+        timer.mark("finish")
+        redir_timings.record(timer)
+        state.stage_timer = timer
+        ns = timer.total()
+    if redir_metrics is not None:
+        redir_metrics.record(virtualhost, rule, ns)
+    if access_log is not None:
+        access_log.record(host_list[0] if host_list else None, path, virtualhost, rule, result[0], result[1], ns)
+    return result
+
+
+def resolve_redir_match(proto, host_list: List[str], path: str, query_params: Dict[str, str], request) -> RedirMatch:
+    """
+    Like resolve_redir, but also gives the virtualhost of the RuleSet used and the Rule that
+    made the redirect, for reporting. The request is not timed or counted in the metrics.
+    """
+    return _resolve_redir(proto, host_list, path, query_params, request, None)
+
+
+def _resolve_redir(proto, host_list: List[str], path: str, query_params: Dict[str, str], request, timer: Optional[StageTimer]) -> RedirMatch:
     # STEP 0: Set up local constants, get path from request
     app_domain_name = request.state.conf_server_name
     app_debug = request.state.conf_debug
@@ -76,202 +105,204 @@ async def make_redir(proto, host_list: List[str], path: str, query_params: Dict[
         localname = None
         extension = None
     request.state.client_requested_path = orig_path
-    logger.debug(f"[REDIRS] Client requested path: {orig_path}")
+    logger.debug("[REDIRS] Client requested path: %s", orig_path)
+
+    # Take the current snapshot once, so a reload can't change the defs part-way through
+    redir_defs: RedirDefs = request.state.redir_defs
+    snapshot: DefsSnapshot = redir_defs.current
+    redir_cache: Optional[RedirCache] = redir_defs.redir_cache
+    if redir_cache is not None:
+        headers = redir_headers(request)
+        cache_key = redir_cache_key(
+            proto, host_list, orig_path,
+            mediatype_extract(headers, query_params, extension), profile_extract(headers, query_params),
+        )
+        cached = redir_cache.get(cache_key)
+        if cached is not None:
+            (redir_code, redir_to, virtualhost, used_rule) = cached
+            if used_rule.qsa:
+                redir_to = _append_query_params(redir_to, query_params)
+            request.state.target_path = redir_to
+            if timer is not None:
+                timer.mark("cache")
+            return (redir_code, redir_to, None), virtualhost, used_rule
 
-    mediatype: Optional[List[Tuple[float, str]]] = None
-    profile: Optional[List[Tuple[float, str]]] = None
+    if timer is not None:
+        timer.mark("cache")
+    mediatype: Optional[QList] = None
+    profile: Optional[QList] = None
+    # Mediatypes are negotiated once, on the first conditional rule, and the result is
+    # shared by the rest of the conditional rules and by the dest
+    negotiation: Optional[MediaNegotiation] = None
+    profile_set: FrozenSet[str] = frozenset()
 
     # STEP 1: Find the correct "redirect host" file to use based on
     # Host header, x-forwarded-host header, and configured server name
-    redir_rules = undef
-    host = "(None)"
-    redir_host_defs = request.state.defs
-    redir_dests = request.state.dests
+    redir_dests = snapshot.dests
     m_path = orig_path.lower()  # match-path for matching redirs is always lowercase
 
-    for possible_host in host_list:
-        if possible_host in redir_host_defs:
-            host = str(possible_host)
-            redir_rules = redir_host_defs[possible_host]
-            break
-
-    if redir_rules is undef:
-        if app_domain_name and (app_domain_name in redir_host_defs):
-            redir_rules = redir_host_defs[app_domain_name]
-        else:
-            redir_rules = redir_host_defs[""]
-
-
-    use_default_redir_code = redir_rules.get("_default_redir_code", 307)
-    use_default_qsa = redir_rules.get("_default_qsa", False)
+    redir_rules: RuleSet
+    (found_host, redir_rules) = snapshot.hosts.select(host_list, app_domain_name)
+    host = "(None)" if found_host is None else str(found_host)
+    if timer is not None:
+        timer.mark("host")
 
     # STEP 2: Check and apply relevant rewrite rules
     did_rewrite = False
-    if m_path in redir_rules['rewrites']:
-        new_path = str(redir_rules['rewrites'][m_path]['to']).lower().lstrip('/')
-        logger.debug(f"[REDIR] Match rewrite rule. Rewriting path to \"{new_path}\"")
+    rule: Optional[Rule] = redir_rules.rewrites.get(m_path, None)
+    if rule is not None:
+        new_path = rule.to.lower().lstrip('/')
+        logger.debug("[REDIR] Match rewrite rule. Rewriting path to \"%s\"", new_path)
         m_path = new_path
         did_rewrite = True
+        if timer is not None:
+            timer.mark("rewrite")
     else:
-        # No static-rewrite for this path
-        pass
-    do_regex = (not did_rewrite) and len(redir_rules['rewrites'].get("_has_regex", [])) > 0
-    if do_regex:
-        # Sort by length, longest first
-        for k in sorted(redir_rules['rewrites']["_has_regex"], key=lambda x: len(x), reverse=True):
-            this_regex_c_rewrite = redir_rules['rewrites'][k]
-            compiled_regex = this_regex_c_rewrite['_regex']  # type: regex.Pattern
-            startsmatch_string = this_regex_c_rewrite['_startsmatch']
-            if len(startsmatch_string) > 0 and not m_path.startswith(startsmatch_string):
-                continue
-            (new_path, n) = compiled_regex.subfn(this_regex_c_rewrite['to'], m_path, concurrent=True)
-            if n > 0:
-                logger.debug(f"[REDIR] Match regex rewrite rule. Substituting path to \"{new_path}\"")
-                m_path = new_path
-                m_path = m_path.lstrip('/')
-                did_rewrite = True
-                break
-    if not did_rewrite and m_path in redir_rules['conditional_rewrites']:
+        if timer is not None:
+            timer.mark("rewrite")
+        # No static-rewrite for this path, try the regex rewrites, longest first
+        found = redir_rules.regex_rewrites.substitute(m_path)
+        if found is not None:
+            (rule, new_path) = found
+            logger.debug("[REDIR] Match regex rewrite rule. Substituting path to \"%s\"", new_path)
+            m_path = new_path.lstrip('/')
+            did_rewrite = True
+        if timer is not None:
+            timer.mark("regex_rewrite")
+    if not did_rewrite:
         # Now check for conditional rewrites, these are applied only after
         # the static rewrites and static regex rewrites
-        this_rewrites = redir_rules['conditional_rewrites'][m_path]
-        for this_rewrite in this_rewrites:
-            cond = this_rewrite['condition']
-            applies = False
-            if len(cond) > 0:
-                if mediatype is None:
-                    mediatype = mediatype_extract(request.headers, query_params, extension)
-                if profile is None:
-                    profile = profile_extract(request.headers, query_params)
-                applies = _evaluate_conditional(cond, profile, mediatype, request)
-            if applies:
-                new_path = this_rewrite['to']
-                logger.debug(f"[REDIR] Match conditional rewrite rule. Rewriting path to \"{new_path}\"")
+        table: Optional[DecisionTable] = redir_rules.conditional_rewrites.get(m_path, None)
+        if table is not None:
+            if negotiation is None:
+                if timer is not None:
+                    timer.mark("conditional")
+                (mediatype, negotiation, profile, profile_set) = _negotiate(request, query_params, extension)
+                if timer is not None:
+                    timer.mark("conneg")
+            rule = table.select(negotiation, profile_set)
+            if rule is not None:
+                new_path = rule.to
+                logger.debug("[REDIR] Match conditional rewrite rule. Rewriting path to \"%s\"", new_path)
                 m_path = new_path.lstrip('/')
                 did_rewrite = True
-                break
-    do_cond_regex = (not did_rewrite) and len(redir_rules['conditional_rewrites'].get("_has_regex", [])) > 0
-    if do_cond_regex:
-        # Sort by length, longest first
-        for k in sorted(redir_rules['conditional_rewrites']["_has_regex"], key=lambda x: len(x), reverse=True):
-            this_regex_cond_rewrites = redir_rules['conditional_rewrites'][k]
-            for this_regex_c_rewrite in this_regex_cond_rewrites:
-                startsmatch_string = this_regex_c_rewrite['_startsmatch']
-                if len(startsmatch_string) > 0 and not m_path.startswith(startsmatch_string):
-                    continue
-                cond = this_regex_c_rewrite['condition']
-                applies = False
-                if len(cond) > 0:
-                    if mediatype is None:
-                        mediatype = mediatype_extract(request.headers, query_params, extension)
-                    if profile is None:
-                        profile = profile_extract(request.headers, query_params)
-                    applies = _evaluate_conditional(cond, profile, mediatype, request)
-                if applies:
-                    compiled_regex = this_regex_c_rewrite['_regex']  # type: regex.Pattern
-                    (new_path, n) = compiled_regex.subfn(this_regex_c_rewrite['to'], m_path, concurrent=True)
-                    if n > 0:
-                        logger.debug(f"[REDIR] Match conditioanl regex rewrite rule. Substituting path to \"{new_path}\"")
-                        m_path = new_path
-                        m_path = m_path.lstrip('/')
-                        did_rewrite = True
-                        break
-            if did_rewrite:
-                break
+    if not did_rewrite:
+        for rule in redir_rules.conditional_regex_rewrites.candidates(m_path):
+            if negotiation is None:
+                if timer is not None:
+                    timer.mark("conditional")
+                (mediatype, negotiation, profile, profile_set) = _negotiate(request, query_params, extension)
+                if timer is not None:
+                    timer.mark("conneg")
+            if rule.condition.applies(negotiation, profile_set):
+                (new_path, n) = rule.regex.subfn(rule.to, m_path, concurrent=True)
+                if n > 0:
+                    logger.debug("[REDIR] Match conditional regex rewrite rule. Substituting path to \"%s\"", new_path)
+                    m_path = new_path.lstrip('/')
+                    did_rewrite = True
+                    break
+        if timer is not None:
+            timer.mark("conditional")
     # Step 3: Do the actual redirects
     redir_to: Optional[str] = None
-    used_record: Optional[dict] = None
-    if m_path in redir_rules['redirects']:
+    used_rule: Optional[Rule] = redir_rules.redirects.get(m_path, None)
+    if used_rule is not None:
         # Static redirects
-        record = redir_rules['redirects'][m_path]
-        redir_to = record['to']
-        used_record = record.copy()
-    do_regex = (redir_to is None) and len(redir_rules['redirects'].get("_has_regex", [])) > 0
-    if do_regex:
-        # Sort by length, longest first
-        for k in sorted(redir_rules['redirects']["_has_regex"], key=lambda x: len(x), reverse=True):
-            this_regex_c_redir = redir_rules['redirects'][k]
-            startsmatch_string = this_regex_c_redir['_startsmatch']
-            if len(startsmatch_string) > 0 and not m_path.startswith(startsmatch_string):
-                continue
-            compiled_regex = this_regex_c_redir['_regex']  # type: regex.Pattern
-            (new_path, n) = compiled_regex.subfn(this_regex_c_redir['to'], m_path, concurrent=True)
-            if n > 0:
-                logger.debug(f"[REDIR] Match regex redirect rule. Substituting redirect to \"{new_path}\"")
-                redir_to = new_path
-                used_record = this_regex_c_redir.copy()
-                break
-    if redir_to is None and m_path in redir_rules['conditional_redirects']:
+        redir_to = used_rule.to
+        if timer is not None:
+            timer.mark("redirect")
+    else:
+        if timer is not None:
+            timer.mark("redirect")
+        found = redir_rules.regex_redirects.substitute(m_path)
+        if found is not None:
+            (used_rule, redir_to) = found
+            logger.debug("[REDIR] Match regex redirect rule. Substituting redirect to \"%s\"", redir_to)
+        if timer is not None:
+            timer.mark("regex_redirect")
+    if redir_to is None:
         # Now check for conditional redirects, these are applied only after
         # the static redirects and static regex redirects
-        this_records = redir_rules['conditional_redirects'][m_path]
-        for this_record in this_records:
-            cond = this_record['condition']
-            applies = False
-            if len(cond) > 0:
-                if mediatype is None:
-                    mediatype = mediatype_extract(request.headers, query_params, extension)
-                if profile is None:
-                    profile = profile_extract(request.headers, query_params)
-                applies = _evaluate_conditional(cond, profile, mediatype, request)
-            if applies:
-                redir_to = this_record['to']
-                used_record = this_record.copy()
-                break
-    do_cond_regex = (redir_to is None) and len(redir_rules['conditional_redirects'].get("_has_regex", [])) > 0
-    if do_cond_regex:
-        # Sort by length, longest first
-        for k in sorted(redir_rules['conditional_redirects']["_has_regex"], key=lambda x: len(x), reverse=True):
-            this_regex_cond_records = redir_rules['conditional_redirects'][k]
-            for this_regex_c_record in this_regex_cond_records:
-                startsmatch_string = this_regex_c_record['_startsmatch']
-                if len(startsmatch_string) > 0 and not m_path.startswith(startsmatch_string):
-                    continue
-                cond = this_regex_c_record['condition']
-                applies = False
-                if len(cond) > 0:
-                    if mediatype is None:
-                        mediatype = mediatype_extract(request.headers, query_params, extension)
-                    if profile is None:
-                        profile = profile_extract(request.headers, query_params)
-                    applies = _evaluate_conditional(cond, profile, mediatype, request)
-                if applies:
-                    compiled_regex = this_regex_c_record['_regex']  # type: regex.Pattern
-                    (new_path, n) = compiled_regex.subfn(this_regex_c_record['to'], m_path, concurrent=True)
-                    if n > 0:
-                        redir_to = new_path
-                        used_record = this_regex_c_record.copy()
-                        break
-            if redir_to is not None:
-                break
-    if redir_to is None or used_record is None:
-        return HTMLResponse(f"Not Found; host={host}; path={m_path}", status_code=404)
+        table = redir_rules.conditional_redirects.get(m_path, None)
+        if table is not None:
+            if negotiation is None:
+                if timer is not None:
+                    timer.mark("conditional")
+                (mediatype, negotiation, profile, profile_set) = _negotiate(request, query_params, extension)
+                if timer is not None:
+                    timer.mark("conneg")
+            rule = table.select(negotiation, profile_set)
+            if rule is not None:
+                redir_to = rule.to
+                used_rule = rule
+    if redir_to is None:
+        for rule in redir_rules.conditional_regex_redirects.candidates(m_path):
+            if negotiation is None:
+                if timer is not None:
+                    timer.mark("conditional")
+                (mediatype, negotiation, profile, profile_set) = _negotiate(request, query_params, extension)
+                if timer is not None:
+                    timer.mark("conneg")
+            if rule.condition.applies(negotiation, profile_set):
+                (new_path, n) = rule.regex.subfn(rule.to, m_path, concurrent=True)
+                if n > 0:
+                    redir_to = new_path
+                    used_rule = rule
+                    break
+        if timer is not None:
+            timer.mark("conditional")
+    if redir_to is None or used_rule is None:
+        return (404, None, f"Not Found; host={host}; path={m_path}"), redir_rules.virtualhost, None
     elif redir_to.startswith("!"):
         redir_to_dest = redir_to[1:]
         if not redir_to_dest in redir_dests:
-            return HTMLResponse(f"Not Found; host={host}; path={m_path}", status_code=404)
+            return (404, None, f"Not Found; host={host}; path={m_path}"), redir_rules.virtualhost, None
         kwargs = {"query_params": query_params}
         if mediatype is not None:
             kwargs["mediatype"] = mediatype
+            kwargs["negotiation"] = negotiation
         if profile is not None:
             kwargs["profile"] = profile
         if extension is not None:
             kwargs["extension"] = extension
-        kwargs.update(used_record)
         dest_fn = redir_dests[redir_to_dest]
-        redir_to = dest_fn(proto, host, path, None, request, **kwargs)
-    append_route = used_record.get("append_route", False)
-    redir_code = int(used_record.get("code", use_default_redir_code))
-    qsa = used_record.get("qsa", use_default_qsa)
-    if append_route:
+        if timer is not None:
+            timer.mark("finish")
+        redir_to = dest_fn(proto, host, path, None, request, **kwargs, **used_rule.params)
+        if timer is not None:
+            timer.mark("dest")
+    redir_code = used_rule.code
+    if used_rule.append_route:
         redir_to = "/".join((redir_to.rstrip("/"), orig_path))
-    if qsa:
+    if redir_cache is not None:
+        # Cached before the query args are appended, they are appended to the cached Location on each hit
+        redir_cache.put(cache_key, redir_code, redir_to, redir_rules.virtualhost, used_rule)
+    if used_rule.qsa:
         # Append query args to redirect
-        _scheme, _netloc, _path, _query, _fragment = urlsplit(redir_to)
-        _new_query_params = dict(parse_qsl(_query, keep_blank_values=True))
-        query_params.update(_new_query_params)
-        _new_query_string = urlencode(query_params, doseq=True)
-        redir_to = urlunsplit((_scheme, _netloc, _path, _new_query_string, _fragment))
-    logger.debug(f"[REDIRS] Match redirect rule. Redirecting with code {redir_code} to {redir_to}")
+        redir_to = _append_query_params(redir_to, query_params)
+    logger.debug("[REDIRS] Match redirect rule. Redirecting with code %s to %s", redir_code, redir_to)
     request.state.target_path = redir_to
-    return Response(None, status_code=redir_code, headers={"Location": redir_to})
+    return (redir_code, redir_to, None), redir_rules.virtualhost, used_rule
+
+
+def redir_response(result: RedirResult, stage_timer: Optional[StageTimer] = None) -> Response:
+    (status_code, location, message) = result
+    if location is None:
+        response = HTMLResponse(message, status_code=status_code)
+    else:
+        response = Response(None, status_code=status_code, headers={"Location": location})
+    if stage_timer is not None:
+        response.headers["Server-Timing"] = stage_timer.server_timing()
+    return response
+
+
+def request_stage_timer(request) -> Optional[StageTimer]:
+    """The StageTimer resolve_redir left on the request, when timing is on."""
+    if request.state.redir_timings is None:
+        return None
+    return getattr(request.state, "stage_timer", None)
+
+
+async def make_redir(proto, host_list: List[str], path: str, query_params: Dict[str, str], request: Request) -> Response:
+    result = resolve_redir(proto, host_list, path, query_params, request)
+    return redir_response(result, request_stage_timer(request))
@@ -0,0 +1,621 @@
+"""
+Compiled, read-only redirect rule tables.
+
+``load_all_defs`` parses the TOML definition files once and compiles the rules
+for each virtualhost into a ``RuleSet``. All per-host defaults are resolved into
+the individual ``Rule`` objects and the regex rule lists are sorted at load time,
+so ``make_redir`` only has to do lookups when serving a request.
+
+Rule conditions are compiled too. A condition only depends on the negotiated mediatype and
+on which profiles the client asked for, so the conditional rules for each path are compiled
+into a ``DecisionTable`` that maps every possible outcome straight to the winning rule.
+"""
+from itertools import product
+from logging import getLogger
+from types import MappingProxyType
+from typing import Any, Callable, Dict, FrozenSet, List, Mapping, Optional, Tuple
+
+import regex
+
+from .connegp import MEDIATYPE_EXPANDS, SERVER_MEDIATYPE_SET, MediaNegotiation
+
+logger = getLogger()  # Root logger
+
+EMPTY_MAPPING: Mapping = MappingProxyType({})
+
+# Keys in a TOML rule entry that are consumed by the rule compiler itself.
+# Everything else in the entry is passed through to the dest function.
+RULE_KEYS = frozenset((
+    "to", "from", "kind", "condition", "code", "qsa", "append_route", "allow_slash", "route_prefix",
+))
+# Keyword arguments that make_redir, or the dest's per-rule setup, supplies to a dest function itself.
+RESERVED_DEST_KWARGS = frozenset((
+    "query_params", "mediatype", "negotiation", "profile", "extension", "ns_prefixes", "prez_parent_curie",
+))
+
+
+class _PickledMapping(dict):
+    """Stands in for a MappingProxyType, which cannot be pickled, inside a pickled rule table."""
+    __slots__ = ()
+
+
+def _unpickle_frozen(cls, values):
+    obj = object.__new__(cls)
+    for name, value in zip(cls.__slots__, values):
+        if isinstance(value, _PickledMapping):
+            value = MappingProxyType(dict(value))
+        object.__setattr__(obj, name, value)
+    return obj
+
+
+class _Frozen:
+    __slots__ = ()
+
+    def __setattr__(self, key, value):
+        raise AttributeError(f"{type(self).__name__} is read-only")
+
+    def __delattr__(self, key):
+        raise AttributeError(f"{type(self).__name__} is read-only")
+
+    def __reduce__(self):
+        # Compiled rule tables are pickled into the precompiled defs snapshot (see iri_snapshot.py)
+        values = tuple(getattr(self, name) for name in type(self).__slots__)
+        values = tuple(_PickledMapping(v) if isinstance(v, MappingProxyType) else v for v in values)
+        return _unpickle_frozen, (type(self), values)
+
+
+# A compiled condition expression is a tuple of terms that are ANDed together:
+#   ("mediatype", mt)   the client wants mediatype mt (always expanded, lowercase)
+#   ("profile", uri)    the client asked for the profile
+#   ("not", expr)       the sub-expression is not true
+#   ("false",)          never true, an empty condition or an empty "not"
+ConditionExpr = Tuple[tuple, ...]
+FALSE_EXPR: ConditionExpr = (("false",),)
+# The outcomes of a condition are enumerated for every combination of the profiles it
+# names, so conditions that name more profiles than this are evaluated on each request instead
+MAX_TABLE_PROFILES = 4
+
+
+def compile_condition(cond: dict) -> ConditionExpr:
+    terms = []
+    for k, v in cond.items():
+        if k == "not":
+            terms.append(("not", compile_condition(v)) if len(v) > 0 else ("false",))
+        elif k == "mediatype":
+            terms.append(("mediatype", MEDIATYPE_EXPANDS.get(v, v).lower()))
+        elif k == "profile":
+            terms.append(("profile", v))
+    return tuple(terms)
+
+
+def evaluate_condition(expr: ConditionExpr, negotiation: MediaNegotiation, profile_set: FrozenSet[str]) -> bool:
+    for term in expr:
+        kind = term[0]
+        if kind == "mediatype":
+            ok = negotiation.accepts(term[1])
+        elif kind == "profile":
+            ok = term[1] in profile_set
+        elif kind == "not":
+            ok = not evaluate_condition(term[1], negotiation, profile_set)
+        else:
+            ok = False
+        if not ok:
+            return False
+    return True
+
+
+def _condition_atoms(expr: ConditionExpr, mediatypes: set, profiles: set):
+    for term in expr:
+        if term[0] == "mediatype":
+            mediatypes.add(term[1])
+        elif term[0] == "profile":
+            profiles.add(term[1])
+        elif term[0] == "not":
+            _condition_atoms(term[1], mediatypes, profiles)
+
+
+class _Outcome:
+    """
+    Stands in for a MediaNegotiation while building a decision table, for one possible outcome:
+    the client's preferred mediatype is ``preferred`` (or none of those the table looks at).
+    """
+    __slots__ = ("preferred",)
+
+    def __init__(self, preferred: Optional[str]):
+        self.preferred = preferred
+
+    def accepts(self, mt: str) -> bool:
+        return mt == self.preferred
+
+
+class Condition(_Frozen):
+    """A rule condition, compiled from its TOML ``condition`` table."""
+    __slots__ = ("source", "expr")
+
+    def __init__(self, source: dict):
+        _set = object.__setattr__
+        _set(self, "source", source)
+        # A rule with an empty condition never applies
+        _set(self, "expr", compile_condition(source) if len(source) > 0 else FALSE_EXPR)
+
+    def applies(self, negotiation: MediaNegotiation, profile_set: FrozenSet[str]) -> bool:
+        return evaluate_condition(self.expr, negotiation, profile_set)
+
+    def __repr__(self):
+        return f"Condition({self.source!r})"
+
+
+# (prefix length, shortest remainder, ``to`` split on "{1}"), see prefix_split()
+PrefixSplit = Tuple[int, int, Tuple[str, ...]]
+
+
+class Rule(_Frozen):
+    """
+    A single compiled redirect or rewrite rule.
+
+    ``split`` is set by the optimiser on an anchored ``^prefix(.+)`` regex rule, so it can be
+    applied by slicing the path, without the regex engine.
+    """
+    __slots__ = (
+        "key", "pattern", "to", "regex", "startsmatch",
+        "condition", "code", "qsa", "append_route", "params", "split",
+    )
+
+    def __init__(
+        self,
+        key: str,
+        pattern: str,
+        to: str,
+        *,
+        regex: Optional["regex.Pattern"] = None,
+        startsmatch: str = "",
+        condition: Optional[Condition] = None,
+        code: int = 307,
+        qsa: bool = False,
+        append_route: bool = False,
+        params: Mapping[str, Any] = EMPTY_MAPPING,
+        split: Optional[PrefixSplit] = None,
+    ):
+        _set = object.__setattr__
+        _set(self, "key", key)
+        _set(self, "pattern", pattern)
+        _set(self, "to", to)
+        _set(self, "regex", regex)
+        _set(self, "startsmatch", startsmatch)
+        _set(self, "condition", condition)
+        _set(self, "code", code)
+        _set(self, "qsa", qsa)
+        _set(self, "append_route", append_route)
+        _set(self, "params", params)
+        _set(self, "split", split)
+
+    @property
+    def is_regex(self) -> bool:
+        return self.regex is not None
+
+    def replace(self, **changes) -> "Rule":
+        values = {name: getattr(self, name) for name in Rule.__slots__}
+        values.update(changes)
+        return Rule(values.pop("key"), values.pop("pattern"), values.pop("to"), **values)
+
+    def with_params(self, params: Mapping[str, Any]) -> "Rule":
+        return self.replace(params=params)
+
+    def __repr__(self):
+        return f"Rule({self.key!r}, {self.pattern!r} -> {self.to!r})"
+
+
+REGEX_ENGINES = ("loop", "combined")
+_COMBINED_GROUP_PREFIX = "_iri_rule_"
+# Backreferences to numbered or named groups cannot survive being combined into one pattern
+_BACKREF_RE = regex.compile(r"\\[1-9]|\\g<|\(\?P=|\\k<")
+
+
+def _combine_rules(rules: Tuple[Rule, ...]) -> Optional["regex.Pattern"]:
+    """
+    Combine the rules into a single alternation that is matched from the start of the path.
+
+    Each alternative checks the rule's literal prefix, then lazily scans for the rule's own
+    pattern, so it matches exactly when the ``startsmatch`` check passes and ``rule.regex``
+    would find a match anywhere in the path. The prefix check is case-sensitive, like the
+    ``startsmatch`` check of the loop engine, while the patterns keep their IGNORECASE flag.
+    Alternatives are tried in rule order, so the first one to match is the longest-first
+    winner. An empty marker group at the end of each alternative is always the last group
+    closed, so ``Match.lastgroup`` names the winner.
+
+    Returns None, and logs a warning, if the rules can't be combined, so the loop is used instead.
+    """
+    if len(rules) < 1:
+        return None
+    alternatives = []
+    for i, rule in enumerate(rules):
+        if _BACKREF_RE.search(rule.pattern):
+            logger.warning(f"[REDIRS] Regex rule \"{rule.pattern}\" has a backreference, using the loop engine for its rule list instead of the combined engine.")
+            return None
+        lookahead = f"(?=(?-i:{regex.escape(rule.startsmatch)}))" if rule.startsmatch else ""
+        alternatives.append(f"{lookahead}(?s:.*?)(?:{rule.pattern})(?P<{_COMBINED_GROUP_PREFIX}{i}>)")
+    try:
+        return regex.compile("^(?:" + "|".join(alternatives) + ")", flags=regex.IGNORECASE)
+    except regex.error as e:
+        culprit = "(unknown)"
+        for (rule, alternative) in zip(rules, alternatives):
+            try:
+                regex.compile(alternative, flags=regex.IGNORECASE)
+            except regex.error:
+                culprit = rule.pattern
+                break
+        logger.warning(f"[REDIRS] Regex rules can't be combined, at rule \"{culprit}\": {e}. Using the loop engine for their rule list instead of the combined engine.")
+        return None
+
+
+# Characters that make a pattern more than a literal string
+_REGEX_META = frozenset("^$.[](){}|*+?\\")
+_PREFIX_SPLIT_GROUPS = (("(.+)$", 1), ("(.+)", 1), ("(.*)$", 0), ("(.*)", 0))
+
+
+def literal_pattern(rule: Rule) -> Optional[str]:
+    """
+    The path that an anchored, literal ``^literal$`` rule matches, or None for any other rule.
+    Only rules whose ``to`` has no ``{}`` template fields qualify, so their result is just ``to``.
+    """
+    pattern = rule.pattern
+    if len(pattern) < 3 or pattern[0] != "^" or pattern[-1] != "$" or "{" in rule.to or "}" in rule.to:
+        return None
+    literal = pattern[1:-1]
+    if any(c in _REGEX_META for c in literal):
+        return None
+    return rule.startsmatch
+
+
+def prefix_split(rule: Rule) -> Optional[PrefixSplit]:
+    """
+    The PrefixSplit for an anchored ``^prefix(.+)`` (or ``(.*)``, with or without ``$``) catch-all
+    rule whose ``to`` only uses ``{1}``, or None for any other rule.
+    """
+    pattern = rule.pattern
+    if not pattern.startswith("^"):
+        return None
+    for (group, shortest) in _PREFIX_SPLIT_GROUPS:
+        if pattern.endswith(group):
+            prefix = pattern[1:-len(group)]
+            break
+    else:
+        return None
+    if not prefix or any(c in _REGEX_META for c in prefix):
+        return None
+    to_parts = tuple(rule.to.split("{1}"))
+    if any("{" in part or "}" in part for part in to_parts):
+        return None
+    return len(prefix), shortest, to_parts
+
+
+class RegexRuleIndex(_Frozen):
+    """
+    Longest-first list of regex rules, with a prefix trie over each rule's literal
+    ``startsmatch`` prefix. ``candidates(path)`` returns only the rules whose prefix
+    the path starts with, still in longest-pattern-first order.
+
+    With ``combined=True`` the rules are also compiled into one multi-pattern regex, and
+    ``substitute(path)`` finds the winning rule in a single scan instead of trying each
+    candidate in turn.
+
+    With ``lower=True`` the rules are optimised for ``substitute``: ``^literal$`` rules that no
+    longer rule could match first are moved into the exact-match ``literals`` table, which is
+    looked up before the regex rules, and ``^prefix(.+)`` rules get a ``split`` so they are
+    applied by slicing the path. ``rules`` still holds every rule, in order.
+    """
+    __slots__ = ("rules", "literals", "_loop_rules", "_trie", "_combined")
+
+    def __init__(self, rules: Tuple[Rule, ...], combined: bool = False, lower: bool = False):
+        loop_rules = rules
+        literals: Dict[str, Tuple[Rule, str]] = {}
+        if lower:
+            (rules, loop_rules, literals) = _lower_rules(rules)
+        # Each trie node is a dict of char -> child node. The rule indexes for rules
+        # whose prefix ends at that node are stored under the None key.
+        trie: dict = {}
+        for i, rule in enumerate(loop_rules):
+            node = trie
+            for c in rule.startsmatch:
+                node = node.setdefault(c, {})
+            node.setdefault(None, []).append(i)
+        _freeze_trie(trie, loop_rules)
+        object.__setattr__(self, "rules", rules)
+        object.__setattr__(self, "literals", MappingProxyType(literals) if literals else EMPTY_MAPPING)
+        object.__setattr__(self, "_loop_rules", loop_rules)
+        object.__setattr__(self, "_trie", trie)
+        object.__setattr__(self, "_combined", _combine_rules(loop_rules) if combined else None)
+
+    @property
+    def is_combined(self) -> bool:
+        return self._combined is not None
+
+    def candidates(self, path: str) -> Tuple[Rule, ...]:
+        node = self._trie
+        found = []
+        if None in node:
+            found.append(node[None])
+        for c in path:
+            try:
+                node = node[c]
+            except KeyError:
+                break
+            if None in node:
+                found.append(node[None])
+        if len(found) < 1:
+            return ()
+        elif len(found) == 1:
+            return found[0][1]
+        rules = self._loop_rules
+        return tuple(rules[i] for i in sorted(i for (idxs, _) in found for i in idxs))
+
+    def substitute(self, path: str) -> Optional[Tuple[Rule, str]]:
+        """
+        Find the first rule, longest pattern first, whose regex matches the path.
+        Returns that rule and the path with the rule's ``to`` template substituted in,
+        or None if no rule matches.
+        """
+        literals = self.literals
+        if literals:
+            found = literals.get(path, None)
+            if found is not None:
+                return found
+        combined = self._combined
+        if combined is not None:
+            m = combined.match(path)
+            if m is None:
+                return None
+            rule = self._loop_rules[int(m.lastgroup[len(_COMBINED_GROUP_PREFIX):])]
+            return rule, rule.regex.subf(rule.to, path, concurrent=True)
+        for rule in self.candidates(path):
+            split = rule.split
+            if split is not None:
+                # A candidate's path starts with its prefix. "." does not match a newline,
+                # so leave those paths to the regex engine.
+                (prefix_len, shortest, to_parts) = split
+                rest = path[prefix_len:]
+                if "\n" not in rest:
+                    if len(rest) < shortest:
+                        continue
+                    return rule, rest.join(to_parts)
+            (new_path, n) = rule.regex.subfn(rule.to, path, concurrent=True)
+            if n > 0:
+                return rule, new_path
+        return None
+
+    def __iter__(self):
+        return iter(self.rules)
+
+    def __len__(self):
+        return len(self.rules)
+
+    def __bool__(self):
+        return len(self.rules) > 0
+
+
+def _lower_rules(rules: Tuple[Rule, ...]) -> Tuple[Tuple[Rule, ...], Tuple[Rule, ...], Dict[str, Tuple[Rule, str]]]:
+    """
+    Split longest-first rules into (all rules, rules left for the regex loop, literals table).
+    A literal rule is only lowered when no rule before it in the candidates for its path
+    matches that path, so looking it up first gives the same winner as the loop would.
+    """
+    unlowered = RegexRuleIndex(rules)
+    all_rules: List[Rule] = []
+    loop_rules: List[Rule] = []
+    literals: Dict[str, Tuple[Rule, str]] = {}
+    for rule in rules:
+        literal = literal_pattern(rule)
+        if literal is not None and literal not in literals:
+            shadowed = False
+            for other in unlowered.candidates(literal):
+                if other is rule:
+                    break
+                if other.regex.search(literal) is not None:
+                    shadowed = True
+                    break
+            if not shadowed:
+                literals[literal] = (rule, rule.to)
+                all_rules.append(rule)
+                continue
+        split = prefix_split(rule)
+        if split is not None:
+            rule = rule.replace(split=split)
+        all_rules.append(rule)
+        loop_rules.append(rule)
+    return tuple(all_rules), tuple(loop_rules), literals
+
+
+def lowered_rules(index: RegexRuleIndex) -> List[Tuple[Rule, str]]:
+    """(rule, "literal" or "prefix_split") for each rule of the index that the optimiser lowered."""
+    literal_rules = {id(rule) for (rule, _) in index.literals.values()}
+    lowered = []
+    for rule in index.rules:
+        if id(rule) in literal_rules:
+            lowered.append((rule, "literal"))
+        elif rule.split is not None:
+            lowered.append((rule, "prefix_split"))
+    return lowered
+
+
+def _freeze_trie(trie: dict, rules: Tuple[Rule, ...]):
+    stack = [trie]
+    while stack:
+        node = stack.pop()
+        for k, v in node.items():
+            if k is None:
+                # Keep the indexes for merging, and the rules themselves for the common single-node case
+                node[None] = (tuple(v), tuple(rules[i] for i in v))
+            else:
+                stack.append(v)
+
+
+class DecisionTable(_Frozen):
+    """
+    The conditional rules for one path, in file order, compiled into a table that maps each
+    possible conneg outcome to the first rule whose condition holds for it.
+
+    An outcome is the negotiated ``preferred`` mediatype, if it is one the conditions name (otherwise
+    None), and whether the client asked for each of the profiles the conditions name. When a
+    condition names a mediatype that is not one of SERVER_MEDIATYPES, whether it matches depends
+    on more than the best match, so the table is not built and the conditions are evaluated in turn.
+    """
+    __slots__ = ("rules", "mediatypes", "profiles", "table")
+
+    def __init__(self, rules: Tuple[Rule, ...]):
+        mediatypes: set = set()
+        profiles: set = set()
+        for rule in rules:
+            _condition_atoms(rule.condition.expr, mediatypes, profiles)
+        profile_order = tuple(sorted(profiles))
+        table: Optional[Mapping] = None
+        if mediatypes <= SERVER_MEDIATYPE_SET and len(profiles) <= MAX_TABLE_PROFILES:
+            table = {}
+            for preferred in (*sorted(mediatypes), None):
+                outcome = _Outcome(preferred)
+                for asked in product((False, True), repeat=len(profile_order)):
+                    profile_set = frozenset(p for p, a in zip(profile_order, asked) if a)
+                    table[(preferred, asked)] = next(
+                        (rule for rule in rules if evaluate_condition(rule.condition.expr, outcome, profile_set)), None
+                    )
+            table = MappingProxyType(table)
+        _set = object.__setattr__
+        _set(self, "rules", rules)
+        _set(self, "mediatypes", frozenset(mediatypes))
+        _set(self, "profiles", profile_order)
+        _set(self, "table", table)
+
+    def select(self, negotiation: MediaNegotiation, profile_set: FrozenSet[str]) -> Optional[Rule]:
+        """The first rule whose condition holds for this request, or None."""
+        table = self.table
+        if table is None:
+            for rule in self.rules:
+                if rule.condition.applies(negotiation, profile_set):
+                    return rule
+            return None
+        preferred = negotiation.preferred
+        return table[(
+            preferred if preferred in self.mediatypes else None,
+            tuple(p in profile_set for p in self.profiles),
+        )]
+
+    def __iter__(self):
+        return iter(self.rules)
+
+    def __len__(self):
+        return len(self.rules)
+
+
+EMPTY_INDEX = RegexRuleIndex(())
+
+
+class RuleSet(_Frozen):
+    """
+    The compiled rules for one virtualhost.
+
+    Static rules are keyed on their lowercase match path, conditional static rules are kept in
+    a DecisionTable for each path. Regex rules are kept in a RegexRuleIndex, in
+    longest-pattern-first order, which is the order they must be tried in.
+    """
+    __slots__ = (
+        "virtualhost",
+        "rewrites", "regex_rewrites", "conditional_rewrites", "conditional_regex_rewrites",
+        "redirects", "regex_redirects", "conditional_redirects", "conditional_regex_redirects",
+    )
+
+    def __init__(
+        self,
+        virtualhost: str,
+        *,
+        rewrites: Mapping[str, Rule] = EMPTY_MAPPING,
+        regex_rewrites: RegexRuleIndex = EMPTY_INDEX,
+        conditional_rewrites: Mapping[str, DecisionTable] = EMPTY_MAPPING,
+        conditional_regex_rewrites: RegexRuleIndex = EMPTY_INDEX,
+        redirects: Mapping[str, Rule] = EMPTY_MAPPING,
+        regex_redirects: RegexRuleIndex = EMPTY_INDEX,
+        conditional_redirects: Mapping[str, DecisionTable] = EMPTY_MAPPING,
+        conditional_regex_redirects: RegexRuleIndex = EMPTY_INDEX,
+    ):
+        _set = object.__setattr__
+        _set(self, "virtualhost", virtualhost)
+        _set(self, "rewrites", rewrites)
+        _set(self, "regex_rewrites", regex_rewrites)
+        _set(self, "conditional_rewrites", conditional_rewrites)
+        _set(self, "conditional_regex_rewrites", conditional_regex_rewrites)
+        _set(self, "redirects", redirects)
+        _set(self, "regex_redirects", regex_redirects)
+        _set(self, "conditional_redirects", conditional_redirects)
+        _set(self, "conditional_regex_redirects", conditional_regex_redirects)
+
+    def __repr__(self):
+        return f"RuleSet({self.virtualhost!r})"
+
+
+def _longest_first(rules: List[Rule], combined: bool = False, lower: bool = False) -> RegexRuleIndex:
+    # sorted() is stable, so rules with same-length patterns keep their file order
+    return RegexRuleIndex(tuple(sorted(rules, key=lambda r: len(r.pattern), reverse=True)), combined, lower)
+
+
+class RuleSetBuilder:
+    """Mutable accumulator for the rules of one virtualhost, across all definition files."""
+
+    def __init__(self, virtualhost: str):
+        self.virtualhost = virtualhost
+        self.rewrites: Dict[str, Rule] = {}
+        self.regex_rewrites: List[Rule] = []
+        self.conditional_rewrites: Dict[str, List[Rule]] = {}
+        self.conditional_regex_rewrites: List[Rule] = []
+        self.redirects: Dict[str, Rule] = {}
+        self.regex_redirects: List[Rule] = []
+        self.conditional_redirects: Dict[str, List[Rule]] = {}
+        self.conditional_regex_redirects: List[Rule] = []
+
+    def add_rewrite(self, match_route: str, rule: Rule):
+        if rule.is_regex:
+            if rule.condition is not None:
+                self.conditional_regex_rewrites.append(rule)
+            else:
+                self.regex_rewrites.append(rule)
+        elif rule.condition is not None:
+            self.conditional_rewrites.setdefault(match_route, []).append(rule)
+        else:
+            self.rewrites[match_route] = rule
+
+    def add_redirect(self, match_route: str, rule: Rule):
+        if rule.is_regex:
+            if rule.condition is not None:
+                self.conditional_regex_redirects.append(rule)
+            else:
+                self.regex_redirects.append(rule)
+        elif rule.condition is not None:
+            self.conditional_redirects.setdefault(match_route, []).append(rule)
+        else:
+            self.redirects[match_route] = rule
+
+    def map_redirects(self, fn: Callable[[Rule], Rule]):
+        """Replace every redirect rule with ``fn(rule)``."""
+        self.redirects = {k: fn(rule) for k, rule in self.redirects.items()}
+        self.regex_redirects = [fn(rule) for rule in self.regex_redirects]
+        self.conditional_redirects = {k: [fn(rule) for rule in v] for k, v in self.conditional_redirects.items()}
+        self.conditional_regex_redirects = [fn(rule) for rule in self.conditional_regex_redirects]
+
+    def build(self, regex_engine: str = "loop", lower: bool = False) -> RuleSet:
+        # Conditional regex rules must have their condition checked before matching,
+        # so only the unconditional regex rules can use the combined matcher, or be lowered.
+        # The combined matcher already finds the winning rule in one scan, so it is not lowered.
+        combined = regex_engine == "combined"
+        lower = lower and not combined
+        return RuleSet(
+            self.virtualhost,
+            rewrites=MappingProxyType(dict(self.rewrites)),
+            regex_rewrites=_longest_first(self.regex_rewrites, combined, lower),
+            conditional_rewrites=MappingProxyType(
+                {k: DecisionTable(tuple(v)) for k, v in self.conditional_rewrites.items()}
+            ),
+            conditional_regex_rewrites=_longest_first(self.conditional_regex_rewrites),
+            redirects=MappingProxyType(dict(self.redirects)),
+            regex_redirects=_longest_first(self.regex_redirects, combined, lower),
+            conditional_redirects=MappingProxyType(
+                {k: DecisionTable(tuple(v)) for k, v in self.conditional_redirects.items()}
+            ),
+            conditional_regex_redirects=_longest_first(self.conditional_regex_redirects),
+        )
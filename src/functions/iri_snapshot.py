@@ -0,0 +1,108 @@
+"""
+Precompiled snapshot of the redirect definitions, for faster cold starts.
+
+The snapshot is a pickle of a compiled DefsSnapshot. Its first line is a header with a content
+hash of the source TOML files, so the app can check that the snapshot still matches the files
+before loading it, and fall back to parsing the TOML files when it doesn't.
+
+Build it at deploy time with:
+
+    python -m src.functions.iri_snapshot [output_file]
+
+Only load snapshots built by your own deployment. Unpickling runs code from the file.
+"""
+import hashlib
+import pickle
+import sys
+from logging import getLogger
+from pathlib import Path
+from typing import Optional
+
+import regex
+
+from .. import settings
+from .iri_configs import DefsSnapshot, RedirDefs, read_defs_snapshot
+from .iri_sources import DirectoryDefsSource
+
+logger = getLogger()  # Root logger
+
+SNAPSHOT_FORMAT = b"IRI-REDIR-DEFS-SNAPSHOT/5"
+
+
+def defs_content_hash(directory: str) -> str:
+    """
+    Hash of the TOML files in the directory, and of everything else that changes the compiled result.
+    """
+    h = hashlib.sha256()
+    h.update(SNAPSHOT_FORMAT)
+    h.update(f"{sys.version_info[:2]}|regex={regex.__version__}|engine={settings['REGEX_ENGINE']}|lowering={settings['REGEX_LOWERING']}".encode("utf-8"))
+    for conf_file in sorted(Path(directory).absolute().glob("*.toml")):
+        h.update(b"\0" + conf_file.name.encode("utf-8") + b"\0")
+        h.update(conf_file.read_bytes())
+    return h.hexdigest()
+
+
+def build_snapshot_file(snapshot_file: str, directory: Optional[str] = None) -> str:
+    """Compile the definition files in the directory and write them to a snapshot file. Returns the content hash."""
+    directory = settings["CONFIG_DEFS_DIRECTORY"] if directory is None else directory
+    content_hash = defs_content_hash(directory)
+    snapshot = read_defs_snapshot(DirectoryDefsSource(directory))
+    with open(snapshot_file, "wb") as f:
+        f.write(SNAPSHOT_FORMAT + b" " + content_hash.encode("ascii") + b"\n")
+        pickle.dump(snapshot, f, protocol=pickle.HIGHEST_PROTOCOL)
+    return content_hash
+
+
+def read_snapshot_file(snapshot_file: str, directory: str) -> Optional[DefsSnapshot]:
+    """Load the snapshot file, if it exists and still matches the definition files in the directory."""
+    try:
+        f = open(snapshot_file, "rb")
+    except FileNotFoundError:
+        logger.debug(f"[REDIRS] No precompiled definitions snapshot at {snapshot_file}")
+        return None
+    with f:
+        header = f.readline().rstrip(b"\n").split(b" ", 1)
+        if len(header) < 2 or header[0] != SNAPSHOT_FORMAT:
+            logger.warning(f"[REDIRS] {snapshot_file} is not a definitions snapshot. Ignoring it.")
+            return None
+        content_hash = defs_content_hash(directory)
+        if header[1].decode("ascii") != content_hash:
+            logger.info(f"[REDIRS] Definitions snapshot {snapshot_file} does not match the definition files. Ignoring it.")
+            return None
+        snapshot: DefsSnapshot = pickle.load(f)
+    # The snapshot was built from files at another path, with other mtimes.
+    # Point it at the local files so the watcher doesn't see them all as changed.
+    by_name = {Path(k).name: v for k, v in snapshot.def_files.items()}
+    def_files = {}
+    for conf_file in sorted(Path(directory).absolute().glob("*.toml")):
+        (_, this_def) = by_name[conf_file.name]
+        def_files[str(conf_file)] = (conf_file.stat().st_mtime, this_def)
+    return DefsSnapshot(snapshot.defs, snapshot.dests, def_files)
+
+
+def load_snapshot_defs(redir_defs: RedirDefs, snapshot_file: str) -> bool:
+    """
+    Swap a precompiled snapshot into ``redir_defs`` if one is available and up to date.
+    Returns False if the definition files must be loaded and compiled the usual way.
+    """
+    source = redir_defs.source
+    if not snapshot_file or not isinstance(source, DirectoryDefsSource):
+        return False
+    try:
+        snapshot = read_snapshot_file(snapshot_file, source.directory)
+    except Exception:
+        logger.exception(f"[REDIRS] Cannot load definitions snapshot {snapshot_file}:")
+        return False
+    if snapshot is None:
+        return False
+    logger.info(f"[REDIRS] Loaded precompiled definitions snapshot {snapshot_file}")
+    redir_defs.swap(snapshot)
+    return True
+
+
+if __name__ == "__main__":
+    out_file = sys.argv[1] if len(sys.argv) > 1 else settings["CONFIG_SNAPSHOT_FILE"]
+    if not out_file:
+        raise SystemExit("Usage: python -m src.functions.iri_snapshot <output_file>")
+    built_hash = build_snapshot_file(out_file)
+    print(f"Wrote definitions snapshot {out_file} ({built_hash})")
@@ -0,0 +1,186 @@
+"""
+Sources of the TOML redirect definition files.
+
+A source lists its definition files and returns them parsed, keyed on the file name, along
+with a version for each (the file mtime, or the blob ETag). Files whose version has not changed
+since the previous read are not fetched or parsed again.
+"""
+from abc import ABC, abstractmethod
+from logging import getLogger
+from pathlib import Path
+from typing import Any, Dict, Optional, Tuple
+
+from .. import settings
+
+logger = getLogger()  # Root logger
+
+# file name -> (version, parsed definition or None if it could not be parsed)
+DefFiles = Dict[str, Tuple[Any, Optional[dict]]]
+
+
+def _read_def_file(conf_file: Path) -> Optional[dict]:
+    # Imported here, tomli is not needed at all when a precompiled snapshot is loaded
+    from tomli import load as load_toml
+    try:
+        f = open(conf_file, "rb")
+    except Exception:
+        logger.error(f"[REDIRS] Cannot open {conf_file}!")
+        raise
+
+    try:
+        this_def = load_toml(f)
+        logger.info(f"[REDIRS] Reading {conf_file}")
+    except Exception as e:
+        logger.error(f"[REDIRS] Cannot read or load {conf_file}.")
+        logger.exception(f"Error reading or loading {conf_file}:")
+        return None
+    finally:
+        f.close()
+    return this_def
+
+
+def _parse_def_bytes(data: bytes, name: str) -> Optional[dict]:
+    from tomli import loads as loads_toml
+    try:
+        this_def = loads_toml(data.decode("utf-8"))
+        logger.info(f"[REDIRS] Reading {name}")
+    except Exception as e:
+        logger.error(f"[REDIRS] Cannot read or load {name}.")
+        logger.exception(f"Error reading or loading {name}:")
+        return None
+    return this_def
+
+
+class DefsSource(ABC):
+    @abstractmethod
+    def read(self, previous: DefFiles, force: bool = False) -> Tuple[DefFiles, bool]:
+        """
+        Read all definition files, reusing the parsed definitions in ``previous`` for files
+        that have not changed. Returns the new files (in load order) and whether anything
+        was added, removed or modified.
+        """
+
+
+class DirectoryDefsSource(DefsSource):
+    """The ``*.toml`` files in a local directory, versioned by modification time."""
+
+    def __init__(self, directory: str):
+        self.directory = directory
+
+    def read(self, previous: DefFiles, force: bool = False) -> Tuple[DefFiles, bool]:
+        defs_dir = Path(self.directory).absolute()
+        logger.info("[REDIRS] Using definition directory: "+str(defs_dir))
+        if not defs_dir.exists():
+            raise RuntimeError(f"Directory {defs_dir} does not exist!")
+        if not defs_dir.is_dir():
+            raise RuntimeError(f"Directory {defs_dir} is not a directory!")
+        new_def_files: DefFiles = {}
+        changed = force
+        for conf_filename in sorted(defs_dir.glob("*.toml")):
+            conf_file = conf_filename.absolute()
+            try:
+                stats = conf_file.stat()
+                mtime = stats.st_mtime
+            except Exception:
+                logger.info("Cannot get file modification date. Ignoring.")
+                mtime = 1
+            key = str(conf_file)
+            try:
+                old_mtime, old_def = previous[key]
+            except LookupError:
+                old_mtime, old_def = 0, None
+            # Compare for equality, a deployment can replace a file with an older one
+            if not force and (mtime == old_mtime):
+                logger.debug(f"[REDIRS] File not modified. {conf_file}")
+                new_def_files[key] = (old_mtime, old_def)
+                continue
+            # A file that cannot be parsed is remembered as None, so it is not retried until modified
+            new_def_files[key] = (mtime, _read_def_file(conf_file))
+            changed = True
+        return new_def_files, changed or (new_def_files.keys() != previous.keys())
+
+
+class BlobDefsSource(DefsSource):
+    """
+    The ``*.toml`` blobs in an Azure Blob Storage container, versioned by ETag.
+
+    Listing the container returns the current ETag of every blob, so an unchanged file costs
+    nothing more than its entry in the listing. Changed blobs are downloaded concurrently,
+    with If-None-Match set to the previous ETag, so a blob that was changed back between
+    the listing and the download is not downloaded or parsed again.
+    """
+
+    def __init__(self, container_client, prefix: str = "", max_workers: int = 8):
+        # An azure.storage.blob.ContainerClient, or anything with the same
+        # list_blobs() and get_blob_client().download_blob() methods
+        self.container_client = container_client
+        self.prefix = prefix
+        self.max_workers = max_workers
+
+    @classmethod
+    def from_settings(cls) -> "BlobDefsSource":
+        try:
+            from azure.storage.blob import ContainerClient
+        except ImportError:
+            raise RuntimeError("azure-storage-blob must be installed to load definitions from Blob Storage.")
+        container = settings["CONFIG_BLOB_CONTAINER"]
+        connection_string = settings["CONFIG_BLOB_CONNECTION_STRING"]
+        if connection_string:
+            # Connection strings are used for Azurite and for storage account keys
+            container_client = ContainerClient.from_connection_string(connection_string, container)
+        else:
+            account_url = settings["CONFIG_BLOB_ACCOUNT_URL"]
+            if not account_url:
+                raise RuntimeError("CONFIG_BLOB_ACCOUNT_URL or CONFIG_BLOB_CONNECTION_STRING must be set to use CONFIG_BLOB_CONTAINER.")
+            from azure.identity import DefaultAzureCredential
+            container_client = ContainerClient(account_url, container, credential=DefaultAzureCredential())
+        logger.info(f"[REDIRS] Using definition blob container: {container}")
+        return cls(container_client, prefix=settings["CONFIG_BLOB_PREFIX"])
+
+    def _fetch(self, name: str, old: Optional[Tuple[Any, Optional[dict]]]) -> Tuple[Tuple[Any, Optional[dict]], bool]:
+        from azure.core import MatchConditions
+        from azure.core.exceptions import ResourceNotModifiedError
+        blob_client = self.container_client.get_blob_client(name)
+        if old is None:
+            downloader = blob_client.download_blob()
+        else:
+            try:
+                downloader = blob_client.download_blob(etag=old[0], match_condition=MatchConditions.IfModified)
+            except ResourceNotModifiedError:
+                logger.debug(f"[REDIRS] Blob not modified. {name}")
+                return old, False
+        data = downloader.readall()
+        return (downloader.properties.etag, _parse_def_bytes(data, name)), True
+
+    def read(self, previous: DefFiles, force: bool = False) -> Tuple[DefFiles, bool]:
+        listed = sorted(
+            (blob.name, blob.etag) for blob in self.container_client.list_blobs(name_starts_with=self.prefix or None)
+            if blob.name.endswith(".toml")
+        )
+        new_def_files: DefFiles = {}
+        to_fetch = []
+        for name, etag in listed:
+            old = previous.get(name, None)
+            if not force and old is not None and old[0] == etag:
+                logger.debug(f"[REDIRS] Blob not modified. {name}")
+                new_def_files[name] = old
+            else:
+                to_fetch.append((name, None if force else old))
+                # Placeholder keeps the listing order
+                new_def_files[name] = None
+        changed = False
+        if to_fetch:
+            from concurrent.futures import ThreadPoolExecutor
+            with ThreadPoolExecutor(max_workers=min(self.max_workers, len(to_fetch))) as pool:
+                results = list(pool.map(lambda f: self._fetch(*f), to_fetch))
+            for (name, _), (def_file, modified) in zip(to_fetch, results):
+                new_def_files[name] = def_file
+                changed = changed or modified
+        return new_def_files, changed or force or (new_def_files.keys() != previous.keys())
+
+
+def make_defs_source() -> DefsSource:
+    """The Blob Storage source if CONFIG_BLOB_CONTAINER is set, otherwise CONFIG_DEFS_DIRECTORY."""
+    if settings["CONFIG_BLOB_CONTAINER"]:
+        return BlobDefsSource.from_settings()
+    return DirectoryDefsSource(settings["CONFIG_DEFS_DIRECTORY"])
@@ -0,0 +1,88 @@
+"""
+Optional per-stage timing of the redirect resolver.
+
+When REDIR_TIMING is on, the lifespan state holds a StageTimings, and resolve_redir times each
+request with a StageTimer. The time between two ``mark()`` calls is added to the stage named in
+the second call. The stages of a request are sent back in a ``Server-Timing`` response header,
+and are added to the in-process histograms of the StageTimings.
+
+When it is off, ``redir_timings`` is None and the resolver skips every ``mark()`` call.
+"""
+from bisect import bisect_left
+from time import perf_counter_ns
+from typing import Dict, List, Tuple
+
+# The stages of resolve_redir, in the order they run
+STAGES = (
+    "cache", "host", "rewrite", "regex_rewrite", "conneg", "conditional",
+    "redirect", "regex_redirect", "dest", "finish", "total",
+)
+# Upper bounds of the histogram buckets, in microseconds. The last bucket is unbounded.
+BUCKET_BOUNDS_US = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 25000, 100000)
+_BUCKET_BOUNDS_NS = tuple(b * 1000 for b in BUCKET_BOUNDS_US)
+
+
+class StageTimer:
+    """The timings of the stages of one request, in nanoseconds."""
+    __slots__ = ("start", "last", "durations")
+
+    def __init__(self):
+        self.start = self.last = perf_counter_ns()
+        self.durations: Dict[str, int] = {}
+
+    def mark(self, stage: str):
+        """Add the time since the last mark to ``stage``."""
+        now = perf_counter_ns()
+        durations = self.durations
+        durations[stage] = durations.get(stage, 0) + (now - self.last)
+        self.last = now
+
+    def total(self) -> int:
+        return self.last - self.start
+
+    def server_timing(self) -> str:
+        """The value of the Server-Timing header, with the durations in milliseconds."""
+        parts = [f"{stage};dur={ns / 1000000:.3f}" for stage, ns in self.durations.items()]
+        parts.append(f"total;dur={self.total() / 1000000:.3f}")
+        return ", ".join(parts)
+
+
+class StageHistogram:
+    """Counts of the durations of one stage, by bucket, with their count and sum."""
+    __slots__ = ("counts", "count", "sum_ns")
+
+    def __init__(self):
+        self.counts: List[int] = [0] * (len(_BUCKET_BOUNDS_NS) + 1)
+        self.count = 0
+        self.sum_ns = 0
+
+    def observe(self, ns: int):
+        self.counts[bisect_left(_BUCKET_BOUNDS_NS, ns)] += 1
+        self.count += 1
+        self.sum_ns += ns
+
+
+class StageTimings:
+    """
+    In-process histograms of the stage timings of all requests.
+
+    Updates are not locked. Requests are resolved on the event loop thread, so at worst
+    a count is lost when requests are resolved on several threads at once.
+    """
+    __slots__ = ("histograms",)
+
+    def __init__(self):
+        self.histograms: Dict[str, StageHistogram] = {stage: StageHistogram() for stage in STAGES}
+
+    def record(self, timer: StageTimer):
+        histograms = self.histograms
+        for stage, ns in timer.durations.items():
+            histograms[stage].observe(ns)
+        histograms["total"].observe(timer.total())
+
+    def snapshot(self) -> Dict[str, Tuple[Tuple[int, ...], int, int]]:
+        """stage -> (counts by bucket, count, sum in nanoseconds), for the stages that have run."""
+        return {
+            stage: (tuple(h.counts), h.count, h.sum_ns)
+            for stage, h in self.histograms.items() if h.count > 0
+        }
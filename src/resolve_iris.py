@@ -0,0 +1,199 @@
+"""
+Offline IRI resolver.
+
+Loads the redirect definitions with load_all_defs, reads IRIs from a file or stdin, resolves
+them like ``/redir?_pid=...`` requests in a pool of worker processes, without any HTTP stack,
+and writes one JSON line per IRI, in input order:
+
+    {"iri": "https://...", "status": 307, "location": "https://...", "virtualhost": "...", "rule": "..."}
+
+``rule`` is the key of the rule that made the redirect, it is null for a miss. Each input line
+is an IRI, or a JSON object like a /redir/batch item: ``{"iri": ..., "accept": ..., "profile": ..., "id": ...}``.
+A line that is bad JSON, an object without an "iri" string, or one whose "accept" or "profile"
+isn't a string, gives a status 400 line with its
+input ``line`` number, its ``id`` if it has one, and an ``error``, and the rest are still resolved.
+
+    python -m src.resolve_iris --config-dir ./configs iris.txt --output results.jsonl
+    cat iris.txt | python -m src.resolve_iris --workers 8 > results.jsonl
+"""
+import argparse
+import json
+import os
+import sys
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from itertools import islice
+from typing import Any, Deque, Dict, Iterable, Iterator, List, Optional, TextIO, Tuple
+
+from ._settings import settings
+from .functions.iri_configs import load_all_defs
+from .functions.iri_redirect import resolve_redir_match
+from .routers.iri_redirect_router import parse_pid_request
+from .routers.iri_request import FastRequest, RawHeaders
+
+# (line number, iri, accept, profile, id, error), the error is None for a good line
+ResolveItem = Tuple[int, Optional[str], Optional[str], Optional[str], Any, Optional[str]]
+
+# The loaded definitions of this process, set by init_resolver
+_state: Optional[Dict[str, Any]] = None
+_headers_cache: Dict[Tuple[Optional[str], Optional[str]], RawHeaders] = {}
+
+
+def init_resolver(config_dir: str, server_name: Optional[str]):
+    """Load the definitions in this process. Runs once in each worker process."""
+    global _state
+    settings["CONFIG_DEFS_DIRECTORY"] = config_dir
+    if server_name:
+        server_name = server_name.split("//", 1)[-1].split("/", 1)[0]
+    state = {
+        "conf_server_name": server_name or None,
+        "conf_debug": False,
+        "redir_timings": None,
+        "redir_metrics": None,
+    }
+    load_all_defs(state)
+    _state = state
+    _headers_cache.clear()
+
+
+def resolve_item(item: ResolveItem, scheme: str = "https") -> Dict[str, Any]:
+    (line_no, iri, accept, profile, item_id, error) = item
+    if error is not None:
+        result: Dict[str, Any] = {"iri": iri, "line": line_no}
+        if item_id is not None:
+            result["id"] = item_id
+        result.update({"status": 400, "location": None, "virtualhost": None, "rule": None, "error": error})
+        return result
+    try:
+        headers = _headers_cache[(accept, profile)]
+    except KeyError:
+        header_map = {}
+        if accept is not None:
+            header_map["accept"] = accept
+        if profile is not None:
+            header_map["accept-profile"] = profile
+        _headers_cache[(accept, profile)] = headers = RawHeaders.from_mapping(header_map)
+    result = {"iri": iri}
+    if item_id is not None:
+        result["id"] = item_id
+    request = FastRequest(None, headers, _state)
+    mut_query_params = {"_pid": iri}
+    try:
+        (proto, host_list, path) = parse_pid_request(scheme, mut_query_params, request)
+    except ValueError as e:
+        result.update({"status": 400, "location": None, "virtualhost": None, "rule": None, "error": str(e)})
+        return result
+    try:
+        ((status_code, location, message), virtualhost, rule) = resolve_redir_match(proto, host_list, path, mut_query_params, request)
+    except Exception as e:
+        result.update({"status": 500, "location": None, "virtualhost": None, "rule": None, "error": f"{type(e).__name__}: {e}"})
+        return result
+    result.update({
+        "status": status_code,
+        "location": location,
+        "virtualhost": virtualhost,
+        "rule": None if rule is None else rule.key,
+    })
+    if message is not None:
+        result["error"] = message
+    return result
+
+
+def resolve_chunk(items: List[ResolveItem]) -> List[str]:
+    """Resolve a chunk of items in a worker, giving their JSON lines."""
+    return [json.dumps(resolve_item(item), ensure_ascii=False) for item in items]
+
+
+def read_items(lines: Iterable[str]) -> Iterator[ResolveItem]:
+    for (line_no, line) in enumerate(lines, 1):
+        line = line.strip()
+        if not line:
+            continue
+        if not line.startswith("{"):
+            yield (line_no, line, None, None, None, None)
+            continue
+        try:
+            value = json.loads(line)
+        except json.JSONDecodeError as e:
+            yield (line_no, None, None, None, None, f"Bad JSON on line {line_no}: {e}")
+            continue
+        iri = value.get("iri", None)
+        if not isinstance(iri, str):
+            yield (line_no, None, None, None, value.get("id", None), f"Line {line_no} must be an IRI, or an object with an \"iri\" string.")
+            continue
+        accept = value.get("accept", None)
+        profile = value.get("profile", None)
+        if not (accept is None or isinstance(accept, str)) or not (profile is None or isinstance(profile, str)):
+            yield (line_no, iri, None, None, value.get("id", None), f"Line {line_no}: accept and profile must be strings.")
+            continue
+        yield (line_no, iri, accept, profile, value.get("id", None), None)
+
+
+def _chunks(items: Iterator[ResolveItem], size: int) -> Iterator[List[ResolveItem]]:
+    while True:
+        chunk = list(islice(items, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def resolve_stream(
+    lines: Iterable[str],
+    out: TextIO,
+    config_dir: str,
+    server_name: Optional[str] = None,
+    workers: int = 0,
+    chunk_size: int = 1000,
+) -> int:
+    """
+    Resolve the IRIs in ``lines`` and write their JSON lines to ``out``, in input order.
+    With ``workers`` > 1 the chunks are resolved in that many processes, with a bounded
+    number of chunks in flight, so the input is read as a stream. Returns the number of IRIs.
+    """
+    count = 0
+    chunks = _chunks(read_items(lines), chunk_size)
+    if workers <= 1:
+        init_resolver(config_dir, server_name)
+        for chunk in chunks:
+            for line in resolve_chunk(chunk):
+                out.write(line + "\n")
+            count += len(chunk)
+        return count
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_resolver, initargs=(config_dir, server_name)) as pool:
+        pending: Deque[Future] = deque()
+        for chunk in chunks:
+            pending.append(pool.submit(resolve_chunk, chunk))
+            count += len(chunk)
+            if len(pending) >= workers * 2:
+                for line in pending.popleft().result():
+                    out.write(line + "\n")
+        while pending:
+            for line in pending.popleft().result():
+                out.write(line + "\n")
+    return count
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("input", nargs="?", default="-", help="File of IRIs, one per line, or - for stdin")
+    parser.add_argument("--config-dir", default=settings["CONFIG_DEFS_DIRECTORY"])
+    parser.add_argument("--server-name", default=settings["SERVER_NAME"], help="Server name used for IRIs of unknown hosts")
+    parser.add_argument("--output", "-o", default="-", help="JSONL output file, or - for stdout")
+    parser.add_argument("--workers", "-j", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--chunk-size", type=int, default=1000)
+    args = parser.parse_args(argv)
+    config_dir = os.path.abspath(args.config_dir)
+    in_file = sys.stdin if args.input == "-" else open(args.input, "r", encoding="utf-8")
+    out_file = sys.stdout if args.output == "-" else open(args.output, "w", encoding="utf-8")
+    try:
+        count = resolve_stream(in_file, out_file, config_dir, args.server_name, args.workers, args.chunk_size)
+    finally:
+        if in_file is not sys.stdin:
+            in_file.close()
+        if out_file is not sys.stdout:
+            out_file.close()
+    print(f"Resolved {count} IRIs.", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
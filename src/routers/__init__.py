@@ -1 +1,3 @@
 from .iri_redirect_router import make_all_iri_redirect_routes
+from .iri_batch import make_batch_routes
+from .iri_redirect_fast import FastRedirectApp
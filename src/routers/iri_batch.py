@@ -0,0 +1,186 @@
+"""
+Batch IRI resolution, ``POST /redir/batch``.
+
+The request body is a JSON array, or NDJSON (one JSON value per line), of IRIs. Each item is
+either an IRI string, or an object with an ``iri`` and optional ``accept`` and ``profile``
+(sent as the Accept and Accept-Profile headers of that IRI) and ``id`` (echoed back).
+
+Each IRI is resolved like a ``/redir?_pid=...`` request. The items are grouped by the host of
+their IRI, so the requests for one host's RuleSet run together, and the request headers are
+made once per distinct accept/profile pair, so their conneg results are parsed once. The
+response is NDJSON, streamed as the items are resolved, one line per item in grouped order:
+
+    {"index": 0, "iri": "https://...", "status": 307, "location": "https://..."}
+
+``index`` is the item's position in the request. Items that can't be resolved have a
+``location`` of null and an ``error`` message. So do items that aren't an IRI string or an
+object with an ``iri`` string, and NDJSON lines that aren't JSON, with a status of 400, and the
+rest of the batch is still resolved.
+"""
+import asyncio
+import json
+from typing import Any, AsyncIterator, Dict, Iterator, List, Optional, Tuple
+
+from logging import getLogger
+
+from starlette.requests import Request
+from starlette.responses import PlainTextResponse, Response, StreamingResponse
+from starlette.routing import Route
+
+from .._settings import settings
+from .iri_redirect_router import pid_redir
+from .iri_request import FastRequest, RawHeaders
+
+# The root logger, this is overridden by Azure Function App logger.
+logger = getLogger()
+
+BATCH_ROUTE = "/redir/batch"
+NDJSON_CONTENT_TYPE = "application/x-ndjson"
+# Results are sent in chunks of this many lines, and the event loop is yielded to between chunks
+BATCH_CHUNK_SIZE = 256
+
+
+class BatchError(ValueError):
+    def __init__(self, message: str, status_code: int = 400):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+# (index, iri, accept, profile, id, error), the error is None for a good item
+BatchItem = Tuple[int, Optional[str], Optional[str], Optional[str], Any, Optional[str]]
+
+
+def parse_batch(body: bytes, content_type: Optional[str] = None) -> List[BatchItem]:
+    """
+    Parse a batch request body, as a JSON array or as NDJSON.
+    The format is taken from the content type, or from the first character of the body.
+    """
+    try:
+        text = body.decode("utf-8")
+    except UnicodeDecodeError:
+        raise BatchError("Batch request body must be UTF-8.")
+    media_type = (content_type or "").split(";", 1)[0].strip().lower()
+    # (value, or None with the error for an NDJSON line that isn't JSON)
+    values: List[Tuple[Any, Optional[str]]] = []
+    if media_type == "application/json" or (media_type not in (NDJSON_CONTENT_TYPE, "application/jsonl") and text.lstrip().startswith("[")):
+        try:
+            array = json.loads(text)
+        except json.JSONDecodeError as e:
+            raise BatchError(f"Bad JSON in batch request body: {e}")
+        if not isinstance(array, list):
+            raise BatchError("Batch request body must be a JSON array, or NDJSON.")
+        values = [(value, None) for value in array]
+    else:
+        for (line_no, line) in enumerate(text.splitlines(), 1):
+            if not line.strip():
+                continue
+            try:
+                values.append((json.loads(line), None))
+            except json.JSONDecodeError as e:
+                values.append((None, f"Bad JSON on line {line_no}: {e}"))
+    max_items = int(settings["REDIR_BATCH_MAX_ITEMS"])
+    if len(values) > max_items:
+        raise BatchError(f"Too many items in batch request, the limit is {max_items}.", 413)
+    items: List[BatchItem] = []
+    for i, (value, error) in enumerate(values):
+        if error is not None:
+            items.append((i, None, None, None, None, error))
+        elif isinstance(value, str):
+            items.append((i, value, None, None, None, None))
+        elif isinstance(value, dict) and isinstance(value.get("iri", None), str):
+            accept = value.get("accept", None)
+            profile = value.get("profile", None)
+            if not (accept is None or isinstance(accept, str)) or not (profile is None or isinstance(profile, str)):
+                items.append((i, value["iri"], None, None, value.get("id", None), "accept and profile must be strings."))
+            else:
+                items.append((i, value["iri"], accept, profile, value.get("id", None), None))
+        else:
+            item_id = value.get("id", None) if isinstance(value, dict) else None
+            items.append((i, None, None, None, item_id, "Batch item must be an IRI string or an object with an \"iri\" string."))
+    return items
+
+
+def _iri_host(iri: Optional[str]) -> str:
+    if iri is None:
+        return ""
+    host_path = iri.strip().split("://", 1)[-1]
+    return host_path.split("/", 1)[0].lower()
+
+
+def group_by_host(items: List[BatchItem]) -> List[BatchItem]:
+    """The items grouped by host, hosts in order of first appearance, items in order within each host."""
+    groups: Dict[str, List[BatchItem]] = {}
+    for item in items:
+        groups.setdefault(_iri_host(item[1]), []).append(item)
+    return [item for group in groups.values() for item in group]
+
+
+def resolve_batch(
+    items: List[BatchItem],
+    request_scheme: str,
+    request_host: Optional[str],
+    app_state: Dict[str, Any],
+) -> Iterator[Dict[str, Any]]:
+    """
+    Resolve the batch items, yielding a result for each, in grouped order.
+    ``request_host`` is the Host header of the batch request, used like on a ``/redir`` request.
+    """
+    # One set of headers per accept/profile pair, shared by all the items that use it
+    headers_cache: Dict[Tuple[Optional[str], Optional[str]], RawHeaders] = {}
+    for (index, iri, accept, profile, item_id, error) in group_by_host(items):
+        result: Dict[str, Any] = {"index": index, "iri": iri}
+        if item_id is not None:
+            result["id"] = item_id
+        if error is not None:
+            result.update({"status": 400, "location": None, "error": error})
+            yield result
+            continue
+        try:
+            headers = headers_cache[(accept, profile)]
+        except KeyError:
+            header_map = {}
+            if request_host is not None:
+                header_map["host"] = request_host
+            if accept is not None:
+                header_map["accept"] = accept
+            if profile is not None:
+                header_map["accept-profile"] = profile
+            headers_cache[(accept, profile)] = headers = RawHeaders.from_mapping(header_map)
+        try:
+            (status_code, location, message) = pid_redir(request_scheme, {"_pid": iri}, FastRequest(None, headers, app_state))
+        except Exception as e:
+            logger.exception(f"[REDIRS] Error resolving batch item {index}: {iri}")
+            (status_code, location, message) = (500, None, f"{type(e).__name__}: {e}")
+        result["status"] = status_code
+        result["location"] = location
+        if message is not None:
+            result["error"] = message
+        yield result
+
+
+async def stream_batch(results: Iterator[Dict[str, Any]]) -> AsyncIterator[bytes]:
+    """NDJSON chunks of the results, giving other requests a turn on the event loop between chunks."""
+    lines = []
+    for result in results:
+        lines.append(json.dumps(result, ensure_ascii=False))
+        if len(lines) >= BATCH_CHUNK_SIZE:
+            yield ("\n".join(lines) + "\n").encode("utf-8")
+            lines = []
+            await asyncio.sleep(0)
+    if lines:
+        yield ("\n".join(lines) + "\n").encode("utf-8")
+
+
+async def redir_batch(request: Request) -> Response:
+    try:
+        items = parse_batch(await request.body(), request.headers.get("content-type", None))
+    except BatchError as e:
+        return PlainTextResponse(str(e), status_code=e.status_code)
+    results = resolve_batch(items, request.url.scheme, request.headers.get("host", None), request.scope["state"])
+    return StreamingResponse(stream_batch(results), media_type=NDJSON_CONTENT_TYPE)
+
+
+def make_batch_routes() -> tuple[str, List[Route], Optional[Any]]:
+    return "", [
+        Route(BATCH_ROUTE, redir_batch, methods=["POST"], name="redir_batch", include_in_schema=False),
+    ], None
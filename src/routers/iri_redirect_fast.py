@@ -0,0 +1,206 @@
+"""
+Pure-ASGI fast path for the IRI redirect routes.
+
+``create_app(fast=True)`` returns a FastRedirectApp instead of a Starlette app. It serves the
+same routes as iri_redirect_router.py and iri_batch.py (``/redir``, ``/redir/batch`` and ``/{path:path}``)
+with the same responses, and runs the same lifespan and CORS policy (see src/cors.py). But it reads ``scope["headers"]`` and the query string
+once per request, calls the redirect resolver directly, and sends the response frames itself,
+without Starlette's Router, middleware stack, Request or Response objects.
+
+The routing, CORS and resolving is done by ``FastRedirectApp.respond``, which does not depend
+on ASGI, so the same app can also serve requests from other front-ends (see the native
+Azure Functions handler in patched_azure_function_app.py).
+"""
+import traceback
+from contextlib import AsyncExitStack
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from urllib.parse import parse_qsl
+
+from logging import getLogger
+
+from ..cors import TEXT_PLAIN, is_preflight, preflight_response, simple_headers
+from ..functions.iri_metrics import PROMETHEUS_CONTENT_TYPE
+from ..functions.iri_redirect import RedirResult
+from .iri_batch import BATCH_ROUTE, NDJSON_CONTENT_TYPE, BatchError, parse_batch, resolve_batch, stream_batch
+from .iri_redirect_router import get_metrics_route, index_redir, metrics_text, pid_redir
+from .iri_request import FastRequest, FastRequestState, RawHeaders
+
+# The root logger, this is overridden by Azure Function App logger.
+logger = getLogger()
+
+ROUTE_METHODS = ("GET", "HEAD", "OPTIONS")
+
+EMPTY_BODY = {"type": "http.response.body", "body": b""}
+TEXT_HTML = b"text/html; charset=utf-8"
+METRICS_CONTENT_TYPE = PROMETHEUS_CONTENT_TYPE.encode("latin-1")
+
+
+# (status code, headers, body)
+FastResponse = Tuple[int, List[Tuple[bytes, bytes]], bytes]
+
+
+def text_response(status_code: int, body: bytes, content_type: bytes, headers: List[Tuple[bytes, bytes]]) -> FastResponse:
+    return status_code, headers + [(b"content-length", str(len(body)).encode("latin-1")), (b"content-type", content_type)], body
+
+
+def result_response(result: RedirResult, extra_headers: List[Tuple[bytes, bytes]]) -> FastResponse:
+    """The response for a resolver result, as redir_response would make it."""
+    (status_code, location, message) = result
+    if location is None:
+        return text_response(status_code, message.encode("utf-8"), TEXT_HTML, extra_headers)
+    headers = [(b"location", location.encode("latin-1")), (b"content-length", b"0")]
+    if extra_headers:
+        headers.extend(extra_headers)
+    return status_code, headers, b""
+
+
+class FastRedirectApp:
+    """
+    A minimal ASGI app serving the IRI redirect routes.
+
+    ``lifespan`` is called with the app, like a Starlette lifespan, and the state it yields
+    is kept on the app and shared by all requests.
+    """
+
+    def __init__(self, *, lifespan: Optional[Callable] = None, root_path: str = "", debug: Any = False):
+        self.lifespan = lifespan
+        self.root_path = "" if root_path in (None, "", "/") else "/" + root_path.strip("/")
+        self.debug = debug
+        self.metrics_route = get_metrics_route()
+        self.state: Dict[str, Any] = {}
+        self._exit_stack: Optional[AsyncExitStack] = None
+
+    async def __call__(self, scope: dict, receive: Callable, send: Callable):
+        scope_type = scope["type"]
+        if scope_type == "http":
+            await self.handle(scope, receive, send)
+        elif scope_type == "lifespan":
+            await self.run_lifespan(scope, receive, send)
+        elif scope_type == "websocket":
+            await send({"type": "websocket.close", "code": 1000})
+
+    async def startup(self):
+        """Run the lifespan startup, and keep its state for the requests."""
+        self._exit_stack = AsyncExitStack()
+        if self.lifespan is not None:
+            maybe_state = await self._exit_stack.enter_async_context(self.lifespan(self))
+            if maybe_state is not None:
+                self.state = dict(maybe_state)
+
+    async def shutdown(self):
+        exit_stack, self._exit_stack = self._exit_stack, None
+        if exit_stack is not None:
+            await exit_stack.aclose()
+
+    async def run_lifespan(self, scope: dict, receive: Callable, send: Callable):
+        started = False
+        await receive()
+        try:
+            await self.startup()
+            if "state" in scope:
+                scope["state"].update(self.state)
+            await send({"type": "lifespan.startup.complete"})
+            started = True
+            await receive()
+            await self.shutdown()
+        except BaseException:
+            exc_text = traceback.format_exc()
+            if started:
+                await send({"type": "lifespan.shutdown.failed", "message": exc_text})
+            else:
+                await send({"type": "lifespan.startup.failed", "message": exc_text})
+            raise
+        else:
+            await send({"type": "lifespan.shutdown.complete"})
+
+    def route_path(self, path: str, scope_root_path: str = "") -> Optional[str]:
+        """The request path, within this app's root_path, or None if it is outside of it."""
+        if scope_root_path and path.startswith(scope_root_path) and path[len(scope_root_path):len(scope_root_path) + 1] in ("", "/"):
+            path = path[len(scope_root_path):]
+        root_path = self.root_path
+        if root_path:
+            if not path.startswith(root_path + "/"):
+                return None
+            path = path[len(root_path):]
+        return path
+
+    def respond(self, method: str, scheme: str, path: Optional[str], mut_query_params: Dict[str, str], headers: RawHeaders, scope: Optional[dict] = None) -> FastResponse:
+        """
+        The response to a request. ``path`` is the route path from ``route_path``,
+        ``mut_query_params`` the parsed query string, which the resolver may modify.
+        """
+        has_origin = "origin" in headers
+        if has_origin and is_preflight(method, headers):
+            return preflight_response(headers)
+        extra_headers = simple_headers(headers) if has_origin else []
+        if path is None:
+            return text_response(404, b"Not Found", TEXT_PLAIN, extra_headers)
+        elif path == self.metrics_route:
+            if method not in ("GET", "HEAD"):
+                return text_response(405, b"Method Not Allowed", TEXT_PLAIN, [(b"allow", b"GET, HEAD")] + extra_headers)
+            body = metrics_text(FastRequestState(self.state)).encode("utf-8")
+            return text_response(200, body, METRICS_CONTENT_TYPE, extra_headers)
+        elif method not in ROUTE_METHODS:
+            return text_response(
+                405, b"Method Not Allowed", TEXT_PLAIN, [(b"allow", ", ".join(ROUTE_METHODS).encode("latin-1"))] + extra_headers
+            )
+        request = FastRequest(scope, headers, self.state)
+        try:
+            if path == "/redir":
+                result = pid_redir(scheme, mut_query_params, request)
+            else:
+                result = index_redir(scheme, path[1:], mut_query_params, request)
+        except Exception:
+            logger.exception(f"[REDIRS] Error handling {method} {path}")
+            raise
+        stage_timer = request.state.stage_timer
+        if stage_timer is not None:
+            extra_headers = [(b"server-timing", stage_timer.server_timing().encode("latin-1"))] + extra_headers
+        return result_response(result, extra_headers)
+
+    async def handle_batch(self, scope: dict, receive: Callable, send: Callable):
+        """Serve a ``POST /redir/batch`` request, streaming the results like the Starlette route does."""
+        headers = RawHeaders(scope["headers"])
+        extra_headers = simple_headers(headers) if "origin" in headers else []
+        chunks = []
+        more_body = True
+        while more_body:
+            message = await receive()
+            if message["type"] == "http.disconnect":
+                return
+            chunks.append(message.get("body", b""))
+            more_body = message.get("more_body", False)
+        try:
+            items = parse_batch(b"".join(chunks), headers.get("content-type", None))
+        except BatchError as e:
+            (status_code, response_headers, body) = text_response(e.status_code, str(e).encode("utf-8"), TEXT_PLAIN, extra_headers)
+            await send({"type": "http.response.start", "status": status_code, "headers": response_headers})
+            await send({"type": "http.response.body", "body": body})
+            return
+        results = resolve_batch(items, scope.get("scheme", "http"), headers.get("host", None), self.state)
+        response_headers = [(b"content-type", NDJSON_CONTENT_TYPE.encode("latin-1"))] + extra_headers
+        await send({"type": "http.response.start", "status": 200, "headers": response_headers})
+        async for chunk in stream_batch(results):
+            await send({"type": "http.response.body", "body": chunk, "more_body": True})
+        await send({"type": "http.response.body", "body": b"", "more_body": False})
+
+    async def handle(self, scope: dict, receive: Callable, send: Callable):
+        if scope["method"] == "POST" and self.route_path(scope["path"], scope.get("root_path", "")) == BATCH_ROUTE:
+            await self.handle_batch(scope, receive, send)
+            return
+        try:
+            (status_code, headers, body) = self.respond(
+                scope["method"],
+                scope.get("scheme", "http"),
+                self.route_path(scope["path"], scope.get("root_path", "")),
+                dict(parse_qsl(scope["query_string"].decode("latin-1"), keep_blank_values=True)),
+                RawHeaders(scope["headers"]),
+                scope,
+            )
+        except Exception:
+            (status_code, headers, body) = text_response(500, b"Internal Server Error", TEXT_PLAIN, [])
+            await send({"type": "http.response.start", "status": status_code, "headers": headers})
+            await send({"type": "http.response.body", "body": body})
+            raise
+        await send({"type": "http.response.start", "status": status_code, "headers": headers})
+        await send(EMPTY_BODY if not body else {"type": "http.response.body", "body": body})
@@ -1,63 +1,76 @@
-from contextlib import asynccontextmanager
-from distutils.core import extension_keywords
-from selectors import SelectSelector
+import asyncio
+from contextlib import asynccontextmanager, suppress
 from typing import List, Any, Optional, Tuple, Dict
 from urllib.parse import parse_qsl
 
-from starlette.datastructures import Headers
-from starlette.routing import Router, Route, Mount
+from starlette.routing import Route
 from starlette.requests import Request
-from starlette.responses import HTMLResponse, Response
+from starlette.responses import Response
 from .._settings import settings
 
 from logging import getLogger
 
-from ..functions.iri_configs import load_all_defs
-from ..functions.iri_redirect import make_redir
+from ..functions.iri_access_log import AccessLog, make_access_log
+from ..functions.iri_cache import make_redir_cache
+from ..functions.iri_configs import RedirDefs, load_all_defs, watch_defs
+from ..functions.iri_headers import RawHeaders, redir_headers
+from ..functions.iri_metrics import PROMETHEUS_CONTENT_TYPE, RedirMetrics, render_prometheus
+from ..functions.iri_redirect import RedirResult, redir_response, request_stage_timer, resolve_redir
+from ..functions.iri_snapshot import load_snapshot_defs
+from ..functions.iri_timing import StageTimings
 
 # The root logger, this is overridden by Azure Function App logger.
 logger = getLogger()
 
-def parse_forwarded_request(headers: Headers) -> Tuple[Optional[str], Optional[str]]:
-    proto = None
-    host = None
-    forwarded_headers = headers.getlist("forwarded")
-    if len(forwarded_headers) > 0:
-        forwarded_str = forwarded_headers[0].split(",", 1)[0]
-        components = [x.strip() for x in forwarded_str.split(";")]
-        for c in components:
-            if host is None and c.startswith("host="):
-                host = c[5:]
-            elif proto is None and c.startswith("proto="):
-                proto = c[6:]
-    else:
-        forwarded_host_headers = headers.getlist("x-forwarded-host")
-        if len(forwarded_host_headers) > 0:
-            forwarded_host = forwarded_host_headers[0].split(",", 1)[0]
-            if forwarded_host:
-                forwarded_host = forwarded_host.split(":", 1)[0].strip().lower()
-                logger.debug(f"[REDIRS] Found Proxy Forwarded host: {forwarded_host}")
-                host = forwarded_host
-        forwarded_proto_headers = headers.getlist("x-forwarded-proto")
-        if len(forwarded_proto_headers) > 0:
-            proto = forwarded_proto_headers[0].split(",", 1)[0]
-            if proto:
-                proto = proto.strip().lower()
-        if proto is None:
-            forwarded_ssl_headers = headers.getlist("x-forwarded-ssl")
-            if len(forwarded_ssl_headers) > 0:
-                ssh_header = forwarded_ssl_headers[0].split(",", 1)[0].strip().lower()
-                if ssh_header in ("on", "true", "yes"):
-                    proto = "https"
-                elif ssh_header == ("off", "false", "no"):
-                    proto = "http"
+def parse_forwarded_request(headers: RawHeaders) -> Tuple[Optional[str], Optional[str]]:
+    """The (proto, host) from the proxy forwarding headers, each None if not given."""
+    (proto, host) = headers.forwarded_proto_host()
+    if host:
+        logger.debug("[REDIRS] Found Proxy Forwarded host: %s", host)
     return proto, host
 
-async def redir_for_pid(request: Request) -> Response:
+def append_request_hosts(host_list: List[str], headers: RawHeaders, app_domain_name: Optional[str]) -> Optional[str]:
+    """
+    Append the forwarded host and the Host header host to ``host_list``, in that order.
+    Returns the forwarded proto, or None.
+    """
+    forwarded_proto, forwarded_host = parse_forwarded_request(headers)
+    if forwarded_host:
+        host_list.append(forwarded_host)
+    head_host = headers.request_host()
+    if head_host is not None:
+        if head_host in ("", "localhost", "127.0.0.1", "127.0.1.1"):
+            logger.debug("[REDIRS] Detected possibly incorrect local Host header: %s", head_host)
+            # These are for local development purposes.
+            # We'll substitute the configured server name to emulate a real server.
+            if app_domain_name:
+                logger.debug("[REDIRS] Substituting server name: %s", app_domain_name)
+                host_list.append(app_domain_name)
+            else:
+                logger.debug("[REDIRS] No localhost substitution found. Falling back to %s.", head_host)
+                host_list.append(head_host)
+        else:
+            host_list.append(head_host)
+    # don't add fallback to `app_domain_name` or empty "" host in host_list
+    # because the make_redir will do that for us
+    return forwarded_proto
+
+def pid_redir(request_scheme: str, mut_query_params: Dict[str, str], request) -> RedirResult:
+    """The redirect for a /redir?_pid=... request. ``request`` is as for resolve_redir."""
+    try:
+        (proto, host_list, path) = parse_pid_request(request_scheme, mut_query_params, request)
+    except ValueError as e:
+        return 400, None, str(e)
+    return resolve_redir(proto, host_list, path, mut_query_params, request)
+
+def parse_pid_request(request_scheme: str, mut_query_params: Dict[str, str], request) -> Tuple[str, List[str], str]:
+    """
+    The (proto, host list, path) to resolve for a /redir?_pid=... request.
+    Raises ValueError, with the message for a 400 response, if there is no valid PID IRI.
+    """
     app_domain_name = request.state.conf_server_name
     app_debug = request.state.conf_debug
     host_list = []
-    mut_query_params: Dict[str, str] = {k: v for k, v in request.query_params.items()}
     if "_host" in mut_query_params:
         host_list.append(mut_query_params["_host"].strip().lower())
         del mut_query_params["_host"]
@@ -68,8 +81,7 @@ async def redir_for_pid(request: Request) -> Response:
         iri = mut_query_params["iri"].strip()
         # Don't remove iri from query params, it could be used for other purposes.
     else:
-        return HTMLResponse(status_code=400, content="Missing iri parameter or _pid query parameter.")
-    request_scheme = request.url.scheme
+        raise ValueError("Missing iri parameter or _pid query parameter.")
     proto_split = iri.split("://", 1)
     if len(proto_split) > 1:
         proto = proto_split[0]
@@ -80,74 +92,55 @@ async def redir_for_pid(request: Request) -> Response:
 
     host_path_split = host_path.split("/", 1)
     if len(host_path_split) < 2:
-        return HTMLResponse(status_code=400, content="Invalid PID URI given for redirect.")
+        raise ValueError("Invalid PID URI given for redirect.")
     host_list.append(host_path_split[0])
     path = str(host_path_split[1]).lstrip("/")
     if "?" in path:
         path, query = path.split("?", 1)
         new_query_vals = dict(parse_qsl(query, keep_blank_values=True))
         mut_query_params.update(new_query_vals)
-    forwarded_proto, forwarded_host = parse_forwarded_request(request.headers)
-    if forwarded_host:
-        host_list.append(forwarded_host)
-    host_headers = request.headers.getlist("host")
-    if len(host_headers) > 0:
-        head_host = host_headers[0].split(",", 1)[0]
-        head_host = head_host.split(":", 1)[0].strip().lower()
-        if head_host in ("", "localhost", "127.0.0.1", "127.0.1.1"):
-            logger.debug(f"[REDIRS] Detected possibly incorrect local Host header: {head_host}")
-            # These are for local development purposes.
-            # We'll substitute the configured server name to emulate a real server.
-            if app_domain_name:
-                logger.debug(f"[REDIRS] Substituting server name: {app_domain_name}")
-                host_list.append(app_domain_name)
-            else:
-                logger.debug(f"[REDIRS] No localhost substitution found. Falling back to {head_host}.")
-                host_list.append(head_host)
-        else:
-            host_list.append(head_host)
+    append_request_hosts(host_list, redir_headers(request), app_domain_name)
+    return proto, host_list, path
 
-    # don't add fallback to `app_domain_name` or empty "" host in host_list
-    # because the make_redir will do that for us
-    return await make_redir(proto, host_list, path, mut_query_params, request)
-
-async def index(request: Request) -> Response:
+def index_redir(request_scheme: str, path: str, mut_query_params: Dict[str, str], request) -> RedirResult:
+    """The redirect for a request to an IRI path on this server. ``request`` is as for resolve_redir."""
     app_domain_name = request.state.conf_server_name
     app_debug = request.state.conf_debug
+    host_list = []
+    if "_host" in mut_query_params:
+        host_list.append(mut_query_params["_host"].strip().lower())
+        del mut_query_params["_host"]
+    forwarded_proto = append_request_hosts(host_list, redir_headers(request), app_domain_name)
+    proto = request_scheme if not forwarded_proto else forwarded_proto
+    return resolve_redir(proto, host_list, path, mut_query_params, request)
+
+async def redir_for_pid(request: Request) -> Response:
+    mut_query_params: Dict[str, str] = {k: v for k, v in request.query_params.items()}
+    result = pid_redir(request.url.scheme, mut_query_params, request)
+    return redir_response(result, request_stage_timer(request))
+
+async def index(request: Request) -> Response:
     mut_query_params: Dict[str, str] = {k: v for k, v in request.query_params.items()}
     # Note, path does not include leading slash, but may have a trailing slash
     # /datasets/bdr => datasets/bdr
     # /hello/ => hello/
     # / => ""
     path: str = request.path_params.get("path", "")
-    request_scheme: str = request.url.scheme
-    host_list = []
-    if "_host" in mut_query_params:
-        host_list.append(mut_query_params["_host"].strip().lower())
-        del mut_query_params["_host"]
-    forwarded_host, forwarded_proto = parse_forwarded_request(request.headers)
-    if forwarded_host:
-        host_list.append(forwarded_host)
-    proto = request_scheme if not forwarded_proto else forwarded_proto
-    host_headers = request.headers.getlist("host")
-    if len(host_headers) > 0:
-        head_host = host_headers[0].split(",", 1)[0]
-        head_host = head_host.split(":", 1)[0].strip().lower()
-        if head_host in ("", "localhost", "127.0.0.1", "127.0.1.1"):
-            logger.debug(f"[REDIRS] Detected possibly incorrect local Host header: {head_host}")
-            # These are for local development purposes.
-            # We'll substitute the configured server name to emulate a real server.
-            if app_domain_name:
-                logger.debug(f"[REDIRS] Substituting server name: {app_domain_name}")
-                host_list.append(app_domain_name)
-            else:
-                logger.debug(f"[REDIRS] No localhost substitution found. Falling back to {head_host}.")
-                host_list.append(head_host)
-        else:
-            host_list.append(head_host)
-    # don't add fallback to `app_domain_name` or empty "" host in host_list
-    # because the make_redir will do that for us
-    return await make_redir(proto, host_list, path, mut_query_params, request)
+    result = index_redir(request.url.scheme, path, mut_query_params, request)
+    return redir_response(result, request_stage_timer(request))
+
+def metrics_text(state) -> str:
+    """The metrics for the Prometheus admin route. ``state`` is a request's state."""
+    return render_prometheus(state.redir_metrics, state.redir_timings, state.redir_defs.redir_cache)
+
+async def metrics(request: Request) -> Response:
+    return Response(metrics_text(request.state), media_type=PROMETHEUS_CONTENT_TYPE)
+
+def get_metrics_route() -> Optional[str]:
+    """The path of the metrics admin route, or None when REDIR_METRICS is off."""
+    if settings['REDIR_METRICS'] in ("true", "TRUE", 'T', True, "1", 1, "True"):
+        return "/" + settings['METRICS_ROUTE'].strip("/")
+    return None
 
 @asynccontextmanager
 async def lifespan(app: Optional[Any]):
@@ -164,18 +157,51 @@ async def lifespan(app: Optional[Any]):
     state = {}
     state["conf_server_name"] = conf_server_name
     state["conf_debug"] = is_debug
-    load_all_defs(state)
+    if settings['REDIR_TIMING'] in ("true", "TRUE", 'T', True, "1", 1, "True"):
+        logger.info(f"[REDIRS] Timing redirect stages, with Server-Timing headers.")
+        state["redir_timings"] = StageTimings()
+    else:
+        state["redir_timings"] = None
+    if settings['REDIR_METRICS'] in ("true", "TRUE", 'T', True, "1", 1, "True"):
+        logger.info(f"[REDIRS] Counting redirects for the metrics route: {get_metrics_route()}")
+        state["redir_metrics"] = RedirMetrics()
+    else:
+        state["redir_metrics"] = None
+    access_log: Optional[AccessLog] = None
+    if settings['ACCESS_LOG'] in ("true", "TRUE", 'T', True, "1", 1, "True"):
+        access_log = make_access_log(
+            settings['ACCESS_LOG_FILE'], float(settings['ACCESS_LOG_SAMPLE']),
+            int(settings['ACCESS_LOG_BATCH']), float(settings['ACCESS_LOG_FLUSH_INTERVAL']),
+        )
+        logger.info(f"[REDIRS] Writing the access log to: {settings['ACCESS_LOG_FILE'] or 'stderr'}")
+        access_log.start()
+    state["redir_access_log"] = access_log
+    state["redir_defs"] = redir_defs = RedirDefs(
+        redir_cache=make_redir_cache(settings["REDIR_CACHE_SIZE"], settings["REDIR_CACHE_TTL"])
+    )
+    if not load_snapshot_defs(redir_defs, settings["CONFIG_SNAPSHOT_FILE"]):
+        load_all_defs(state)
+    watch_task: Optional[asyncio.Task] = None
+    if settings['WATCH_CONFIGS'] in ("true", "TRUE", 'T', True, "1", 1, "True"):
+        watch_task = asyncio.create_task(watch_defs(redir_defs, float(settings['WATCH_CONFIGS_INTERVAL'])))
     try:
         # Now pass back to the request handler to serve requests
         yield state
     finally:
         # Server is shutting down, cleanup
-        pass
+        if watch_task is not None:
+            watch_task.cancel()
+            with suppress(asyncio.CancelledError):
+                await watch_task
+        if access_log is not None:
+            access_log.stop()
 
 
 def make_all_iri_redirect_routes() -> tuple[str,List[Route], Optional[Any]]:
-
-    return "", [
-        Route("/redir", redir_for_pid, methods=["GET", "OPTIONS", "HEAD"], name="redir", include_in_schema=False),
-        Route("/{path:path}", index, methods=["GET", "OPTIONS", "HEAD"], name="handler", include_in_schema=False)
-    ], lifespan
+    routes = [Route("/redir", redir_for_pid, methods=["GET", "OPTIONS", "HEAD"], name="redir", include_in_schema=False)]
+    metrics_route = get_metrics_route()
+    if metrics_route is not None:
+        # Must come before the catch-all route
+        routes.append(Route(metrics_route, metrics, methods=["GET", "HEAD"], name="metrics", include_in_schema=False))
+    routes.append(Route("/{path:path}", index, methods=["GET", "OPTIONS", "HEAD"], name="handler", include_in_schema=False))
+    return "", routes, lifespan
@@ -0,0 +1,36 @@
+"""
+Lightweight stand-ins for Starlette's Request and Headers, for calling the redirect resolver
+outside of a Starlette route: from the fast path, the native Azure Functions handler and the
+batch route.
+"""
+from typing import Any, Dict, Optional
+
+from ..functions.iri_headers import RawHeaders
+
+
+class FastRequestState:
+    __slots__ = (
+        "conf_server_name", "conf_debug", "redir_defs", "redir_timings", "redir_metrics", "redir_access_log", "stage_timer",
+        "client_requested_path", "target_path",
+    )
+
+    def __init__(self, app_state: Dict[str, Any]):
+        self.conf_server_name = app_state["conf_server_name"]
+        self.conf_debug = app_state["conf_debug"]
+        self.redir_defs = app_state["redir_defs"]
+        self.redir_timings = app_state.get("redir_timings", None)
+        self.redir_metrics = app_state.get("redir_metrics", None)
+        self.redir_access_log = app_state.get("redir_access_log", None)
+        self.stage_timer = None
+        self.client_requested_path = None
+        self.target_path = None
+
+
+class FastRequest:
+    """Stands in for a Starlette Request, for resolve_redir and the dest functions."""
+    __slots__ = ("scope", "headers", "state")
+
+    def __init__(self, scope: Optional[dict], headers: RawHeaders, app_state: Dict[str, Any]):
+        self.scope = scope
+        self.headers = headers
+        self.state = FastRequestState(app_state)
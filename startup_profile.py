@@ -0,0 +1,73 @@
+"""
+Cold-start profiling for the Function App.
+
+Set the STARTUP_PROFILE environment variable (app setting) to "true" to log how long each
+module takes to import during startup, and how long it takes until the app is ready to
+answer its first request. This module must not import anything from ``src``, because it is
+enabled before ``src`` is imported, so that those imports are measured too.
+"""
+import builtins
+import os
+import sys
+import time
+from importlib.util import resolve_name
+from logging import Logger
+from typing import List, Tuple
+
+_orig_import = builtins.__import__
+_started_at = time.perf_counter()
+# (module name, import depth, cumulative seconds), in the order the imports finished
+_import_times: List[Tuple[str, int, float]] = []
+_depth = 0
+enabled = False
+
+
+def _timed_import(name, globals=None, locals=None, fromlist=(), level=0):
+    global _depth
+    if level > 0:
+        try:
+            full_name = resolve_name("." * level + name, (globals or {}).get("__package__", None))
+        except (ImportError, ValueError):
+            full_name = name
+    else:
+        full_name = name
+    if full_name in sys.modules:
+        return _orig_import(name, globals, locals, fromlist, level)
+    t0 = time.perf_counter()
+    _depth += 1
+    try:
+        return _orig_import(name, globals, locals, fromlist, level)
+    finally:
+        _depth -= 1
+        _import_times.append((full_name, _depth, time.perf_counter() - t0))
+
+
+def enable_if_configured() -> bool:
+    """Start timing imports, if STARTUP_PROFILE is set."""
+    global enabled, _started_at
+    if enabled:
+        return True
+    if os.getenv("STARTUP_PROFILE", "").lower() not in ("true", "1", "t", "yes"):
+        return False
+    enabled = True
+    _started_at = time.perf_counter()
+    builtins.__import__ = _timed_import
+    return True
+
+
+def report_imports(logger: Logger, top: int = 30):
+    """Log the slowest imports seen so far, by cumulative time, and stop timing imports."""
+    if not enabled:
+        return
+    builtins.__import__ = _orig_import
+    total = sum(t for (_, depth, t) in _import_times if depth == 0)
+    logger.info(f"[STARTUP] {len(_import_times)} modules imported in {total * 1000.0:.1f} ms")
+    for (name, depth, t) in sorted(_import_times, key=lambda x: x[2], reverse=True)[:top]:
+        logger.info(f"[STARTUP] import {t * 1000.0:9.2f} ms {'  ' * depth}{name}")
+
+
+def mark(logger: Logger, label: str):
+    """Log the time since startup profiling was enabled."""
+    if not enabled:
+        return
+    logger.info(f"[STARTUP] {label} after {(time.perf_counter() - _started_at) * 1000.0:.1f} ms")
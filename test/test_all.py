@@ -1,3 +1,5 @@
+import os
+import time
 from pathlib import Path
 from tomli import load as load_toml
 try:
@@ -20,6 +22,16 @@ from src.factory import create_app
 from src import settings
 settings["CONFIG_DEFS_DIRECTORY"] = str(tests_dir / "configs")
 
+
+@pytest.fixture
+def set_settings(monkeypatch):
+    """Sets ``settings`` keys for one test, the old values are put back after it."""
+    def set_settings(values: dict):
+        for (k, v) in values.items():
+            monkeypatch.setitem(settings, k, v)
+    return set_settings
+
+
 test_files_dir = tests_dir / "test_files"
 all_files = list(test_files_dir.glob("*.toml"))
 
@@ -37,13 +49,14 @@ for test_file in all_files:
         test_data.append((_host, _test_redirects, _kwargs))
 
 @pytest.mark.asyncio
+@pytest.mark.parametrize("fast", [False, True], ids=["starlette", "fast"])
 @pytest.mark.parametrize("host, test_redirects, kwargs", test_data)
-async def test_redirects(host, test_redirects, kwargs):
+async def test_redirects(host, test_redirects, kwargs, fast):
     settings["SERVER_NAME"] = host
     host_aliases = kwargs.get("host_aliases", [])
     default_redirect_code = kwargs.get("default_redirect_code", 307)
     default_scheme = kwargs.get("default_scheme", "http")
-    app = create_app()
+    app = create_app(fast=fast)
     with TestClient(app=app, root_path="") as client:
         for t_def in test_redirects:
             from_ = t_def['from']
@@ -62,3 +75,394 @@ async def test_redirects(host, test_redirects, kwargs):
             assert loc_parts[0].lower() == to_.lower()
 
 
+
+
+def test_fast_app_matches_starlette():
+    settings["SERVER_NAME"] = "linked.data.gov.au"
+    requests = [
+        ("GET", "https://linked.data.gov.au/dataset/bdr/orgs", {"accept": "text/html"}),
+        ("HEAD", "https://linked.data.gov.au/dataset/bdr?_foo=bar", {"accept": "text/turtle"}),
+        ("GET", "https://linked.data.gov.au/not/a/path", {}),
+        ("GET", "https://linked.data.gov.au/redir?_pid=https://linked.data.gov.au/dataset/bdr/orgs/wamuseum", {}),
+        ("GET", "https://linked.data.gov.au/redir", {}),
+        ("GET", "https://linked.data.gov.au/dataset/bdr", {"origin": "https://example.com"}),
+        ("GET", "https://linked.data.gov.au/dataset/bdr", {"origin": "https://example.com", "cookie": "a=b"}),
+        ("OPTIONS", "https://linked.data.gov.au/dataset/bdr", {}),
+        ("OPTIONS", "https://linked.data.gov.au/dataset/bdr", {
+            "origin": "https://example.com", "access-control-request-method": "GET",
+            "access-control-request-headers": "accept, accept-profile",
+        }),
+        ("OPTIONS", "https://linked.data.gov.au/dataset/bdr", {
+            "origin": "https://example.com", "access-control-request-method": "FETCH",
+        }),
+    ]
+    responses = {}
+    for fast in (False, True):
+        with TestClient(app=create_app(fast=fast), root_path="") as client:
+            responses[fast] = [
+                client.request(method, url, headers=headers, follow_redirects=False)
+                for (method, url, headers) in requests
+            ]
+    for slow, fast in zip(responses[False], responses[True]):
+        assert fast.status_code == slow.status_code
+        assert fast.content == slow.content
+        assert dict(fast.headers) == dict(slow.headers)
+
+
+def test_static_cors_matches_starlette_cors():
+    from starlette.applications import Starlette
+    from starlette.middleware import Middleware
+    from starlette.middleware.cors import CORSMiddleware
+    from starlette.responses import Response
+    from starlette.routing import Route
+    from src.cors import StaticCORSMiddleware
+    calls = []
+
+    async def redirect(request):
+        calls.append(request.method)
+        return Response(None, status_code=307, headers={"Location": "https://example.org/"})
+
+    routes = [Route("/{path:path}", redirect, methods=["GET", "OPTIONS", "HEAD"])]
+    starlette_cors = Middleware(
+        CORSMiddleware, allow_origins=["*"], allow_credentials=True,
+        allow_methods=["*"], allow_headers=["*"], expose_headers=["*"],
+    )
+    requests = [
+        ("GET", {}),
+        ("GET", {"origin": "https://example.com"}),
+        ("HEAD", {"origin": "https://example.com", "cookie": "a=b"}),
+        ("OPTIONS", {"origin": "https://example.com"}),
+        ("OPTIONS", {"origin": "https://example.com", "access-control-request-method": "GET"}),
+        ("OPTIONS", {"origin": "https://example.com", "access-control-request-method": "GET", "access-control-request-headers": "Accept, X-Foo"}),
+        ("OPTIONS", {"origin": "https://example.com", "access-control-request-method": "FETCH"}),
+        ("OPTIONS", {"origin": "https://example.com", "access-control-request-method": "GET", "access-control-request-private-network": "true"}),
+    ]
+    responses = {}
+    for middleware in (starlette_cors, Middleware(StaticCORSMiddleware)):
+        calls.clear()
+        with TestClient(Starlette(routes=routes, middleware=[middleware])) as client:
+            responses[middleware.cls] = [
+                client.request(method, "http://example.com/a", headers=headers, follow_redirects=False)
+                for (method, headers) in requests
+            ]
+        # Preflight requests are answered by the middleware
+        assert calls == ["GET", "GET", "HEAD", "OPTIONS"]
+    for expected, resp in zip(responses[CORSMiddleware], responses[StaticCORSMiddleware]):
+        assert resp.status_code == expected.status_code
+        assert resp.content == expected.content
+        assert dict(resp.headers) == dict(expected.headers)
+
+
+def test_native_function_handler():
+    func = pytest.importorskip("azure.functions")
+    from patched_azure_function_app import NativeRedirectFunctionApp
+    import asyncio
+    settings["SERVER_NAME"] = "linked.data.gov.au"
+    requests = [
+        ("https://linked.data.gov.au/dataset/bdr/orgs/wamuseum?_foo=bar", {"accept": "text/html"}),
+        ("https://linked.data.gov.au/dataset/bdr", {"origin": "https://example.com"}),
+        ("https://linked.data.gov.au/not/a/path", {}),
+    ]
+    fn_app = NativeRedirectFunctionApp(redirect_app=create_app(fast=True), http_auth_level=func.AuthLevel.ANONYMOUS)
+    http_app_func = fn_app.get_functions()[0].get_user_function()
+
+    async def native_responses():
+        responses = []
+        for (url, headers) in requests:
+            params = dict(p.split("=", 1) for p in url.split("?", 1)[1].split("&")) if "?" in url else {}
+            req = func.HttpRequest("GET", url, headers={"host": "linked.data.gov.au", **headers}, params=params, body=b"")
+            responses.append(await http_app_func(req, None))
+        await fn_app.redirect_app.shutdown()
+        return responses
+    native = asyncio.run(native_responses())
+    with TestClient(app=create_app(), root_path="") as client:
+        for (url, headers), native_resp in zip(requests, native):
+            resp = client.get(url, headers=headers, follow_redirects=False)
+            assert native_resp.status_code == resp.status_code
+            assert native_resp.get_body() == resp.content
+            for k in ("location", "content-type", "access-control-allow-origin"):
+                assert native_resp.headers.get(k, None) == resp.headers.get(k, None)
+
+
+def test_native_function_handler_content_headers(monkeypatch):
+    func = pytest.importorskip("azure.functions")
+    from patched_azure_function_app import NativeRedirectFunctionApp
+    import asyncio
+    import gzip
+    settings["SERVER_NAME"] = "linked.data.gov.au"
+    fn_app = NativeRedirectFunctionApp(redirect_app=create_app(fast=True), http_auth_level=func.AuthLevel.ANONYMOUS)
+    http_app_func = fn_app.get_functions()[0].get_user_function()
+
+    def request(path, **headers):
+        return func.HttpRequest("GET", "https://linked.data.gov.au" + path, headers={"host": "linked.data.gov.au", **headers}, body=b"")
+
+    async def native_responses():
+        redirect = await http_app_func(request("/dataset/bdr/orgs/wamuseum", accept="text/turtle"), None)
+        body = gzip.compress(b"not found")
+        monkeypatch.setattr(fn_app.redirect_app, "respond", lambda *args, **kwargs: (
+            404, [(b"content-type", b"text/plain; charset=iso-8859-1"), (b"content-encoding", b"gzip")], body,
+        ))
+        encoded = await http_app_func(request("/not/a/path"), None)
+        await fn_app.redirect_app.shutdown()
+        return redirect, encoded, body
+    (redirect, encoded, body) = asyncio.run(native_responses())
+    # A bodyless redirect has no Content-Type header, and no charset is made up for it
+    assert redirect.status_code == 307 and redirect.headers.get("location", "").startswith("https://")
+    assert "content-type" not in redirect.headers and redirect.charset == "utf-8"
+    # The content coding stays in Content-Encoding, the charset comes from the Content-Type
+    assert encoded.headers["content-encoding"] == "gzip" and encoded.get_body() == body
+    assert (encoded.mimetype, encoded.charset) == ("text/plain", "iso-8859-1")
+    assert encoded.headers["content-type"] == "text/plain; charset=iso-8859-1"
+
+
+def test_redirect_cache():
+    settings["SERVER_NAME"] = "linked.data.gov.au"
+    app = create_app()
+    with TestClient(app=app, root_path="") as client:
+        redir_cache = client.app_state["redir_defs"].redir_cache
+        url = "https://linked.data.gov.au/dataset/bdr/orgs/wamuseum"
+        locations = []
+        for accept in ("text/turtle", "text/turtle", "text/html"):
+            resp = client.get(url, headers={"accept": accept}, follow_redirects=False)
+            assert resp.status_code == 307
+            locations.append(resp.headers["location"])
+        assert locations[0] == locations[1] != locations[2]
+        assert redir_cache.hits == 1
+        assert redir_cache.misses == 2
+        # The key is the negotiated inputs: spacing and the order of equal q-values don't matter,
+        # and other query params are appended to the cached Location of a qsa rule
+        for (accept, params) in (
+            ("text/turtle,application/ld+json;q=0.5", {}),
+            ("application/ld+json; q=0.5, text/turtle", {"utm_source": "a"}),
+        ):
+            resp = client.get(url, params=params, headers={"accept": accept}, follow_redirects=False)
+            locations.append(resp.headers["location"])
+        assert redir_cache.hits == 2 and redir_cache.misses == 3
+        assert locations[4] == locations[3] + "?utm_source=a"
+
+
+def test_watch_configs_reload(tmp_path, set_settings):
+    conf_file = tmp_path / "test.toml"
+    conf_file.write_text('[default]\nvirtualhost = "example.com"\n[redirects]\n"a" = "https://example.org/one"\n')
+    set_settings({
+        "SERVER_NAME": "example.com", "CONFIG_DEFS_DIRECTORY": str(tmp_path),
+        "WATCH_CONFIGS": "true", "WATCH_CONFIGS_INTERVAL": "0.05",
+    })
+    app = create_app()
+    with TestClient(app=app, root_path="") as client:
+        resp = client.get("http://example.com/a", follow_redirects=False)
+        assert resp.headers["location"] == "https://example.org/one"
+        snapshot = client.app_state["redir_defs"].current
+        conf_file.write_text('[default]\nvirtualhost = "example.com"\n[redirects]\n"a" = "https://example.org/two"\n')
+        os.utime(conf_file, (time.time() + 10, time.time() + 10))
+        for _ in range(100):
+            if client.app_state["redir_defs"].current is not snapshot:
+                break
+            time.sleep(0.05)
+        resp = client.get("http://example.com/a", follow_redirects=False)
+        assert resp.headers["location"] == "https://example.org/two"
+
+
+@pytest.mark.parametrize("fast", [False, True], ids=["starlette", "fast"])
+def test_redirect_stage_timing(fast, set_settings):
+    set_settings({"SERVER_NAME": "linked.data.gov.au", "REDIR_TIMING": "true", "REDIR_CACHE_SIZE": "0"})
+    app = create_app(fast=fast)
+    with TestClient(app=app, root_path="") as client:
+        redir_timings = client.app_state["redir_timings"]
+        resp = client.get("https://linked.data.gov.au/dataset/bdr/orgs/wamuseum", headers={"accept": "text/turtle"}, follow_redirects=False)
+        assert resp.status_code == 307
+        stages = [part.split(";", 1)[0] for part in resp.headers["server-timing"].split(", ")]
+        assert stages[0] == "cache" and stages[-1] == "total"
+        assert "host" in stages and "finish" in stages
+        resp = client.get("https://linked.data.gov.au/not/a/path", follow_redirects=False)
+        assert resp.status_code == 404
+        assert "server-timing" in resp.headers
+        histograms = redir_timings.snapshot()
+        (counts, count, sum_ns) = histograms["total"]
+        assert count == 2 == sum(counts)
+        assert sum_ns > 0
+
+
+@pytest.mark.parametrize("fast", [False, True], ids=["starlette", "fast"])
+def test_metrics_route(fast, set_settings):
+    set_settings({"SERVER_NAME": "linked.data.gov.au", "REDIR_METRICS": "true"})
+    app = create_app(fast=fast)
+    with TestClient(app=app, root_path="") as client:
+        url = "https://linked.data.gov.au/dataset/bdr/orgs/wamuseum"
+        for _ in range(3):
+            # The second and third requests are served from the redirect cache
+            resp = client.get(url, headers={"accept": "text/turtle"}, follow_redirects=False)
+            assert resp.status_code == 307
+        resp = client.get("https://linked.data.gov.au/not/a/path", follow_redirects=False)
+        assert resp.status_code == 404
+        resp = client.get("https://linked.data.gov.au/_admin/metrics")
+        assert resp.status_code == 200
+        assert resp.headers["content-type"] == "text/plain; version=0.0.4; charset=utf-8"
+        lines = resp.text.splitlines()
+        hits = [l for l in lines if l.startswith("iri_redir_rule_hits_total{")]
+        assert len(hits) == 1 and hits[0].endswith(" 3")
+        assert 'virtualhost="linked.data.gov.au"' in hits[0]
+        assert any(l.startswith("iri_redir_dest_hits_total{") and l.endswith(" 3") for l in lines)
+        assert 'iri_redir_not_found_total{virtualhost="linked.data.gov.au"} 1' in lines
+        assert any(l.startswith("iri_redir_rule_duration_seconds_bucket{") and 'le="+Inf"' in l and l.endswith(" 3") for l in lines)
+        assert "iri_redir_cache_hits_total 2" in lines
+        assert client.post("https://linked.data.gov.au/_admin/metrics").status_code == 405
+
+
+@pytest.mark.parametrize("fast", [False, True], ids=["starlette", "fast"])
+def test_access_log(fast, tmp_path, set_settings):
+    import json
+    log_file = tmp_path / "access.ndjson"
+    set_settings({"SERVER_NAME": "linked.data.gov.au", "ACCESS_LOG": "true", "ACCESS_LOG_FILE": str(log_file), "ACCESS_LOG_BATCH": "2"})
+    app = create_app(fast=fast)
+    with TestClient(app=app, root_path="") as client:
+        for _ in range(2):
+            resp = client.get("https://linked.data.gov.au/dataset/bdr/orgs/wamuseum", headers={"accept": "text/turtle"}, follow_redirects=False)
+            assert resp.status_code == 307
+        resp = client.get("https://linked.data.gov.au/not/a/path", follow_redirects=False)
+        assert resp.status_code == 404
+    # The last record is written when the app shuts down
+    records = [json.loads(line) for line in log_file.read_text().splitlines()]
+    assert [r["status"] for r in records] == [307, 307, 404]
+    assert records[0]["host"] == "linked.data.gov.au" and records[0]["path"] == "dataset/bdr/orgs/wamuseum"
+    assert records[0]["rule"] is not None and records[0]["location"].startswith("https://")
+    assert records[2]["rule"] is None and records[2]["location"] is None
+    assert all(r["duration_us"] > 0 for r in records)
+
+
+@pytest.mark.parametrize("fast", [False, True], ids=["starlette", "fast"])
+def test_batch_route(fast):
+    import json
+    settings["SERVER_NAME"] = "linked.data.gov.au"
+    items = [
+        "https://linked.data.gov.au/dataset/bdr/orgs/wamuseum",
+        {"iri": "https://linked.data.gov.au/dataset/bdr", "accept": "text/turtle", "id": "a"},
+        {"iri": "https://example.com/not/a/path"},
+        {"iri": "https://linked.data.gov.au/dataset/bdr", "accept": "text/html"},
+        "not-an-iri",
+    ]
+    app = create_app(fast=fast)
+    with TestClient(app=app, root_path="") as client:
+        expected = []
+        for item in items:
+            (iri, accept) = (item, None) if isinstance(item, str) else (item["iri"], item.get("accept", None))
+            resp = client.get("https://linked.data.gov.au/redir", params={"_pid": iri},
+                              headers={} if accept is None else {"accept": accept}, follow_redirects=False)
+            expected.append((resp.status_code, resp.headers.get("location", None)))
+        for body, content_type in (
+            (json.dumps(items), "application/json"),
+            ("\n".join(json.dumps(i) for i in items), "application/x-ndjson"),
+        ):
+            resp = client.post("https://linked.data.gov.au/redir/batch", content=body, headers={"content-type": content_type})
+            assert resp.status_code == 200
+            assert resp.headers["content-type"] == "application/x-ndjson"
+            results = [json.loads(line) for line in resp.text.splitlines()]
+            # Grouped by host, in order of first appearance
+            assert [r["index"] for r in results] == [0, 1, 3, 2, 4]
+            assert results[1]["id"] == "a"
+            for r in results:
+                assert (r["status"], r["location"]) == expected[r["index"]]
+            assert "error" in results[3] and "error" in results[4]
+        # Bad items and bad NDJSON lines get error lines, the rest are still resolved
+        body = "\n".join(('{"iri": 1, "id": "b"}', "{not json", json.dumps(items[0])))
+        resp = client.post("https://linked.data.gov.au/redir/batch", content=body, headers={"content-type": "application/x-ndjson"})
+        assert resp.status_code == 200
+        results = {r["index"]: r for r in (json.loads(line) for line in resp.text.splitlines())}
+        assert (results[0]["status"], results[0]["id"]) == (400, "b") and "error" in results[0]
+        assert results[1]["status"] == 400 and "line 2" in results[1]["error"]
+        assert (results[2]["status"], results[2]["location"]) == expected[0]
+        resp = client.post("https://linked.data.gov.au/redir/batch", content='{"iri": "x"}', headers={"content-type": "application/json"})
+        assert resp.status_code == 400
+
+
+def test_offline_resolver():
+    import io
+    import json
+    from src.resolve_iris import resolve_stream
+    settings["SERVER_NAME"] = "linked.data.gov.au"
+    lines = [
+        "https://linked.data.gov.au/dataset/bdr/orgs/wamuseum",
+        json.dumps({"iri": "https://linked.data.gov.au/dataset/bdr", "accept": "text/html", "id": 7}),
+        "https://linked.data.gov.au/not/a/path",
+        "",
+        "not-an-iri",
+        '{"iri": "https://linked.data.gov.au/dataset/bdr"',
+        json.dumps({"id": 8}),
+        json.dumps({"iri": "https://linked.data.gov.au/dataset/bdr", "accept": ["text/html"], "id": 9}),
+    ]
+    out = io.StringIO()
+    assert resolve_stream(lines, out, settings["CONFIG_DEFS_DIRECTORY"], "linked.data.gov.au", workers=0) == 7
+    results = [json.loads(line) for line in out.getvalue().splitlines()]
+    assert [r["status"] for r in results] == [307, 307, 404, 400, 400, 400, 400]
+    # Bad lines don't stop the run, their results have the line number and id
+    assert results[4]["line"] == 6 and "error" in results[4]
+    assert (results[5]["line"], results[5]["id"]) == (7, 8) and "error" in results[5]
+    assert (results[6]["line"], results[6]["id"]) == (8, 9) and "accept" in results[6]["error"]
+    assert results[0]["rule"] == "^dataset/bdr/orgs/(.+)"
+    assert results[1]["rule"] == "_bdr_html" and results[1]["id"] == 7
+    assert results[2]["rule"] is None and results[2]["virtualhost"] == "linked.data.gov.au"
+    with TestClient(app=create_app(), root_path="") as client:
+        for r in results[:3]:
+            resp = client.get("https://linked.data.gov.au/redir", params={"_pid": r["iri"]},
+                              headers={"accept": "text/html"} if r.get("id") == 7 else {}, follow_redirects=False)
+            assert (resp.status_code, resp.headers.get("location", None)) == (r["status"], r["location"])
+
+
+@pytest.mark.parametrize("fast", [False, True], ids=["starlette", "fast"])
+def test_forwarded_host(fast, set_settings):
+    from src.functions.iri_headers import RawHeaders
+    headers = RawHeaders([(b"Host", b"Proxy.example:8080"), (b"x-forwarded-host", b"a.example, b.example"), (b"x-forwarded-ssl", b"off")])
+    assert headers.request_host() == "proxy.example"
+    assert headers.forwarded_proto_host() == ("http", "a.example")
+    headers = RawHeaders([(b"forwarded", b"proto=https;host=c.example"), (b"x-forwarded-host", b"a.example")])
+    assert headers.forwarded_proto_host() == ("https", "c.example")
+    set_settings({"SERVER_NAME": "", "REDIR_CACHE_SIZE": "0"})
+    app = create_app(fast=fast)
+    with TestClient(app=app, root_path="") as client:
+        # The virtualhost comes from the proxy's forwarded host, not the Host header
+        resp = client.get(
+            "https://proxy.example/dataset/bdr/orgs/wamuseum",
+            headers={"x-forwarded-host": "linked.data.gov.au", "x-forwarded-proto": "https"},
+            follow_redirects=False,
+        )
+        assert resp.status_code == 307
+        resp = client.get("https://proxy.example/dataset/bdr/orgs/wamuseum", follow_redirects=False)
+        assert resp.status_code == 404
+
+
+@pytest.mark.parametrize("fast", [False, True], ids=["starlette", "fast"])
+def test_pid_host_case_and_port(fast, set_settings):
+    set_settings({"SERVER_NAME": "", "REDIR_CACHE_SIZE": "0"})
+    app = create_app(fast=fast)
+    with TestClient(app=app, root_path="") as client:
+        locations = []
+        for iri in (
+            "https://linked.data.gov.au/dataset/bdr/orgs/wamuseum",
+            "https://Linked.Data.Gov.Au/dataset/bdr/orgs/wamuseum",
+            "https://linked.data.gov.au:443/dataset/bdr/orgs/wamuseum",
+        ):
+            resp = client.get("https://localhost/redir", params={"_pid": iri}, headers={"accept": "text/turtle"}, follow_redirects=False)
+            assert resp.status_code == 307
+            locations.append(resp.headers["location"])
+        # The dest gets the normalised host, so the IRI still maps to its CURIE
+        assert "bdr-orgs:wamuseum" in locations[0]
+        assert locations[1] == locations[0] and locations[2] == locations[0]
+
+
+@pytest.mark.parametrize("fast", [False, True], ids=["starlette", "fast"])
+def test_conditional_rule_without_accept(fast, tmp_path, set_settings):
+    (tmp_path / "test.toml").write_text(
+        '[default]\nvirtualhost = "example.com"\n[redirects]\n'
+        '"a_ttl" = { from="a", to="https://example.org/ttl", condition={mediatype="ttl"} }\n'
+        '"a_other" = { from="a", to="https://example.org/other", condition={not={mediatype="ttl"}} }\n'
+    )
+    set_settings({"SERVER_NAME": "example.com", "CONFIG_DEFS_DIRECTORY": str(tmp_path), "REDIR_CACHE_SIZE": "0"})
+    app = create_app(fast=fast)
+    with TestClient(app=app, root_path="") as client:
+        del client.headers["accept"]
+        resp = client.get("http://example.com/a", follow_redirects=False)
+        assert resp.headers["location"] == "https://example.org/other"
+        resp = client.get("http://example.com/a", headers={"accept": "*/*"}, follow_redirects=False)
+        assert resp.headers["location"] == "https://example.org/other"
+        resp = client.get("http://example.com/a", headers={"accept": "text/turtle"}, follow_redirects=False)
+        assert resp.headers["location"] == "https://example.org/ttl"
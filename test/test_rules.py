@@ -0,0 +1,363 @@
+from pathlib import Path
+try:
+    import pytest
+except ImportError:
+    raise RuntimeError("pytest must be installed in the python environment for tests to run")
+
+import regex
+
+tests_dir = Path(__file__).parent
+
+from src import settings
+from src.functions.connegp import media_range_rank, negotiate_mediatypes, parse_mediatypes
+from src.functions.iri_configs import RedirDefs, compile_defs, find_regex_startsmatch, load_all_defs
+from src.functions.iri_rules import Condition, DecisionTable, RegexRuleIndex, Rule, RuleSet
+from src.functions.iri_snapshot import build_snapshot_file, load_snapshot_defs, read_snapshot_file
+from src.functions.iri_sources import BlobDefsSource, DirectoryDefsSource
+settings["CONFIG_DEFS_DIRECTORY"] = str(tests_dir / "configs")
+
+
+def test_load_all_defs_ruleset():
+    state = {}
+    assert load_all_defs(state) is True
+    snapshot = state["redir_defs"].current
+    defs = snapshot.defs
+    rules = defs["linked.data.gov.au"]
+    assert isinstance(rules, RuleSet)
+    # Host aliases share the same compiled RuleSet
+    assert defs["linked.bdr.gov.au"] is rules
+    # Regex rules are pre-sorted longest pattern first
+    lengths = [len(r.pattern) for r in rules.regex_redirects]
+    assert lengths == sorted(lengths, reverse=True)
+    # Defaults from the [default] table are resolved into each rule
+    assert all(r.code == 307 and r.qsa for r in rules.regex_redirects)
+    with pytest.raises(AttributeError):
+        rules.redirects = {}
+    with pytest.raises(TypeError):
+        rules.redirects["new/path"] = rules.redirects["dataset/bdr/orgs"]
+    # Nothing changed on disk, so the defs are not rebuilt
+    assert load_all_defs(state) is False
+    assert state["redir_defs"].current is snapshot
+
+
+def test_regex_index_candidates_match_linear_scan():
+    state = {}
+    load_all_defs(state)
+    index = state["redir_defs"].current.defs["linked.data.gov.au"].regex_redirects
+    for path in ("dataset/bdr/orgs/wamuseum", "dataset/bdr/other/", "dataset/bdr", "", "nothing/here"):
+        expected = tuple(r for r in index if not r.startsmatch or path.startswith(r.startsmatch))
+        assert index.candidates(path) == expected
+
+
+def test_combined_regex_engine_matches_loop():
+    patterns = [
+        ("^dataset/bdr/(.+)", "a/{1}"),
+        ("^dataset/bdr/orgs/(.+)", "b/{1}"),
+        ("orgs/([a-z]+)", "c/{1}"),  # unanchored, matches mid-path
+        ("^def/(?P<v>[^/]+)/(.+)", "d/{v}/{2}"),
+        ("^x$", "e"),
+    ]
+    rules = [
+        Rule(p, p, to, regex=regex.compile(p, flags=regex.IGNORECASE), startsmatch=find_regex_startsmatch(p))
+        for (p, to) in patterns
+    ]
+    rules = tuple(sorted(rules, key=lambda r: len(r.pattern), reverse=True))
+    loop = RegexRuleIndex(rules)
+    combined = RegexRuleIndex(rules, combined=True)
+    assert combined.is_combined and not loop.is_combined
+    for path in ("dataset/bdr/orgs/wam", "dataset/bdr/x", "other/orgs/abc", "def/abis/a/b", "x", "xx", "",
+                 "Dataset/BDR/orgs/wam", "dataset/bdr/ORGS/wam", "other/ORGS/abc", "X"):
+        assert combined.substitute(path) == loop.substitute(path)
+
+
+def test_combined_regex_engine_fallback_warns(caplog):
+    p = r"^(a)/\1$"
+    rule = Rule(p, p, "x", regex=regex.compile(p, flags=regex.IGNORECASE), startsmatch=find_regex_startsmatch(p))
+    index = RegexRuleIndex((rule,), combined=True)
+    assert not index.is_combined and index.substitute("a/a") == RegexRuleIndex((rule,)).substitute("a/a")
+    assert any(r.levelname == "WARNING" and p in r.getMessage() and "backreference" in r.getMessage() for r in caplog.records)
+
+
+def test_lowered_regex_rules_match_loop():
+    patterns = [
+        ("^dataset/bdr/(.+)", "a/{1}"),
+        ("^dataset/bdr/orgs/(.+)$", "b/{1}/x"),
+        ("^dataset/bdr/orgs/wam$", "c"),  # shadowed by the longer pattern below, stays a regex
+        ("^dataset/bdr/orgs/(wam)", "d"),
+        ("^def/(.*)", "e/{1}"),
+        ("^def/(?P<v>[^/]+)/(.+)", "f/{v}/{2}"),
+        ("^about$", "g"),
+        ("^about.html$", "h"),  # "." is a metachar, not a literal
+    ]
+    rules = [
+        Rule(p, p, to, regex=regex.compile(p, flags=regex.IGNORECASE), startsmatch=find_regex_startsmatch(p))
+        for (p, to) in patterns
+    ]
+    rules = tuple(sorted(rules, key=lambda r: len(r.pattern), reverse=True))
+    loop = RegexRuleIndex(rules)
+    lowered = RegexRuleIndex(rules, lower=True)
+    assert set(lowered.literals) == {"about"}
+    assert {r.key for r in lowered if r.split is not None} == {"^dataset/bdr/(.+)", "^dataset/bdr/orgs/(.+)$", "^def/(.*)"}
+    assert len(lowered) == len(loop)
+    for path in (
+        "dataset/bdr/orgs/wam", "dataset/bdr/orgs/wamx", "dataset/bdr/orgs/", "dataset/bdr/x", "dataset/bdr/",
+        "def/", "def/abis/a/b", "about", "aboutx", "about.html", "aboutahtml", "dataset/bdr/a\nb", "",
+    ):
+        expected = loop.substitute(path)
+        found = lowered.substitute(path)
+        if expected is None:
+            assert found is None, path
+        else:
+            assert (found[0].key, found[1]) == (expected[0].key, expected[1]), path
+
+
+class _FakeBlob:
+    def __init__(self, name, etag):
+        self.name = name
+        self.etag = etag
+
+
+class _FakeDownloader:
+    def __init__(self, data, etag):
+        self._data = data
+        self.properties = _FakeBlob(None, etag)
+
+    def readall(self):
+        return self._data
+
+
+class _FakeContainerClient:
+    """In-process stand-in for azure.storage.blob.ContainerClient"""
+
+    def __init__(self):
+        self.blobs = {}
+        self.downloads = 0
+
+    def upload(self, name, data: bytes):
+        etag = f'"{name}-{len(self.blobs)}-{hash(data)}"'
+        self.blobs[name] = (data, etag)
+
+    def list_blobs(self, name_starts_with=None):
+        return [_FakeBlob(n, etag) for n, (_, etag) in self.blobs.items() if n.startswith(name_starts_with or "")]
+
+    def get_blob_client(self, name):
+        container = self
+
+        class _FakeBlobClient:
+            def download_blob(self, etag=None, match_condition=None):
+                from azure.core import MatchConditions
+                from azure.core.exceptions import ResourceNotModifiedError
+                data, current_etag = container.blobs[name]
+                if match_condition == MatchConditions.IfModified and etag == current_etag:
+                    raise ResourceNotModifiedError()
+                container.downloads += 1
+                return _FakeDownloader(data, current_etag)
+        return _FakeBlobClient()
+
+
+def test_duplicate_dest_uses_last_definition(caplog):
+    all_defs = [
+        {"dests": {"d": {"kind": "prez_v4", "api_endpoint": f"https://{n}.example.org/"}}}
+        for n in ("first", "second")
+    ]
+    (_, dests) = compile_defs(all_defs)
+    assert dests["d"].keywords["dest_params"]["api_endpoint"] == "https://second.example.org/"
+    assert any(r.levelname == "ERROR" and "Destination name d" in r.getMessage() for r in caplog.records)
+
+
+def test_access_log_flush_interval(monkeypatch):
+    import io
+    import logging
+    import time
+    from src.functions import iri_access_log
+    from src.functions.iri_access_log import AccessLog, NDJSONBatchHandler
+
+    clock = [100.0]
+    monkeypatch.setattr(iri_access_log, "monotonic", lambda: clock[0])
+    stream = io.StringIO()
+    handler = NDJSONBatchHandler(stream, batch_size=100, flush_interval=1.0)
+    assert handler.due_in() is None
+    record = logging.LogRecord(iri_access_log.ACCESS_LOGGER_NAME, logging.INFO, __file__, 0, "access", None, None)
+    record.access = ("example.org", "a", "example.org", None, 404, None, 1000)
+    handler.emit(record)
+    assert stream.getvalue() == "" and handler.due_in() == 1.0
+    clock[0] += 0.5
+    handler.flush_if_due()
+    assert stream.getvalue() == "" and handler.due_in() == 0.5
+    # Time passes with no new records, and the batch is written
+    clock[0] += 0.5
+    handler.flush_if_due()
+    assert stream.getvalue().count("\n") == 1 and handler.due_in() is None
+    monkeypatch.undo()
+
+    # The listener writes a waiting batch when its interval is up, without another record coming
+    stream = io.StringIO()
+    access_log = AccessLog(NDJSONBatchHandler(stream, batch_size=100, flush_interval=0.05))
+    access_log.start()
+    try:
+        for _ in range(2):
+            access_log.record("example.org", "a", "example.org", None, 404, None, 1000)
+        for _ in range(100):
+            if stream.getvalue():
+                break
+            time.sleep(0.02)
+        assert stream.getvalue().count("\n") == 2
+    finally:
+        access_log.stop()
+
+
+def test_blob_defs_source_etags():
+    container = _FakeContainerClient()
+    container.upload("a.toml", b'[default]\nvirtualhost = "a.example"\n[redirects]\n"x" = "https://a.example.org/x"\n')
+    container.upload("b.toml", b'[default]\nvirtualhost = "b.example"\n[redirects]\n"x" = "https://b.example.org/x"\n')
+    container.upload("readme.md", b'not a definition file')
+    redir_defs = RedirDefs(source=BlobDefsSource(container))
+    state = {"redir_defs": redir_defs}
+    assert load_all_defs(state) is True
+    assert container.downloads == 2
+    assert redir_defs.current.defs["b.example"].redirects["x"].to == "https://b.example.org/x"
+    # Nothing changed, so nothing is downloaded or rebuilt
+    assert load_all_defs(state) is False
+    assert container.downloads == 2
+    container.upload("b.toml", b'[default]\nvirtualhost = "b.example"\n[redirects]\n"x" = "https://b.example.org/y"\n')
+    assert load_all_defs(state) is True
+    assert container.downloads == 3
+    assert redir_defs.current.defs["b.example"].redirects["x"].to == "https://b.example.org/y"
+
+
+def test_defs_source_must_implement_read():
+    from src.functions.iri_sources import DefsSource
+
+    class IncompleteSource(DefsSource):
+        pass
+
+    with pytest.raises(TypeError):
+        IncompleteSource()
+
+
+def test_defs_snapshot_file(tmp_path):
+    conf_dir = tmp_path / "configs"
+    conf_dir.mkdir()
+    conf_file = conf_dir / "test1.toml"
+    conf_file.write_bytes((tests_dir / "configs" / "test1.toml").read_bytes())
+    snapshot_file = str(tmp_path / "defs.pickle")
+    build_snapshot_file(snapshot_file, str(conf_dir))
+    redir_defs = RedirDefs(source=DirectoryDefsSource(str(conf_dir)))
+    assert load_snapshot_defs(redir_defs, snapshot_file) is True
+    rules = redir_defs.current.defs["linked.data.gov.au"]
+    assert redir_defs.current.defs["linked.bdr.gov.au"] is rules
+    assert rules.regex_redirects.candidates("dataset/bdr/orgs/x")[0].pattern == "^dataset/bdr/orgs/(.+)"
+    with pytest.raises(AttributeError):
+        rules.redirects = {}
+    # The watcher sees the snapshot's files as unmodified
+    assert load_all_defs({"redir_defs": redir_defs}) is False
+    # A changed definition file no longer matches the snapshot
+    conf_file.write_bytes(conf_file.read_bytes() + b"\n")
+    assert read_snapshot_file(snapshot_file, str(conf_dir)) is None
+
+
+def test_mediatype_negotiation():
+    def negotiate(accept, f_ext=None):
+        return negotiate_mediatypes(parse_mediatypes((accept,) if accept else (), (), None, None, f_ext))
+
+    # Most specific matching range wins, q=0 refuses a type
+    mts = parse_mediatypes(("text/*;q=0.5, text/html;q=0, */*;q=0.1",), (), None, None, None)
+    assert media_range_rank(mts, "text/turtle") == (0.5, 1)
+    assert media_range_rank(mts, "text/html") == (0.0, -1)
+    assert media_range_rank(mts, "application/json") == (0.1, 0)
+    assert media_range_rank((), "image/png") == (1.0, 0)
+
+    assert negotiate(None).best == "text/turtle"
+    assert negotiate("*/*").media_class == "rdf"
+    assert negotiate("text/html").accepts("html")
+    assert not negotiate("*/*").accepts("html")
+    assert negotiate("text/html;q=0.9, application/ld+json").best == "application/ld+json"
+    # An unknown type only matches a condition if it is rated above the best known type
+    assert negotiate("image/png").best is None
+    assert negotiate("image/png").accepts("image/png")
+    assert not negotiate("text/turtle, image/png;q=0.5").accepts("image/png")
+    assert not negotiate("*/*").accepts("image/png")
+    # No Accept header, or only */*, is no preference: the dests get RDF, but no mediatype condition holds
+    assert negotiate(None).preferred is None and not negotiate(None).accepts("ttl")
+    assert not negotiate("*/*").accepts("ttl") and negotiate("text/turtle, */*;q=0.1").accepts("ttl")
+    # An Accept header with only wildcards lets the file extension choose
+    assert negotiate("*/*", "ttl").best == "text/turtle"
+    assert negotiate("application/xml, text/html;q=0.9").media_class == "html"
+
+
+def test_condition_decision_table():
+    def negotiate(accept):
+        return negotiate_mediatypes(parse_mediatypes((accept,), (), None, None, None))
+
+    state = {}
+    load_all_defs(state)
+    table = state["redir_defs"].current.defs["linked.data.gov.au"].conditional_redirects["dataset/bdr"]
+    assert isinstance(table, DecisionTable) and table.table is not None
+    assert table.select(negotiate("text/html"), frozenset()).key == "_bdr_html"
+    assert table.select(negotiate("*/*"), frozenset()).key == "_bdr_not_html"
+
+    prof = "https://example.com/profile"
+    rules = tuple(
+        Rule(key, "p", to, condition=Condition(cond))
+        for (key, to, cond) in (
+            ("html_prof", "a", {"mediatype": "html", "profile": prof}),
+            ("not_prof", "b", {"not": {"profile": prof}}),
+            ("empty", "c", {}),
+            ("ttl", "d", {"mediatype": "text/turtle"}),
+        )
+    )
+    table = DecisionTable(rules)
+    assert table.table is not None
+    # Unknown mediatypes can't be tabled, the conditions are evaluated in turn instead
+    untabled = DecisionTable(rules + (Rule("png", "p", "e", condition=Condition({"mediatype": "image/png"})),))
+    assert untabled.table is None
+    for accept in ("text/html", "text/turtle", "*/*", "image/png", "text/html;q=0, text/turtle;q=0.5"):
+        for profile_set in (frozenset(), frozenset((prof,)), frozenset(("other",))):
+            negotiation = negotiate(accept)
+            expected = next((r for r in untabled if r.condition.applies(negotiation, profile_set)), None)
+            assert untabled.select(negotiation, profile_set) is expected
+            if expected is None or expected.key != "png":
+                assert table.select(negotiation, profile_set) is expected
+
+
+def test_prez_dest_prefix_index():
+    from src.functions.iri_dests import invert_prefixes, prez_v3_rule_params, uri_to_curie
+    ns_prefixes = invert_prefixes({"a": "https://example.com/a/", "b": "https://example.com/b/", "a2": "https://example.com/a/"})
+    # The first prefix of a namespace wins, as with a linear scan
+    assert ns_prefixes == {"https://example.com/a/": "a", "https://example.com/b/": "b"}
+    assert uri_to_curie("https://example.com/b/x", ns_prefixes) == "b:x"
+    assert uri_to_curie("https://example.com/c/x", ns_prefixes) is None
+    # The parent CURIE of a rule is resolved against the rule's prefixes, or the dest's
+    dest = {"prefixes": {"a": "https://example.com/a/"}}
+    assert prez_v3_rule_params(dest, {"prez_parent": "https://example.com/a/p"})["prez_parent_curie"] == "a:p"
+    params = prez_v3_rule_params(dest, {"prez_parent": "https://example.com/b/p", "prefixes": {"b": "https://example.com/b/"}})
+    assert params["prez_parent_curie"] == "b:p" and params["ns_prefixes"] == {"https://example.com/b/": "b"}
+    plain = {"prez_kind": "vocab"}
+    assert prez_v3_rule_params(dest, plain) is plain
+
+    state = {}
+    load_all_defs(state)
+    rules = state["redir_defs"].current.defs["linked.data.gov.au"]
+    rule = next(r for r in rules.regex_redirects if r.pattern == "^dataset/bdr/orgs/(.+)")
+    assert rule.params["prez_parent_curie"] == "bdr-ds:orgs"
+
+
+def test_host_index():
+    from src.functions.iri_hosts import HostIndex, normalize_host
+    assert normalize_host(" Example.ORG:8080 ") == "example.org"
+    assert normalize_host("example.org.") == "example.org"
+    assert normalize_host("[::1]:8080") == "[::1]"
+    assert normalize_host("a.example, proxy.example") == "a.example"
+    default, exact, wild, deep = (RuleSet(vh) for vh in ("", "example.org", "*.example.org", "*.a.example.org"))
+    hosts = HostIndex({"": default, "example.org": exact, "alias.example": exact, "*.example.org": wild, "*.A.example.org": deep})
+    assert hosts.find("EXAMPLE.org:443") is exact
+    assert hosts.find("alias.example") is exact
+    assert hosts.find("x.example.org") is wild
+    assert hosts.find("x.a.example.org") is deep
+    assert hosts.find("a.example.org") is wild
+    assert hosts.find("other.example") is None
+    assert hosts.select(["other.example", "WWW.Example.org.:8443"]) == ("www.example.org", wild)
+    assert hosts.select(["other.example"], "Example.org") == (None, exact)
+    assert hosts.select(["other.example"], "missing.example") == (None, default)
+    # Results are cached by the raw host name
+    assert "EXAMPLE.org:443" in hosts._cache